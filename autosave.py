@@ -0,0 +1,216 @@
+"""
+自动保存与崩溃恢复
+
+每隔一段时间把画布上一次检查点之后的变化写入会话的恢复文件（.mathnote 格式）：
+界面线程只复制修改过的图块的像素，压缩和写入在后台线程中进行，正在书写时跳过本次检查点。
+第一次写入（以及整理文件时）写入临时文件后原子地替换，之后只追加变化的记录，
+文件中最后一个完整的提交点总是可以恢复。
+
+程序崩溃后留下的恢复文件在下一次启动时提示恢复。正常退出时如果还有没保存的修改，
+写完最后一个检查点并保留恢复文件（下一次启动时同样提示恢复），否则删除。
+
+- MATHNOTE_AUTOSAVE_INTERVAL: 检查点间隔（秒），默认30，为0时关闭自动保存
+- MATHNOTE_AUTOSAVE_MAX_MB: 每次最多复制的图块数据量（MB），默认8；超出的部分稍后继续写入，
+  全部写完时才提交，恢复的总是某一时刻完整的画布
+- MATHNOTE_AUTOSAVE_DIR: 恢复文件所在的目录，默认为 ~/.mathnote/autosave
+"""
+import glob
+import os
+import re
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QTimer, pyqtSignal
+
+from notefile import EXTENSION, NoteFile, NoteFileError
+from tracing import stage
+
+AUTOSAVE_INTERVAL = float(os.environ.get("MATHNOTE_AUTOSAVE_INTERVAL", 30))
+AUTOSAVE_MAX_BYTES = int(float(os.environ.get("MATHNOTE_AUTOSAVE_MAX_MB", 8)) * 1024 * 1024) or None
+AUTOSAVE_DIR = os.environ.get("MATHNOTE_AUTOSAVE_DIR") or os.path.join(os.path.expanduser("~"), ".mathnote", "autosave")
+# 检查点没有写完所有变化时，多久之后继续写入（毫秒）
+CATCH_UP_MS = 1000
+
+_SESSION_NAME = re.compile(r"autosave-(\d+)" + re.escape(EXTENSION) + "$")
+
+
+def session_path(directory=AUTOSAVE_DIR, pid=None):
+    """本进程的恢复文件"""
+    return os.path.join(directory, f"autosave-{os.getpid() if pid is None else pid}{EXTENSION}")
+
+
+def _process_alive(pid, path):
+    if os.name == "nt":
+        # Windows 上运行中的进程一直打开着自己的恢复文件，无法重命名
+        try:
+            os.rename(path, path + ".probe")
+            os.rename(path + ".probe", path)
+        except OSError:
+            return True
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def find_recoverable(directory=AUTOSAVE_DIR):
+    """已经退出（崩溃）的进程留下的恢复文件，最新的在前"""
+    paths = []
+    for path in glob.glob(os.path.join(directory, "autosave-*" + EXTENSION)):
+        match = _SESSION_NAME.search(os.path.basename(path))
+        if match is None or int(match.group(1)) == os.getpid():
+            continue
+        if not _process_alive(int(match.group(1)), path):
+            paths.append(path)
+    return sorted(paths, key=os.path.getmtime, reverse=True)
+
+
+def discard(path):
+    for name in (path, path + ".tmp"):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+
+class AutosaveSignals(QObject):
+    # 写入的字节数
+    finished = pyqtSignal(int)
+    failed = pyqtSignal(str)
+
+
+class AutosaveJob(QRunnable):
+    """在后台线程中写入一个检查点的快照"""
+    def __init__(self, noteFile, snapshot):
+        super().__init__()
+        self.noteFile = noteFile
+        self.snapshot = snapshot
+        self.signals = AutosaveSignals()
+        # 由 Autosaver 持有引用，直到任务结束
+        self.setAutoDelete(False)
+
+    def run(self):
+        try:
+            with stage("autosave_write"):
+                size = self.noteFile.write(self.snapshot)
+        except (OSError, NoteFileError) as e:
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.finished.emit(size)
+
+
+class Autosaver(QObject):
+    """
+    定时把画布的变化写入恢复文件
+
+    - start(): 开始定时检查点（间隔为0时不做任何事）
+    - checkpoint(): 立即尝试一次检查点；上一次还在写入或正在书写时跳过
+    - adopt(path): 把崩溃留下的恢复文件接管为本进程的恢复文件并打开，返回 NoteFile
+    - shutdown(): 退出前调用；有没保存的修改时写完最后一个检查点并保留文件，否则删除
+    """
+    def __init__(self, canvas, directory=AUTOSAVE_DIR, interval=AUTOSAVE_INTERVAL, maxBytes=AUTOSAVE_MAX_BYTES):
+        super().__init__(canvas)
+        self.canvas = canvas
+        self.directory = directory
+        self.path = session_path(directory)
+        self.maxBytes = maxBytes
+        self.noteFile = None
+        self.job = None
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.timer = QTimer(self)
+        self.timer.setInterval(int(interval * 1000))
+        self.timer.timeout.connect(self.checkpoint)
+
+    def start(self):
+        if self.timer.interval() > 0:
+            self.timer.start()
+
+    def isBusy(self):
+        return self.job is not None
+
+    def checkpoint(self):
+        """生成快照并在后台写入，返回是否开始了写入"""
+        canvas = self.canvas
+        if self.job is not None or canvas.drawing:
+            return False
+        if not canvas.isModified():
+            self.discardFile()
+            return False
+        snapshot = self.takeSnapshot(self.maxBytes)
+        if snapshot is None:
+            return False
+        self.job = AutosaveJob(self.noteFile, snapshot)
+        self.job.signals.finished.connect(self.onFinished)
+        self.job.signals.failed.connect(self.onFailed)
+        self.pool.start(self.job)
+        return True
+
+    def takeSnapshot(self, maxBytes):
+        canvas = self.canvas
+        if self.noteFile is None:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+            except OSError as e:
+                print(f"无法创建自动保存目录: {str(e)}")
+                return None
+            self.noteFile = NoteFile(self.path)
+        meta = canvas.documentMeta()
+        meta["document"] = canvas.noteFile.path if canvas.noteFile is not None else None
+        with stage("autosave_snapshot"):
+            return self.noteFile.snapshot(canvas.store, canvas.scene, canvas.liveTracker.segments, meta, maxBytes)
+
+    def onFinished(self, size):
+        self.job = None
+        # 超出数据量上限的图块稍后继续写入，不等到下一个间隔
+        if self.noteFile is not None and self.noteFile.pending():
+            QTimer.singleShot(CATCH_UP_MS, self.checkpoint)
+
+    def onFailed(self, message):
+        self.job = None
+        print(f"自动保存时出错: {message}")
+
+    def discardFile(self):
+        """画布与已保存的内容一致时删除恢复文件（仍有图块从中按需加载时保留）"""
+        note = self.noteFile
+        if note is None:
+            return
+        store = self.canvas.store
+        if any(store.tileSource(key) is note for key in store.keys()):
+            return
+        note.close()
+        self.noteFile = None
+        discard(self.path)
+
+    def adopt(self, path):
+        """接管崩溃留下的恢复文件，失败时抛出 OSError 或 NoteFileError"""
+        os.makedirs(self.directory, exist_ok=True)
+        os.replace(path, self.path)
+        discard(path)
+        note = NoteFile.open(self.path)
+        if self.noteFile is not None:
+            self.noteFile.close()
+        self.noteFile = note
+        return note
+
+    def shutdown(self):
+        self.timer.stop()
+        self.pool.waitForDone()
+        self.job = None
+        if self.canvas.isModified():
+            # 最后一个检查点在当前线程中写完，不限制数据量
+            snapshot = self.takeSnapshot(None)
+            if snapshot is not None:
+                try:
+                    self.noteFile.write(snapshot)
+                except (OSError, NoteFileError) as e:
+                    print(f"自动保存时出错: {str(e)}")
+            if self.noteFile is not None:
+                self.noteFile.close()
+            return
+        if self.noteFile is not None:
+            self.noteFile.close()
+            self.noteFile = None
+        discard(self.path)
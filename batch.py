@@ -0,0 +1,237 @@
+"""
+批量识别与求解
+
+不创建窗口，对一批公式图片执行与右键“识别并计算公式”相同的
+识别 -> 分类 -> 求解 流程。每个工作进程常驻一个识别模型，结果以JSONL格式
+在完成时逐行写出；再次运行时会跳过输出文件中已有的输入，实现断点续跑。
+
+用法：
+    python main.py batch <目录|通配符> [...] [-o 输出.jsonl] [-j 进程数]
+"""
+import argparse
+import concurrent.futures
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def collect_inputs(patterns):
+    """展开目录和通配符，返回排序去重后的图片路径"""
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                paths.extend(
+                    os.path.join(root, name) for name in files
+                    if name.lower().endswith(IMAGE_EXTENSIONS)
+                )
+        else:
+            paths.extend(
+                path for path in glob.glob(pattern, recursive=True)
+                if os.path.isfile(path)
+            )
+    return sorted(set(os.path.abspath(path) for path in paths))
+
+
+def load_finished(outputPath):
+    """读取已有输出文件中处理过的输入"""
+    finished = set()
+    if not os.path.exists(outputPath):
+        return finished
+    with open(outputPath, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                finished.add(json.loads(line)["input"])
+            except (ValueError, KeyError, TypeError):
+                # 中断时可能留下不完整的最后一行
+                continue
+    return finished
+
+
+def _init_worker(timeout):
+    """工作进程初始化：加载常驻识别模型，求解进程只保留一个"""
+    from recognizer import get_recognizer
+    from solver_engine import get_solver_engine
+    engine = get_solver_engine()
+    engine.maxWorkers = 1
+    if timeout is not None:
+        engine.timeout = timeout
+    try:
+        get_recognizer().ensure_loaded()
+    except Exception as e:
+        # 加载失败时每个输入都会记录错误，不在这里退出
+        print(f"加载识别模型失败: {str(e)}", file=sys.stderr)
+
+
+def _solve_formula(latex):
+    """分类并求解一个公式，返回该公式的结果记录和各阶段耗时"""
+    from formula import ParsedFormula, calculate_formula
+
+    entry = {"latex": latex, "classification": None, "status": None, "solutions": None, "error": None}
+    timings = {}
+    stage = "classify"
+    start = time.perf_counter()
+    try:
+        formula = ParsedFormula.of(latex)
+        entry["classification"] = formula.relation
+        timings["classify"] = time.perf_counter() - start
+
+        stage = "solve"
+        start = time.perf_counter()
+        result = calculate_formula(formula)
+        timings["solve"] = time.perf_counter() - start
+        entry.update(
+            status=result.status,
+            solutions=None if result.solutions is None else str(result.solutions),
+            error=result.error,
+        )
+    except Exception as e:
+        timings[stage] = time.perf_counter() - start
+        entry["status"] = "error"
+        entry["error"] = f"{stage}: {str(e)}"
+    return entry, timings
+
+
+def process_image(path):
+    """
+    对一张图片执行 分割 -> 识别 -> 分类 -> 求解，返回一条结果记录
+
+    与界面中的右键识别相同，图片先分割成多个公式，在一次批量推理中识别后分别求解。
+    formulas 为每个公式的结果（包围盒为图片内的 (top, bottom, left, right)）；
+    latex/classification/status/solutions/error 为第一个公式的结果，没有公式时 status 为 empty。
+    """
+    import numpy as np
+    from PIL import Image
+    from image_bridge import preprocess_segments
+    from recognizer import get_recognizer
+
+    record = {
+        "input": path,
+        "latex": None,
+        "classification": None,
+        "status": None,
+        "solutions": None,
+        "formulas": [],
+        "timings": {},
+        "error": None,
+    }
+    stage = "load"
+    start = time.perf_counter()
+    try:
+        segments = preprocess_segments(np.asarray(Image.open(path).convert("RGB")))
+        record["timings"]["load"] = time.perf_counter() - start
+        if not segments:
+            record["latex"] = ""
+            record["status"] = "empty"
+            return record
+
+        stage = "recognize"
+        start = time.perf_counter()
+        recognized = get_recognizer().recognize_formulas([image for _, image in segments])
+        record["timings"]["recognize"] = time.perf_counter() - start
+    except Exception as e:
+        record["timings"][stage] = time.perf_counter() - start
+        record["status"] = "error"
+        record["error"] = f"{stage}: {str(e)}"
+        return record
+
+    for (box, _), latex in zip(segments, recognized):
+        if not latex:
+            continue
+        entry, timings = _solve_formula(latex)
+        record["formulas"].append({"box": [int(value) for value in box], **entry})
+        for name, elapsed in timings.items():
+            record["timings"][name] = record["timings"].get(name, 0.0) + elapsed
+    if not record["formulas"]:
+        record["latex"] = ""
+        record["status"] = "empty"
+        return record
+    first = record["formulas"][0]
+    record.update({key: first[key] for key in ("latex", "classification", "status", "solutions", "error")})
+    return record
+
+
+def _open_output(outputPath):
+    """以追加方式打开输出文件；中断时留下的不完整的最后一行被截掉，避免与新记录连在一起"""
+    out = open(outputPath, "a+b")
+    size = out.seek(0, os.SEEK_END)
+    if size:
+        # 从末尾向前找到最后一个换行符
+        position = size
+        while position > 0:
+            step = min(4096, position)
+            out.seek(position - step)
+            chunk = out.read(step)
+            newline = chunk.rfind(b"\n")
+            if newline >= 0:
+                position = position - step + newline + 1
+                break
+            position -= step
+        if position < size:
+            out.truncate(position)
+    out.close()
+    return open(outputPath, "a", encoding="utf-8")
+
+
+def run_batch(inputs, outputPath, jobs=1, timeout=None):
+    """处理所有未完成的输入，结果追加写入 outputPath，返回本次处理的数量"""
+    finished = load_finished(outputPath)
+    pending = [path for path in inputs if path not in finished]
+    total = len(pending)
+    print(f"共 {len(inputs)} 个输入，已完成 {len(inputs) - total} 个，待处理 {total} 个", file=sys.stderr)
+    if not pending:
+        return 0
+
+    with _open_output(outputPath) as out:
+        def write(index, record):
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            print(f"[{index}/{total}] {record['status']}: {record['input']}", file=sys.stderr)
+
+        if jobs <= 1:
+            _init_worker(timeout)
+            for index, path in enumerate(pending, 1):
+                write(index, process_image(path))
+            return total
+
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, mp_context=context,
+            initializer=_init_worker, initargs=(timeout,)
+        ) as executor:
+            futures = {executor.submit(process_image, path): path for path in pending}
+            for index, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                try:
+                    record = future.result()
+                except Exception as e:
+                    # 工作进程崩溃等情况，记录后继续
+                    record = {"input": futures[future], "status": "error", "error": str(e)}
+                write(index, record)
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="main.py batch",
+        description="批量识别并求解公式图片，结果以JSONL格式输出"
+    )
+    parser.add_argument("inputs", nargs="+", help="图片目录或通配符（如 'scans/**/*.png'）")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl", help="输出的JSONL文件，已存在时续跑")
+    parser.add_argument("-j", "--jobs", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="工作进程数，每个进程常驻一个识别模型")
+    parser.add_argument("--timeout", type=float, default=None, help="单个求解任务的超时（秒）")
+    args = parser.parse_args(argv)
+
+    inputs = collect_inputs(args.inputs)
+    if not inputs:
+        print("没有找到输入图片", file=sys.stderr)
+        return 1
+    start = time.perf_counter()
+    count = run_batch(inputs, args.output, args.jobs, args.timeout)
+    print(f"处理完成 {count} 个，用时 {time.perf_counter() - start:.1f}s，结果写入 {args.output}", file=sys.stderr)
+    return 0
@@ -0,0 +1,222 @@
+"""
+数学管线基准测试
+
+不需要识别模型，使用固定的LaTeX语料测量 is_equation、is_binary_equation、
+is_calculation、solve_mix、safe_calculate、solve_expression 以及完整的
+calculate_formula 的耗时分位数和Python内存峰值（不含求解进程），
+结果保存为JSON，便于在不同提交之间比较。使用 --no-fast-path 关闭按结构的快速求解，
+可以在同一个提交中比较快速路径带来的差异。
+
+用法：
+    python benchmark.py [-n 重复次数] [-o 结果.json] [--no-fast-path]
+    python benchmark.py --compare 旧结果.json 新结果.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# 按类别整理的LaTeX语料
+CORPUS = {
+    "equation": [
+        "x^{2}+2x+1=0",
+        "3x-7=11",
+        "\\frac{x}{2}+\\frac{x}{3}=5",
+        "x^{3}-6x^{2}+11x-6=0",
+    ],
+    "inequality": [
+        "x>2",
+        "2x+3\\leq 7",
+        "x+y<3",
+        "x^{2}-4x\\geq 5",
+    ],
+    "system": [
+        "\\begin{cases} x+y=3 \\\\ x-y=1 \\end{cases}",
+        "\\begin{cases} {x^{2}+2x+1=0} \\\\ {y=2x} \\\\ \\end{cases}",
+        "\\begin{cases} 2x+3y-z=1 \\\\ x-y+2z=3 \\\\ 3x+y+z=6 \\end{cases}",
+    ],
+    "linear_system": [
+        "\\begin{cases} \\frac{x}{2}+\\frac{y}{3}=4 \\\\ \\frac{x}{4}-y=-5 \\end{cases}",
+        "\\begin{cases} a+b+c+d=10 \\\\ a-b+2c-d=3 \\\\ 2a+b-c+3d=15 \\\\ a+2b+c-2d=0 \\end{cases}",
+        "\\begin{cases} 0.5x+1.5y=4 \\\\ 2.5x-y=3.5 \\end{cases}",
+        "\\begin{cases} x+y=3 \\\\ 2x+2y=6 \\end{cases}",
+    ],
+    "polynomial": [
+        "x^{2}-5x+6=0",
+        "2x^{2}+3x-7=0",
+        "x^{4}-5x^{2}+4=0",
+        "(x-1)^{2}(x+2)^{6}=0",
+        "x^{6}-1=0",
+    ],
+    "calculation": [
+        "1+2\\times 3",
+        "\\frac{1}{3}+\\frac{2}{7}\\times 14-\\sqrt{16}",
+        "2^{10}-3^{5}+\\frac{17}{4}=",
+        "(1+2+3+4+5+6+7+8+9+10)\\times(11-12+13-14+15)",
+    ],
+    "pathological": [
+        "x^{12}-3x^{7}+2x^{3}-x+5=0",
+        "x^{9}+x^{8}-7x^{5}+2x^{2}-11=0",
+        "\\begin{cases} x^{3}+y^{3}=9 \\\\ x^{2}y+xy^{2}=6 \\end{cases}",
+    ],
+}
+
+FUNCTIONS = [
+    "is_equation",
+    "is_binary_equation",
+    "is_calculation",
+    "solve_mix",
+    "safe_calculate",
+    "solve_expression",
+    "calculate_formula",
+]
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(samples, p):
+    """线性插值的分位数"""
+    ordered = sorted(samples)
+    if len(ordered) == 1:
+        return ordered[0]
+    k = (len(ordered) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(ordered) - 1)
+    return ordered[f] + (ordered[c] - ordered[f]) * (k - f)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _call(function, latex_str):
+    try:
+        # 公式函数会打印调试信息，测量时丢弃
+        with contextlib.redirect_stdout(io.StringIO()):
+            function(latex_str)
+    except Exception:
+        # 基准只关心耗时，解析失败同样是一次真实的点击
+        pass
+
+
+def _time_call(function, latex_str, reset):
+    reset()
+    start = time.perf_counter()
+    _call(function, latex_str)
+    return time.perf_counter() - start
+
+
+def _peak_memory(function, latex_str, reset):
+    """单独测量一次调用的Python内存峰值（tracemalloc会拖慢计时，因此不与计时同时进行）"""
+    reset()
+    tracemalloc.start()
+    _call(function, latex_str)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def run_benchmarks(repeat=5, warmup=1, functions=None, timeout=None, fastPath=True):
+    import sympy
+    import formula
+    from solver_engine import get_solver_engine
+
+    formula.FAST_SOLVE = fastPath
+
+    engine = get_solver_engine()
+    if timeout is not None:
+        engine.timeout = timeout
+    # 先启动求解进程，避免把进程启动时间算进第一次求解
+    engine.evaluate(sympy.Integer(0))
+
+    # 每次调用前清空解析缓存，测量的是一次点击的冷启动开销
+    reset = formula.parse_formula.cache_clear
+
+    results = {}
+    for name in functions or FUNCTIONS:
+        function = getattr(formula, name)
+        results[name] = {}
+        for category, inputs in CORPUS.items():
+            times = []
+            peaks = []
+            for latex_str in inputs:
+                for _ in range(warmup):
+                    _time_call(function, latex_str, reset)
+                for _ in range(repeat):
+                    times.append(_time_call(function, latex_str, reset))
+                peaks.append(_peak_memory(function, latex_str, reset))
+            stats = {f"p{p}_ms": percentile(times, p) * 1000 for p in PERCENTILES}
+            stats["mean_ms"] = statistics.fmean(times) * 1000
+            stats["max_ms"] = max(times) * 1000
+            stats["peak_kb"] = max(peaks) / 1024
+            stats["samples"] = len(times)
+            results[name][category] = stats
+            print(f"{name:20s} {category:13s} p50={stats['p50_ms']:9.2f}ms "
+                  f"p90={stats['p90_ms']:9.2f}ms peak={stats['peak_kb']:9.1f}KB", file=sys.stderr)
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "warmup": warmup,
+            "fast_path": fastPath,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare(basePath, newPath):
+    """打印两次结果中p50的变化"""
+    with open(basePath, "r", encoding="utf-8") as f:
+        base = json.load(f)
+    with open(newPath, "r", encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"{'函数':20s} {'类别':13s} {base['meta']['revision']:>10s} {new['meta']['revision']:>10s}   变化")
+    for name, categories in new["results"].items():
+        for category, stats in categories.items():
+            old = base["results"].get(name, {}).get(category)
+            if old is None:
+                continue
+            before, after = old["p50_ms"], stats["p50_ms"]
+            change = (after - before) / before * 100 if before else 0.0
+            print(f"{name:20s} {category:13s} {before:9.2f}ms {after:9.2f}ms {change:+7.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="数学管线基准测试")
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="每个输入的重复次数")
+    parser.add_argument("--warmup", type=int, default=1, help="每个输入的预热次数")
+    parser.add_argument("-f", "--function", action="append", choices=FUNCTIONS, help="只测试指定的函数")
+    parser.add_argument("--timeout", type=float, default=None, help="单个求解任务的超时（秒）")
+    parser.add_argument("--no-fast-path", action="store_true", help="关闭按结构的快速求解")
+    parser.add_argument("-o", "--output", default=None, help="结果文件，默认为 bench-<提交>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="比较两次结果")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    report = run_benchmarks(args.repeat, args.warmup, args.function, args.timeout, not args.no_fast_path)
+    output = args.output or f"bench-{report['meta']['revision']}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,393 @@
+"""
+公式解析与求解
+
+识别出的LaTeX只解析一次：ParsedFormula 负责分词、分类，并缓存 latex2sympy 的
+结果、自由变量以及 cases 方程组的拆分。is_equation、is_binary_equation、
+is_calculation、solve_mix、safe_calculate、solve_expression 既可以接收字符串，
+也可以直接接收 ParsedFormula，同一个字符串会复用同一个解析结果。
+
+方程的求解先经过 structured_solve 的快速路径（线性方程组、一元多项式），
+其余的才交给 sympy.solve，两者都在求解引擎中执行。设置环境变量 MATHNOTE_FAST_SOLVE=0 可以关闭快速路径。
+"""
+import os
+import re
+from functools import lru_cache
+
+import sympy
+from sympy import latex
+from latex2sympy2 import latex2sympy
+
+from solver_engine import SolveResult, get_solver_engine
+import numeric
+from tracing import stage
+
+FAST_SOLVE = os.environ.get("MATHNOTE_FAST_SOLVE", "1") != "0"
+# sympy.solve 失败或超时后是否改为数值求根
+NUMERIC_SOLVE = os.environ.get("MATHNOTE_NUMERIC_SOLVE", "1") != "0"
+# 这些情况下改为数值求根（取消的任务不再继续）
+NUMERIC_FALLBACK_STATUSES = {SolveResult.ERROR, SolveResult.TIMEOUT, SolveResult.MEMORY}
+
+# 所有需要检查的方程符号及其优先级（长的符号优先检查）
+EQUATION_SYMBOLS = ['\\leq', '\\geq', '\\neq', '\\lt', '\\gt', '=', '<', '>', '≤', '≥', '≠']
+INEQUALITY_SYMBOLS = {'\\leq', '\\geq', '\\neq', '\\lt', '\\gt', '<', '>', '≤', '≥', '≠'}
+
+# 关系类型的中文名称，用于显示
+RELATION_NAMES = {'system': '方程组', 'inequality': '不等式', 'equation': '方程', 'calculation': '计算'}
+
+CASES_REGEX = r"\\begin{cases}([\s\S]*)\\end{cases}"
+CASES_LINE_REGEX = r"\\\\(?:\[?.*?\])?"
+
+_UNSET = object()
+
+
+def _strip_group(latex_str):
+    """去掉包住整行的一对花括号，例如方程组中的 {x+y=3}"""
+    text = latex_str.strip()
+    while text.startswith('{') and text.endswith('}'):
+        depth = 0
+        for index, char in enumerate(text):
+            depth += {'{': 1, '}': -1}.get(char, 0)
+            if depth == 0 and index < len(text) - 1:
+                return text
+        text = text[1:-1].strip()
+    return text
+
+
+def parse_relation(latex_str):
+    """
+    解析一个方程而不求解
+
+    latex2sympy 遇到 = 时会在当前进程中直接调用 sympy.solve，返回 [Eq(变量, 解), ...]。
+    这里把只有一个等号的方程两边分别解析后组成 Eq(左边, 右边)，求解统一交给 solve_equations；
+    其他情况（不等式、表达式等）与 latex2sympy 相同。
+    """
+    text = _strip_group(latex_str)
+    if text.count('=') == 1:
+        left, right = text.split('=')
+        if left.strip() and right.strip():
+            return sympy.Eq(latex2sympy(left), latex2sympy(right), evaluate=False)
+    return latex2sympy(text)
+
+
+class ParsedFormula:
+    """
+    一次识别结果的解析管线
+
+    所有属性都在首次访问时计算并缓存；latex2sympy 抛出的异常同样会被缓存，
+    再次访问时重新抛出，不会重复解析。
+    """
+
+    def __init__(self, latex_str):
+        self.latex = latex_str
+        # 预处理：移除空格
+        self.cleaned = latex_str.replace(' ', '')
+        self._memo = {}
+
+    def _cached(self, name, compute):
+        value = self._memo.get(name, _UNSET)
+        if value is _UNSET:
+            try:
+                value = compute()
+            except Exception as e:
+                value = e
+            self._memo[name] = value
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    @classmethod
+    def of(cls, formula):
+        """字符串转换为（共享的）ParsedFormula，ParsedFormula原样返回"""
+        if isinstance(formula, ParsedFormula):
+            return formula
+        return parse_formula(formula)
+
+    # ---- 分词与分类（纯文本） ----
+
+    @property
+    def equation_symbol(self):
+        """第一个出现的等号或不等号，没有时为None"""
+        def compute():
+            for symbol in EQUATION_SYMBOLS:
+                if symbol in self.cleaned:
+                    return symbol
+            return None
+        return self._cached('equation_symbol', compute)
+
+    @property
+    def is_equation(self):
+        """有等号或各种不等号，且后面还有数字或字母"""
+        def compute():
+            symbol = self.equation_symbol
+            if symbol is None:
+                print("不是方程")
+                return False
+            # 检查符号后面是否有内容
+            after_symbol = self.cleaned.split(symbol, 1)[1].strip()
+            if not after_symbol:
+                print("不是方程")
+                return False
+            # 检查是否包含至少一个数字或字母
+            return bool(re.search(r'[a-zA-Z0-9]', after_symbol))
+        return self._cached('is_equation', compute)
+
+    @property
+    def is_calculation(self):
+        """没有等号或不等号，或者等号后面没有内容"""
+        def compute():
+            cleaned = self.cleaned
+            if '=' not in cleaned and '\\neq' not in cleaned:
+                return True
+            # 分割表达式（考虑等号和不等号）
+            if '=' in cleaned:
+                parts = cleaned.split('=', 1)
+            else:
+                parts = cleaned.split('\\neq', 1)
+            after_equal = parts[1].strip()
+            if not after_equal:
+                return True
+            return not bool(re.search(r'[a-zA-Z0-9]', after_equal))
+        return self._cached('is_calculation', compute)
+
+    @property
+    def cases(self):
+        """\\begin{cases} 方程组拆分后的各行，不是方程组时为None"""
+        def compute():
+            matches = re.findall(CASES_REGEX, self.latex, re.MULTILINE)
+            if not matches:
+                return None
+            lines = re.split(CASES_LINE_REGEX, matches[0])
+            return [line for line in lines if line.strip()]
+        return self._cached('cases', compute)
+
+    @property
+    def relation(self):
+        """关系类型：'system'、'inequality'、'equation' 或 'calculation'"""
+        def compute():
+            if self.cases is not None:
+                return 'system'
+            if self.is_equation:
+                if self.equation_symbol in INEQUALITY_SYMBOLS:
+                    return 'inequality'
+                return 'equation'
+            return 'calculation'
+        return self._cached('relation', compute)
+
+    # ---- sympy 解析结果 ----
+
+    @property
+    def expr(self):
+        """整个公式的 latex2sympy 结果"""
+        return self._cached('expr', lambda: latex2sympy(self.latex))
+
+    @property
+    def equation(self):
+        """未求解的方程 Eq(左边, 右边)；不等式和算式与 expr 相同"""
+        return self._cached('equation', lambda: parse_relation(self.latex))
+
+    @property
+    def free_symbols(self):
+        return self._cached('free_symbols', lambda: self.equation.free_symbols)
+
+    @property
+    def case_equations(self):
+        """方程组中每一行解析后（未求解）的方程列表"""
+        def compute():
+            equations = []
+            for line in self.cases or []:
+                ins = parse_relation(line)
+                if type(ins) == list:
+                    equations.extend(ins)
+                else:
+                    equations.append(ins)
+            return equations
+        return self._cached('case_equations', compute)
+
+    @property
+    def calculation_expr(self):
+        """等号之前部分的 latex2sympy 结果，没有等号时与 expr 相同"""
+        def compute():
+            if '=' not in self.latex:
+                return self.expr
+            return latex2sympy(self.latex.split('=')[0].strip())
+        return self._cached('calculation_expr', compute)
+
+    @property
+    def compiled(self):
+        """calculation_expr 编译后的NumPy向量化函数"""
+        return self._cached('compiled', lambda: numeric.compile_expression(self.calculation_expr))
+
+
+@lru_cache(maxsize=64)
+def parse_formula(latex_str):
+    """同一个LaTeX字符串共享同一个 ParsedFormula"""
+    return ParsedFormula(latex_str)
+
+
+def solve_mix(latex_text, formatter='sympy'):
+    with stage("solve_mix"):
+        formula = ParsedFormula.of(latex_text)
+        if formula.cases is None:
+            return False
+        with stage("latex2sympy"):
+            equations = formula.case_equations
+        solved = solve_equations(equations).unwrap()
+        if formatter == 'latex':
+            return latex(solved)
+        else:
+            return solved
+
+
+def solve_equations(target, timeout=None, cancelEvent=None):
+    """
+    求解方程或方程组，返回 SolveResult
+
+    所有求解都在求解引擎中执行，受超时、内存上限和取消的约束：线性方程组和一元多项式
+    先按结构直接求解，其余的执行 sympy.solve；sympy.solve 出错（例如 sin(x)=x/3 这样
+    没有解析解的方程）或超时时，在默认区间内做多初始点的数值求根，
+    找不到可用的数值解时返回原来的结果。
+    """
+    engine = get_solver_engine()
+    result = None
+    if FAST_SOLVE:
+        with stage("fast_solve"):
+            fast = engine.structured(target, timeout=timeout, cancelEvent=cancelEvent)
+        if fast.status == SolveResult.CANCELLED or (fast.ok and fast.solutions is not None):
+            return fast
+        if fast.status in (SolveResult.TIMEOUT, SolveResult.MEMORY):
+            # 按结构求解已经超时的方程（例如次数很高的多项式），sympy.solve 同样会超时
+            result = fast
+    if result is None:
+        with stage("solve"):
+            result = engine.solve(target, timeout=timeout, cancelEvent=cancelEvent)
+    if not NUMERIC_SOLVE or result.status not in NUMERIC_FALLBACK_STATUSES:
+        return result
+    with stage("numeric_solve"):
+        numericResult = engine.nsolve(target, timeout=timeout, cancelEvent=cancelEvent)
+    if numericResult.ok and numericResult.solutions is not None:
+        return numericResult
+    return result
+
+
+def is_equation(latex_str):
+    """
+    判断LaTeX表达式是否为方程（包括等式方程和不等式方程）
+
+    规则：
+    - 有等号或各种不等号，且后面还有数字或字母
+    - 返回True表示是方程，False表示不是方程
+
+    支持的符号：
+    - 等式: =
+    - 不等式: ≠, <, >, ≤, ≥, \\neq, \\lt, \\gt, \\leq, \\geq
+    """
+    return ParsedFormula.of(latex_str).is_equation
+
+
+def is_binary_equation(latex_str):
+    """
+    判断LaTeX表达式是否为二元方程或二元不等方程
+
+    返回：
+    - True表示是二元方程或二元不等方程
+    - False表示不是
+    """
+    try:
+        formula = ParsedFormula.of(latex_str)
+
+        # 检查是否为方程
+        if not formula.is_equation:
+            return False
+
+        # 检查是否有且仅有2个不同的变量
+        return len(formula.free_symbols) == 2
+    except Exception as e:
+        print(f"判断二元方程时出错: {str(e)}")
+        return False
+
+
+def is_calculation(latex_str):
+    """
+    判断LaTeX表达式是否为计算式
+
+    规则：
+    - 没有等号或不等号
+    - 有等号但等号后面没有内容
+    - 返回True表示是计算式，False表示不是计算式
+    """
+    return ParsedFormula.of(latex_str).is_calculation
+
+
+def safe_calculate(expr_str, values=None, exact=True):
+    """
+    计算表达式的值
+
+    - 默认用 evalf 精确计算
+    - exact=False 或提供 values（{变量: 标量/数组/range}）时，使用编译后的
+      NumPy向量化函数一次算出所有取值
+    """
+    with stage("safe_calculate"):
+        formula = ParsedFormula.of(expr_str)
+
+        # 检查表达式是否为空（去除等号和末尾可能的空白字符）
+        if not formula.cleaned.split('=')[0].strip():
+            return "错误: 表达式为空"
+
+        try:
+            # 尝试计算表达式
+            with stage("latex2sympy"):
+                expr = formula.calculation_expr
+            with stage("evaluate"):
+                if values is not None or not exact:
+                    if exact:
+                        return numeric.evaluate(expr, values, exact=True)
+                    return formula.compiled.evaluate(values)
+                return get_solver_engine().evaluate(expr).unwrap()
+        except Exception as e:
+            return f"错误: {str(e)}"
+
+
+def solve_expression(expr_str):
+    formula = ParsedFormula.of(expr_str)
+    try:
+        # 尝试解析为 LaTeX
+        expr = formula.equation
+    except:
+        try:
+            # 如果不是 LaTeX，尝试解析为普通表达式
+            expr = sympy.sympify(formula.latex)
+        except Exception as e:
+            return f"解析错误: {str(e)}"
+    try:
+        return solve_equations(expr).unwrap()
+    except Exception as e:
+        return f"解析错误: {str(e)}"
+
+
+def calculate_formula(result, timeout=None, cancelEvent=None):
+    """
+    根据识别出的LaTeX公式的类型进行求解或计算
+
+    求解在沙箱求解引擎中执行，返回 SolveResult；cancelEvent 被设置时会终止正在进行的求解。
+    """
+    formula = ParsedFormula.of(result)
+    engine = get_solver_engine()
+    try:
+        with stage("classify"):
+            equation = formula.is_equation
+            relation = formula.relation
+        if equation:
+            # 方程组按 cases 拆分后联立求解
+            with stage("latex2sympy"):
+                target = formula.case_equations if relation == 'system' else formula.equation
+            return solve_equations(target, timeout=timeout, cancelEvent=cancelEvent)
+
+        # 检查表达式是否为空（去除等号和末尾可能的空白字符）
+        if not formula.cleaned.split('=')[0].strip():
+            return SolveResult.failure("表达式为空")
+        with stage("latex2sympy"):
+            expr = formula.calculation_expr
+        with stage("evaluate"):
+            return engine.evaluate(expr, timeout=timeout, cancelEvent=cancelEvent)
+    except Exception as e:
+        return SolveResult.failure(str(e))
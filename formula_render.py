@@ -0,0 +1,151 @@
+"""
+LaTeX 公式渲染
+
+用 matplotlib 的 mathtext 直接把 LaTeX 光栅化为 QPixmap，不创建 Figure 和画布。
+渲染结果按 (latex, 字号, DPI) 做LRU缓存，同一个公式再次显示几乎没有开销。
+mathtext 不支持 \\begin{cases}，方程组会逐行渲染后上下拼接并在左侧画出大括号。
+
+QPixmap 只能在界面线程中创建，FormulaRenderer.render 也只应在界面线程中调用。
+"""
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PyQt5.QtCore import QPointF, Qt
+from PyQt5.QtGui import QColor, QImage, QPainter, QPainterPath, QPen, QPixmap
+
+from image_bridge import qimage_array
+
+DEFAULT_FONT_SIZE = 20
+DEFAULT_DPI = 100
+DEFAULT_CACHE_ENTRIES = 64
+
+CASES_REGEX = r"\\begin{cases}([\s\S]*)\\end{cases}"
+CASES_LINE_REGEX = r"\\\\(?:\[?.*?\])?"
+# 方程组各行之间的间距和大括号所占的宽度（像素）
+LINE_SPACING = 6
+BRACE_WIDTH = 14
+
+_parser = None
+_parserLock = threading.Lock()
+
+
+def _get_parser():
+    global _parser
+    with _parserLock:
+        if _parser is None:
+            from matplotlib.mathtext import MathTextParser
+            _parser = MathTextParser("agg")
+        return _parser
+
+
+def _rasterize(latex, fontSize, dpi, color):
+    """渲染一行公式，返回 ARGB32 的 QImage；mathtext 无法解析时抛出 ValueError"""
+    from matplotlib.font_manager import FontProperties
+
+    parser = _get_parser()
+    with _parserLock:
+        parsed = parser.parse(f"${latex}$", dpi=dpi, prop=FontProperties(size=fontSize))
+    # 灰度的覆盖率作为透明度，颜色统一为 color
+    coverage = np.asarray(parsed.image)
+    height, width = coverage.shape
+    image = QImage(width, height, QImage.Format_ARGB32)
+    pixels = qimage_array(image)
+    pixels[...] = (coverage.astype(np.uint32) << 24) | (QColor(color).rgb() & 0xFFFFFF)
+    return image
+
+
+def _stack(images, brace, color):
+    """把多行图像左对齐上下拼接，brace 为True时在左侧画大括号"""
+    offset = BRACE_WIDTH if brace else 0
+    width = offset + max(image.width() for image in images)
+    height = sum(image.height() for image in images) + LINE_SPACING * (len(images) - 1)
+    result = QImage(width, height, QImage.Format_ARGB32)
+    result.fill(Qt.transparent)
+    painter = QPainter(result)
+    painter.setRenderHint(QPainter.Antialiasing)
+    y = 0
+    for image in images:
+        painter.drawImage(offset, y, image)
+        y += image.height() + LINE_SPACING
+    if brace:
+        # 由两段贝塞尔曲线组成的左大括号
+        right, left, middle = BRACE_WIDTH - 3, 3, height / 2
+        path = QPainterPath(QPointF(right, 1))
+        path.cubicTo(QPointF(left + 2, 1), QPointF(right - 2, middle), QPointF(left, middle))
+        path.cubicTo(QPointF(right - 2, middle), QPointF(left + 2, height - 1), QPointF(right, height - 1))
+        painter.setPen(QPen(QColor(color), 1.5))
+        painter.drawPath(path)
+    painter.end()
+    return result
+
+
+class FormulaRenderer:
+    """
+    带LRU缓存的公式渲染器
+
+    - render(latex, fontSize, dpi): 返回 QPixmap，无法渲染时返回None
+    - maxEntries: 缓存的最大条目数
+    """
+
+    def __init__(self, maxEntries=DEFAULT_CACHE_ENTRIES, color="black"):
+        self.maxEntries = maxEntries
+        self.color = color
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, latex, fontSize=DEFAULT_FONT_SIZE, dpi=DEFAULT_DPI):
+        key = (latex, fontSize, dpi)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return self._cache[key]
+        self.misses += 1
+        pixmap = self._render(latex, fontSize, dpi)
+        self._cache[key] = pixmap
+        while len(self._cache) > self.maxEntries:
+            self._cache.popitem(last=False)
+        return pixmap
+
+    def _render(self, latex, fontSize, dpi):
+        latex = latex.strip()
+        if not latex:
+            return None
+        match = re.search(CASES_REGEX, latex)
+        try:
+            if match:
+                # mathtext 不支持对齐符号 &，直接去掉
+                lines = [line.replace("&", " ").strip() for line in re.split(CASES_LINE_REGEX, match.group(1))]
+                images = [_rasterize(line, fontSize, dpi, self.color) for line in lines if line]
+                if not images:
+                    return None
+                image = _stack(images, True, self.color)
+            else:
+                image = _rasterize(latex, fontSize, dpi, self.color)
+        except ValueError as e:
+            # mathtext 的错误信息最后一行是具体原因
+            message = str(e).strip().splitlines()
+            print(f"无法渲染公式 {latex}: {message[-1] if message else ''}")
+            return None
+        return QPixmap.fromImage(image)
+
+    def clear(self):
+        self._cache.clear()
+
+
+_renderer = None
+
+
+def get_formula_renderer():
+    """获取界面线程共享的公式渲染器"""
+    global _renderer
+    if _renderer is None:
+        _renderer = FormulaRenderer()
+    return _renderer
+
+
+def warm_up():
+    """预先导入 mathtext 并构建解析器（可以在后台线程中调用）"""
+    _get_parser()
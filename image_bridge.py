@@ -0,0 +1,182 @@
+"""
+QImage 与 NumPy / PIL 之间的桥接
+
+直接把 QImage 的像素内存暴露为 NumPy 数组，不做拷贝，并正确处理每行的字节跨度
+和通道顺序（RGB32 在内存中按 0xAARRGGBB 整数存放，小端机器上的字节顺序是 B, G, R, A）。
+
+在此之上提供识别前的预处理：灰度化、二值化、裁剪到笔迹包围盒（或按 segmentation
+分割出的每个公式）、加边距、缩小到模型偏好的高度。全部是向量化的NumPy运算，识别模型收到的是更小、更干净的图像。
+"""
+import sys
+
+import numpy as np
+from PyQt5.QtGui import QImage
+
+# 识别模型偏好的输入高度（像素），更高的图像会按比例缩小，较小的不会放大
+MODEL_INPUT_HEIGHT = 128
+# 裁剪到笔迹后四周保留的空白（像素）
+OCR_PADDING = 8
+
+
+def qimage_array(image):
+    """
+    返回 RGB32 图像像素的 (高, 宽) uint32 视图
+
+    数组与 image 共享内存：修改数组会直接修改图像。调用 bits() 会让隐式共享的
+    QImage 先分离出独立的副本，因此不会影响其他共享同一数据的图像。
+    调用方需要在使用数组期间保持 image 的引用。
+    """
+    if image.format() not in (QImage.Format_RGB32, QImage.Format_ARGB32):
+        raise ValueError("只支持 RGB32/ARGB32 格式的图像")
+    height = image.height()
+    bytesPerLine = image.bytesPerLine()
+    ptr = image.bits()
+    ptr.setsize(height * bytesPerLine)
+    rows = np.frombuffer(ptr, np.uint32).reshape(height, bytesPerLine // 4)
+    return rows[:, :image.width()]
+
+
+def qimage_rgb(image):
+    """
+    返回 RGB32 图像的 (高, 宽, 3) uint8 视图，通道顺序为 R, G, B
+
+    与 qimage_array 一样不拷贝，数组是跨步视图（不连续）。
+    """
+    channels = qimage_array(image).view(np.uint8).reshape(image.height(), image.width(), 4)
+    if sys.byteorder == "little":
+        # 内存中为 B, G, R, A
+        return channels[..., 2::-1]
+    # 大端机器上为 A, R, G, B
+    return channels[..., 1:]
+
+
+def qimage_to_pil(image):
+    """把 QImage 转换为 RGB 模式的PIL图像（拷贝，之后与 image 无关）"""
+    from PIL import Image
+    if image.format() not in (QImage.Format_RGB32, QImage.Format_ARGB32):
+        image = image.convertToFormat(QImage.Format_RGB32)
+    return Image.fromarray(np.ascontiguousarray(qimage_rgb(image)), "RGB")
+
+
+def grayscale(pixels):
+    """
+    转换为 uint8 灰度图
+
+    pixels 可以是 qimage_array 返回的 uint32 数组、(高, 宽, 3/4) 的RGB(A)数组或灰度数组。
+    """
+    pixels = np.asarray(pixels)
+    if pixels.dtype == np.uint32:
+        r = (pixels >> 16) & 0xFF
+        g = (pixels >> 8) & 0xFF
+        b = pixels & 0xFF
+    elif pixels.ndim == 3:
+        r, g, b = (pixels[..., i].astype(np.uint32) for i in range(3))
+    else:
+        return pixels.astype(np.uint8, copy=False)
+    # ITU-R BT.601 权重的整数近似
+    return ((r * 77 + g * 150 + b * 29) >> 8).astype(np.uint8)
+
+
+def otsu_threshold(gray):
+    """用大津法计算二值化阈值，灰度值低于阈值的像素视为笔迹"""
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    total = histogram.sum()
+    if total == 0:
+        return 128
+    levels = np.arange(256)
+    weightBelow = np.cumsum(histogram)
+    sumBelow = np.cumsum(histogram * levels)
+    weightAbove = total - weightBelow
+    with np.errstate(divide="ignore", invalid="ignore"):
+        meanBelow = sumBelow / weightBelow
+        meanAbove = (sumBelow[-1] - sumBelow) / weightAbove
+        variance = weightBelow * weightAbove * (meanBelow - meanAbove) ** 2
+    variance = np.nan_to_num(variance)
+    # 阈值 t 表示 <= t 的灰度归为笔迹
+    return int(np.argmax(variance)) + 1
+
+
+def binarize(gray, threshold=None):
+    """返回笔迹掩码（True 为笔迹），threshold 为None时使用大津法"""
+    if threshold is None:
+        threshold = otsu_threshold(gray)
+    return gray < threshold
+
+
+def ink_bbox(mask):
+    """笔迹掩码的包围盒 (top, bottom, left, right)，bottom/right 不含；没有笔迹时返回None"""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if not rows.size:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+
+def _ink_mask(pixels, threshold):
+    """灰度化并二值化；纯色（例如全白）的图像返回None"""
+    gray = grayscale(pixels)
+    if gray.size == 0 or gray.min() == gray.max():
+        return None
+    return binarize(gray, threshold)
+
+
+def _clean_image(ink, targetHeight, padding):
+    """把裁剪好的笔迹掩码画成加了边距的白底黑字图像，并缩小到 targetHeight"""
+    from PIL import Image
+
+    height, width = ink.shape
+    clean = np.full((height + 2 * padding, width + 2 * padding), 255, np.uint8)
+    clean[padding:padding + height, padding:padding + width][ink] = 0
+
+    result = Image.fromarray(clean, "L")
+    if targetHeight and result.height > targetHeight:
+        scale = targetHeight / result.height
+        result = result.resize((max(1, round(result.width * scale)), targetHeight), Image.LANCZOS)
+    return result.convert("RGB")
+
+
+def preprocess_for_ocr(pixels, targetHeight=MODEL_INPUT_HEIGHT, padding=OCR_PADDING, threshold=None):
+    """
+    把选区整理成适合识别模型的图像
+
+    灰度化 -> 二值化（白底黑字）-> 裁剪到笔迹 -> 加边距 -> 缩小到 targetHeight。
+    pixels 同 grayscale 的参数。返回RGB模式的PIL图像；选区内没有笔迹时返回None。
+    """
+    ink = _ink_mask(pixels, threshold)
+    bbox = None if ink is None else ink_bbox(ink)
+    if bbox is None:
+        return None
+    top, bottom, left, right = bbox
+    return _clean_image(ink[top:bottom, left:right], targetHeight, padding)
+
+
+def preprocess_segments(pixels, targetHeight=MODEL_INPUT_HEIGHT, padding=OCR_PADDING, threshold=None):
+    """
+    把选区分割成多个公式并分别预处理
+
+    返回 [(包围盒, PIL图像), ...]，包围盒为选区内的 (top, bottom, left, right)，
+    按阅读顺序排列；选区内没有笔迹时返回空列表。
+    """
+    from segmentation import segment_ink
+
+    ink = _ink_mask(pixels, threshold)
+    if ink is None:
+        return []
+    return [
+        ((top, bottom, left, right), _clean_image(ink[top:bottom, left:right], targetHeight, padding))
+        for top, bottom, left, right in segment_ink(ink)
+    ]
+
+
+def preprocess_qimage(image, **kwargs):
+    """对 QImage 执行 preprocess_for_ocr，像素通过零拷贝视图读取"""
+    if image.format() not in (QImage.Format_RGB32, QImage.Format_ARGB32):
+        image = image.convertToFormat(QImage.Format_RGB32)
+    return preprocess_for_ocr(qimage_array(image), **kwargs)
+
+
+def segment_qimage(image, **kwargs):
+    """对 QImage 执行 preprocess_segments，像素通过零拷贝视图读取"""
+    if image.format() not in (QImage.Format_RGB32, QImage.Format_ARGB32):
+        image = image.convertToFormat(QImage.Format_RGB32)
+    return preprocess_segments(qimage_array(image), **kwargs)
@@ -0,0 +1,350 @@
+"""
+二元方程和不等式的隐函数绘图
+
+关系 f(u, v) ? 0（f = 左边 - 右边）只用 lambdify 编译一次，之后在 NumPy 网格上向量化求值：
+
+- 先在每 CELL 个像素一个点的粗网格上求值，只有四个角符号不同的单元才在像素网格上细化，
+  用相邻像素之间的符号变化描出曲线，不等式成立的区域整块填充
+- 粗网格按世界坐标对齐、分块缓存（每个缩放级别一套图块），平移时只计算新露出的图块；
+  相邻缩放级别的采样点互相重合（比例相差2倍），缩放时从已有的图块中取出重合的采样点，
+  只计算新增的点
+"""
+import math
+from collections import OrderedDict
+
+import numpy as np
+import sympy
+from PyQt5.QtCore import QPoint, Qt
+from PyQt5.QtGui import QColor, QFont, QImage, QPainter, QPen
+from PyQt5.QtWidgets import QWidget
+
+import numeric
+from image_bridge import qimage_array
+from tracing import stage
+
+# 第0级缩放时每个单位的像素数，级别每增加1放大2倍
+BASE_SCALE = 32.0
+MIN_LEVEL = -10
+MAX_LEVEL = 16
+# 粗网格的采样间距（像素）和每个图块的粗网格单元数
+CELL = 4
+TILE_CELLS = 64
+TILE_PIXELS = CELL * TILE_CELLS
+# 缓存的最大图块数
+MAX_CACHED_TILES = 256
+
+CURVE_COLOR = 0xFF1F4E99
+REGION_COLOR = 0x403C78D8
+
+RELATION_KINDS = {
+    sympy.Equality: "eq",
+    sympy.Unequality: "ne",
+    sympy.StrictLessThan: "lt",
+    sympy.LessThan: "le",
+    sympy.StrictGreaterThan: "gt",
+    sympy.GreaterThan: "ge",
+}
+
+
+class ImplicitRelation:
+    """
+    一个二元关系 f(u, v) ? 0
+
+    - variables: (横轴变量, 纵轴变量)，有 x 和 y 时分别对应横轴和纵轴
+    - kind: 'eq'、'ne'、'lt'、'le'、'gt'、'ge'
+    - evaluate(u, v): 向量化地计算 f，无定义的点为 NaN
+    - region(values): 不等式成立的掩码，方程返回None
+    """
+
+    def __init__(self, expr, variables, kind):
+        self.expr = expr
+        self.variables = tuple(variables)
+        self.kind = kind
+        self.compiled = numeric.compile_expression(expr, self.variables)
+
+    @classmethod
+    def from_formula(cls, formula):
+        """由公式（字符串或 ParsedFormula）构建，不是二元方程或不等式时返回None"""
+        from formula import ParsedFormula
+        try:
+            relation = ParsedFormula.of(formula).equation
+        except Exception:
+            return None
+        kind = RELATION_KINDS.get(type(relation))
+        if kind is None:
+            return None
+        # 连写的不等式（例如 1<x+y<2）的一边本身是关系式，无法相减
+        if not (isinstance(relation.lhs, sympy.Expr) and isinstance(relation.rhs, sympy.Expr)):
+            return None
+        expr = relation.lhs - relation.rhs
+        symbols = sorted(expr.free_symbols, key=lambda s: s.name)
+        if len(symbols) != 2:
+            return None
+        names = [s.name for s in symbols]
+        if names == ["x", "y"] or "y" not in names:
+            variables = symbols
+        else:
+            # 名为 y 的变量放在纵轴
+            variables = [symbols[1 - names.index("y")], symbols[names.index("y")]]
+        try:
+            return cls(expr, variables, kind)
+        except Exception as e:
+            print(f"无法编译公式 {formula}: {str(e)}")
+            return None
+
+    def evaluate(self, u, v):
+        return self.compiled.real(u, v)
+
+    def region(self, values):
+        if self.kind == "lt":
+            return values < 0
+        if self.kind == "le":
+            return values <= 0
+        if self.kind == "gt":
+            return values > 0
+        if self.kind == "ge":
+            return values >= 0
+        return None
+
+
+def _scale(level):
+    """level 级别下每个单位的像素数"""
+    return BASE_SCALE * 2.0 ** level
+
+
+class PlotTiles:
+    """
+    按缩放级别和世界坐标对齐的图块缓存
+
+    图块 (level, col, row) 的粗网格包含下标 [col*T, col*T+T] × [row*T, row*T+T] 的采样点
+    （T = TILE_CELLS，相邻图块共享边上的点）。下标为 (kc, kr) 的点的世界坐标为
+    (kc, -kr) * CELL / scale，因此 level 级的点 k 与 level+1 级的点 2k 重合。
+    """
+
+    def __init__(self, relation, maxTiles=MAX_CACHED_TILES):
+        self.relation = relation
+        self.maxTiles = maxTiles
+        self._samples = OrderedDict()
+        self._images = OrderedDict()
+        # 实际求值的点数（粗网格和细化的像素点），用于观察缓存的效果
+        self.evaluated = 0
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > self.maxTiles:
+            cache.popitem(last=False)
+
+    def _evaluate(self, level, columns, rows, pixelStep):
+        """在像素坐标 (columns, rows)（以 pixelStep 为单位）处求值"""
+        unit = pixelStep / _scale(level)
+        self.evaluated += np.size(columns)
+        return self.relation.evaluate(columns * unit, -rows * unit)
+
+    def samples(self, level, col, row):
+        """图块的粗网格采样，形状为 (T+1, T+1)，行对应纵向"""
+        key = (level, col, row)
+        values = self._samples.get(key)
+        if values is not None:
+            self._samples.move_to_end(key)
+            return values
+        size = TILE_CELLS + 1
+        half = TILE_CELLS // 2
+        values = np.full((size, size), np.nan)
+        known = np.zeros((size, size), bool)
+
+        # 上一级（更粗）的图块：本级下标为偶数的点与之重合
+        parent = self._samples.get((level - 1, col // 2, row // 2))
+        if parent is not None:
+            top, left = (row % 2) * half, (col % 2) * half
+            values[::2, ::2] = parent[top:top + half + 1, left:left + half + 1]
+            known[::2, ::2] = True
+        # 下一级（更细）的图块：其中下标为偶数的点落在本图块中
+        for dr in (0, 1):
+            for dc in (0, 1):
+                child = self._samples.get((level + 1, 2 * col + dc, 2 * row + dr))
+                if child is not None:
+                    values[dr * half:dr * half + half + 1, dc * half:dc * half + half + 1] = child[::2, ::2]
+                    known[dr * half:dr * half + half + 1, dc * half:dc * half + half + 1] = True
+
+        missing = ~known
+        if missing.any():
+            rows, columns = np.nonzero(missing)
+            values[missing] = self._evaluate(level, columns + col * TILE_CELLS, rows + row * TILE_CELLS, CELL)
+        self._remember(self._samples, key, values)
+        return values
+
+    def image(self, level, col, row):
+        """图块的渲染结果（TILE_PIXELS 见方的 ARGB32 图像）"""
+        key = (level, col, row)
+        image = self._images.get(key)
+        if image is not None:
+            self._images.move_to_end(key)
+            return image
+        with stage("plot_tile"):
+            image = self._render(level, col, row)
+        self._remember(self._images, key, image)
+        return image
+
+    def _crossings(self, level, fine, columns, rows, step):
+        """
+        细化网格中每个点与 step=(行偏移, 列偏移) 方向的相邻点之间是否穿过曲线
+
+        符号不同的两个点之间可能是零点，也可能是极点（例如 tan 的渐近线）。在中点再求一次值：
+        中点与同号的一端相比更靠近零点时 |f| 变小，更靠近极点时 |f| 变大，后者不算曲线。
+        """
+        dr, dc = step
+        size = fine.shape[1] - 1
+        first = fine[:, :-1, :-1]
+        second = fine[:, dr:dr + size, dc:dc + size]
+        crossing = ((first > 0) != (second > 0)) & np.isfinite(first) & np.isfinite(second)
+        if crossing.any():
+            middle = self._evaluate(level, columns[:, :-1, :-1][crossing] + dc / 2,
+                                    rows[:, :-1, :-1][crossing] + dr / 2, 1)
+            a, b = first[crossing], second[crossing]
+            near = np.where((middle > 0) == (a > 0), a, b)
+            # 中点无定义（NaN）时同样不算曲线
+            crossing[crossing] = np.abs(middle) <= np.abs(near)
+        return crossing
+
+    def _render(self, level, col, row):
+        values = self.samples(level, col, row)
+        relation = self.relation
+        # 单元的四个角
+        corners = np.stack([values[:-1, :-1], values[:-1, 1:], values[1:, :-1], values[1:, 1:]])
+        finite = np.isfinite(corners).all(axis=0)
+        positive = corners > 0
+        mixed = finite & positive.any(axis=0) & ~positive.all(axis=0)
+
+        # 按 (单元行, 单元内的行, 单元列, 单元内的列) 排列的像素
+        pixels = np.zeros((TILE_CELLS, CELL, TILE_CELLS, CELL), np.uint32)
+        region = relation.region(corners)
+        if region is not None:
+            # 四个角都成立的单元整块填充
+            inside = finite & region.all(axis=0)
+            pixels[...] = np.where(inside[:, None, :, None], np.uint32(REGION_COLOR), np.uint32(0))
+
+        cellRows, cellColumns = np.nonzero(mixed)
+        if cellRows.size:
+            # 只在符号变化的单元中按像素细化：每个单元 (CELL+1) × (CELL+1) 个点
+            offsets = np.arange(CELL + 1)
+            pixelRows = (row * TILE_CELLS + cellRows)[:, None, None] * CELL + offsets[None, :, None]
+            pixelColumns = (col * TILE_CELLS + cellColumns)[:, None, None] * CELL + offsets[None, None, :]
+            pixelRows, pixelColumns = np.broadcast_arrays(pixelRows, pixelColumns)
+            fine = self._evaluate(level, pixelColumns, pixelRows, 1)
+            valid = np.isfinite(fine)
+            # 与右侧或下方相邻的点之间穿过曲线的像素在曲线上
+            edge = self._crossings(level, fine, pixelColumns, pixelRows, (0, 1)) | \
+                   self._crossings(level, fine, pixelColumns, pixelRows, (1, 0))
+            cells = pixels[cellRows, :, cellColumns, :]
+            if region is not None:
+                cells[relation.region(fine[:, :-1, :-1]) & valid[:, :-1, :-1]] = REGION_COLOR
+            cells[edge] = CURVE_COLOR
+            pixels[cellRows, :, cellColumns, :] = cells
+
+        image = QImage(TILE_PIXELS, TILE_PIXELS, QImage.Format_ARGB32)
+        qimage_array(image)[...] = pixels.reshape(TILE_PIXELS, TILE_PIXELS)
+        return image
+
+
+def _tick_step(scale):
+    """坐标轴刻度的间距：1、2、5 乘以10的幂，刻度之间至少 60 像素"""
+    step = 10.0 ** math.floor(math.log10(60.0 / scale))
+    for factor in (1, 2, 5, 10):
+        if step * factor * scale >= 60:
+            return step * factor
+    return step * 10
+
+
+class ImplicitPlotView(QWidget):
+    """
+    二元关系的绘图窗口
+
+    拖动平移（复用已显示的像素，只绘制新露出的区域），滚轮以光标为中心缩放。
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent, Qt.Tool)
+        self.setWindowTitle("函数图像")
+        self.resize(520, 520)
+        self.tiles = None
+        self.level = 0
+        # 窗口左上角在当前级别像素坐标中的位置
+        self.origin = QPoint(-260, -260)
+        self.dragPos = None
+        self.labelFont = QFont()
+        self.labelFont.setPointSize(8)
+
+    def setRelation(self, relation, title=""):
+        self.tiles = PlotTiles(relation)
+        self.level = 0
+        self.origin = QPoint(-self.width() // 2, -self.height() // 2)
+        u, v = (symbol.name for symbol in relation.variables)
+        self.setWindowTitle(f"函数图像: {title}（横轴 {u}，纵轴 {v}）" if title else "函数图像")
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setClipRect(event.rect())
+        painter.fillRect(event.rect(), Qt.white)
+        if self.tiles is None:
+            return
+        # 像素坐标中需要绘制的区域
+        dirty = event.rect().translated(self.origin)
+        firstCol, lastCol = dirty.left() // TILE_PIXELS, dirty.right() // TILE_PIXELS
+        firstRow, lastRow = dirty.top() // TILE_PIXELS, dirty.bottom() // TILE_PIXELS
+        for row in range(firstRow, lastRow + 1):
+            for col in range(firstCol, lastCol + 1):
+                position = QPoint(col * TILE_PIXELS, row * TILE_PIXELS) - self.origin
+                painter.drawImage(position, self.tiles.image(self.level, col, row))
+        self.drawAxes(painter, dirty)
+
+    def drawAxes(self, painter, dirty):
+        scale = _scale(self.level)
+        step = _tick_step(scale)
+        painter.setPen(QPen(QColor(90, 90, 90), 1))
+        painter.setFont(self.labelFont)
+        x0, y0 = -self.origin.x(), -self.origin.y()
+        painter.drawLine(0, y0, self.width(), y0)
+        painter.drawLine(x0, 0, x0, self.height())
+        first = math.floor(dirty.left() / scale / step)
+        last = math.ceil(dirty.right() / scale / step)
+        for k in range(first, last + 1):
+            if k:
+                x = round(k * step * scale) + x0
+                painter.drawLine(x, y0 - 3, x, y0 + 3)
+                painter.drawText(x + 2, y0 + 12, f"{k * step:g}")
+        first = math.floor(dirty.top() / scale / step)
+        last = math.ceil(dirty.bottom() / scale / step)
+        for k in range(first, last + 1):
+            if k:
+                y = round(k * step * scale) + y0
+                painter.drawLine(x0 - 3, y, x0 + 3, y)
+                painter.drawText(x0 + 5, y - 2, f"{-k * step:g}")
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.dragPos = event.pos()
+
+    def mouseMoveEvent(self, event):
+        if self.dragPos is None:
+            return
+        delta = event.pos() - self.dragPos
+        self.dragPos = event.pos()
+        self.origin -= delta
+        # 复用已经显示的内容（包括坐标轴），只绘制新露出的区域
+        self.scroll(delta.x(), delta.y())
+
+    def mouseReleaseEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.dragPos = None
+
+    def wheelEvent(self, event):
+        steps = event.angleDelta().y() // 120
+        level = max(MIN_LEVEL, min(MAX_LEVEL, self.level + steps))
+        if level == self.level:
+            return
+        # 以光标为中心缩放：光标下的点在新级别中的像素坐标乘以 2^(级别差)
+        cursor = event.pos()
+        self.origin = (self.origin + cursor) * (2.0 ** (level - self.level)) - cursor
+        self.level = level
+        self.update()
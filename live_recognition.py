@@ -0,0 +1,142 @@
+"""
+边写边识别（实时识别）
+
+画布把每次修改的区域交给 LiveRegionTracker。停笔一段时间后（防抖），以修改过的区域
+为中心向外扩展，直到区域四条边上都没有笔迹，得到当前正在书写的公式区域。
+识别任务只对与修改区域相交的公式重新识别和求解，其余公式直接沿用上一次的结果。
+
+识别出的公式（包围盒和结果）同时是文档的一部分：右键识别同样沿用和更新这些结果，
+保存文档时一并写入，重新打开后不需要再识别和求解。笔迹被修改的公式会立即丢弃。
+
+- 设置环境变量 MATHNOTE_LIVE_IDLE_MS 可以修改停笔后等待的毫秒数
+"""
+import os
+
+import numpy as np
+from PyQt5.QtCore import QRect
+
+from tiles import WHITE
+
+# 停笔后等待多久开始识别（毫秒）
+LIVE_IDLE_MS = int(os.environ.get("MATHNOTE_LIVE_IDLE_MS", 800))
+# 修改区域向四周预留的边距（像素）
+REGION_MARGIN = 48
+# 区域边缘有笔迹时每次向外扩展的距离（像素）
+GROW_STEP = 64
+# 公式区域的最大宽度和高度（像素）
+MAX_REGION_SIZE = 2048
+
+
+def _has_ink(surface, rect):
+    """rect 内是否有非白色的像素"""
+    if rect.isEmpty():
+        return False
+    return bool(np.any((surface.read_pixels(rect) & 0xFFFFFF) != (WHITE & 0xFFFFFF)))
+
+
+def _box_rect(box):
+    top, bottom, left, right = box
+    return QRect(left, top, right - left, bottom - top)
+
+
+class LiveRegionTracker:
+    """
+    记录自上次识别以来修改过的区域，以及识别出的各个公式
+
+    - mark_changed(rect): 记录一次修改（文档坐标），与之相交的公式不再有效
+    - active_region(surface): 当前正在书写的公式区域，没有修改时返回空矩形
+    - take(region): 取出修改区域，并给出 region 内可以沿用的结果
+    - known(region): region 内可以沿用的结果，不影响修改区域
+    - store(region, entries, edits): 保存 region 的识别结果，取代其中旧的结果；
+      与识别期间的修改 edits 相交的公式不保存
+    """
+
+    def __init__(self, margin=REGION_MARGIN, growStep=GROW_STEP, maxSize=MAX_REGION_SIZE):
+        self.margin = margin
+        self.growStep = growStep
+        self.maxSize = maxSize
+        self.dirty = QRect()
+        # {(top, bottom, left, right): 结果}，包围盒为文档坐标，bottom/right 不含
+        self.segments = {}
+
+    def mark_changed(self, rect):
+        if rect.isEmpty():
+            return
+        rect = rect.normalized()
+        self.dirty = self.dirty.united(rect)
+        for box in [box for box in self.segments if rect.intersects(_box_rect(box))]:
+            del self.segments[box]
+
+    def has_changes(self):
+        return not self.dirty.isEmpty()
+
+    def clear_changes(self):
+        self.dirty = QRect()
+
+    def reset(self):
+        self.dirty = QRect()
+        self.segments.clear()
+
+    def active_region(self, surface):
+        """
+        从修改区域加上边距开始，只要某条边上还有笔迹就把这条边向外推，
+        直到四周都是空白或者达到最大尺寸。
+        """
+        if self.dirty.isEmpty():
+            return QRect()
+        region = self.dirty.adjusted(-self.margin, -self.margin, self.margin, self.margin)
+        region.setLeft(max(0, region.left()))
+        region.setTop(max(0, region.top()))
+        while True:
+            grow = [0, 0, 0, 0]
+            if region.width() < self.maxSize:
+                if region.left() > 0 and _has_ink(surface, QRect(region.left(), region.top(), 1, region.height())):
+                    grow[0] = -min(self.growStep, region.left())
+                if _has_ink(surface, QRect(region.right(), region.top(), 1, region.height())):
+                    grow[2] = self.growStep
+            if region.height() < self.maxSize:
+                if region.top() > 0 and _has_ink(surface, QRect(region.left(), region.top(), region.width(), 1)):
+                    grow[1] = -min(self.growStep, region.top())
+                if _has_ink(surface, QRect(region.left(), region.bottom(), region.width(), 1)):
+                    grow[3] = self.growStep
+            if not any(grow):
+                return region
+            region.adjust(*grow)
+
+    def take(self, region):
+        """
+        取出并清空修改区域，返回 (修改区域, 可沿用的结果)
+
+        可沿用的结果为 {(top, bottom, left, right): 结果}，包围盒换算为 region 内的坐标，
+        只包含完全位于 region 内且与修改区域不相交的公式。
+        """
+        changed, self.dirty = self.dirty, QRect()
+        known = {box: result for box, result in self.known(region).items()
+                 if not _box_rect(box).translated(region.topLeft()).intersects(changed)}
+        return changed, known
+
+    def known(self, region):
+        """完全位于 region 内的公式，包围盒换算为 region 内的坐标"""
+        known = {}
+        for (top, bottom, left, right), result in self.segments.items():
+            if region.contains(QRect(left, top, right - left, bottom - top)):
+                box = (top - region.top(), bottom - region.top(), left - region.left(), right - region.left())
+                known[box] = result
+        return known
+
+    def store(self, region, entries, edits=()):
+        """
+        entries 为 [((top, bottom, left, right), 结果), ...]，包围盒为 region 内的坐标
+
+        edits 为识别任务开始之后的修改区域（文档坐标）：这些位置的结果是按旧的笔迹
+        得到的，不再保存，留给下一次识别。
+        """
+        self.segments = {
+            box: result for box, result in self.segments.items()
+            if not region.intersects(_box_rect(box))
+        }
+        for (top, bottom, left, right), result in entries:
+            box = (top + region.top(), bottom + region.top(), left + region.left(), right + region.left())
+            if any(rect.intersects(_box_rect(box)) for rect in edits):
+                continue
+            self.segments[box] = result
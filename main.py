@@ -1,191 +1,363 @@
+# 最先导入，以便统计之后每个导入的耗时
+import startup
+import os
 import sys
 import math
-from pix2text import Pix2Text
-import numpy as np
-import sympy
-from sympy import solve as solving, latex
-from latex2sympy2 import latex2sympy
-import io
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-import matplotlib.pyplot as plt
+import threading
+import time
+# sympy、latex2sympy2、matplotlib 和识别模型都在第一次使用时（或后台预热时）才导入，
+# 窗口可以立即显示
+from recognizer import get_recognizer
+from solver_engine import get_solver_engine
+from strokes import StrokeRenderer, Stroke, Shape, Clear, RasterPatch, Scene, shape_path
+from undo import TileUndoStack
+from tiles import TiledImage
+from image_bridge import segment_qimage
+from formula_render import get_formula_renderer
+from tracing import get_tracer, stage
+from live_recognition import LiveRegionTracker, LIVE_IDLE_MS
+from notefile import NoteFile, NoteFileError, DeferredRelation, EXTENSION as NOTE_EXTENSION
+from autosave import Autosaver, find_recoverable, discard as discard_autosave
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QToolBar, QAction, QDockWidget,
     QColorDialog, QFontDialog, QInputDialog, QMessageBox, QListWidget,
     QLabel, QHBoxLayout, QVBoxLayout, QSplitter, QFileDialog, QFrame, QSlider,
-    QPushButton
+    QPushButton, QProgressDialog, QTableWidget, QTableWidgetItem, QPlainTextEdit
 )
 from PyQt5.QtGui import (
     QPainter, QPen, QBrush, QColor, QPixmap, QIcon, QCursor, QFont,
-    QPainterPath, QImage
+    QPainterPath, QImage, QTransform
 )
 from PyQt5.QtCore import (
-    Qt, QPoint, QRect, QSize, QRectF, QSizeF, QLineF, QPointF, QEvent
+    Qt, QPoint, QRect, QSize, QRectF, QSizeF, QLineF, QPointF, QEvent, QTimer,
+    QObject, QRunnable, QThreadPool, pyqtSignal
 )
-import re
-def solve_mix(latex_text, formatter='sympy'):
-    regex = r"\\begin{cases}([\s\S]*)\\end{cases}"
-    matches = re.findall(regex, latex_text, re.MULTILINE)
-    equations = []
-    if matches:
-        matches = re.split(r"\\\\(?:\[?.*?\])?", matches[0])
-        for match in matches:
-            ins = latex2sympy(match)
-            if type(ins) == list:
-                equations.extend(ins)
-            else:
-                equations.append(ins)
-        solved = sympy.solve(equations)
-    else:
-        return False
-    if formatter == 'latex':
-        return latex(solved)
-    else:
-        return solved
-def is_equation(latex_str):
+def preload_formula():
+    """在后台线程中导入公式解析（sympy、latex2sympy2）和渲染（mathtext）模块，首次求解时无需等待"""
+    def load():
+        with startup.phase("预加载公式解析模块"):
+            import formula  # noqa: F401
+        with startup.phase("预加载公式渲染"):
+            import formula_render
+            formula_render.warm_up()
+    threading.Thread(target=load, name="formula-warmup", daemon=True).start()
+class RecognitionSignals(QObject):
+    """识别任务向界面线程回传结果所用的信号"""
+    progress = pyqtSignal(int, str)
+    # 结果为 [(LaTeX, 关系类型, SolveResult, ImplicitRelation或None), ...]，每个识别出的公式一项；
+    # 二元方程和不等式的 ImplicitRelation 已在后台编译好，可以直接绘图
+    finished = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+    done = pyqtSignal(int)
+class RecognitionCancelled(Exception):
+    pass
+class RecognitionJob(QRunnable):
     """
-    判断LaTeX表达式是否为方程（包括等式方程和不等式方程）
+    在线程池中执行 分割 -> 识别 -> 分类 -> 求解 的后台任务
     
-    规则：
-    - 有等号或各种不等号，且后面还有数字或字母
-    - 返回True表示是方程，False表示不是方程
-    
-    支持的符号：
-    - 等式: = 
-    - 不等式: ≠, <, >, ≤, ≥, \\neq, \\lt, \\gt, \\leq, \\geq
+    选区中的多个公式在一次批量推理中识别，之后分别分类、求解。
+    known 为 {包围盒: 结果}，包围盒与之相同的公式直接沿用已有结果，不再识别和求解。
+    结束后 boxes 为与结果一一对应的包围盒 (top, bottom, left, right)。
+    取消时正在进行的求解进程会被终止；正在进行的推理会继续运行，但结果会被丢弃。
     """
-    # 预处理：移除空格
-    cleaned = latex_str.replace(' ', '')
-    
-    # 检查是否包含等号或不等号
-    has_equation_symbol = False
-    equation_symbol = None
+    def __init__(self, jobId, selectionImage, trace, known=None):
+        super().__init__()
+        self.jobId = jobId
+        self.selectionImage = selectionImage
+        # 本次识别请求的分阶段计时，由画布在显示结果后结束
+        self.trace = trace
+        self.known = known or {}
+        self.boxes = []
+        # 任务开始之后画布上的修改区域（由画布记录），与之相交的结果不再保存
+        self.edits = []
+        self.signals = RecognitionSignals()
+        self._cancelled = threading.Event()
+        # 由画布持有引用，直到任务结束
+        self.setAutoDelete(False)
     
-    # 定义所有需要检查的方程符号及其优先级（长的符号优先检查）
-    equation_symbols = ['\\leq', '\\geq', '\\neq', '\\lt', '\\gt', '=', '<', '>', '≤', '≥', '≠']
+    def cancel(self):
+        self._cancelled.set()
     
-    for symbol in equation_symbols:
-        if symbol in cleaned:
-            has_equation_symbol = True
-            equation_symbol = symbol
-            break
+    def isCancelled(self):
+        return self._cancelled.is_set()
     
-    if not has_equation_symbol:
-        print("不是方程")
-        return False
+    def checkCancelled(self):
+        if self.isCancelled():
+            raise RecognitionCancelled()
     
-    # 分割表达式
-    parts = cleaned.split(equation_symbol, 1)
+    def run(self):
+        with self.trace.activate():
+            self.runStages()
     
-    # 检查符号后面是否有内容
-    if len(parts) < 2:
-        print("不是方程")
-        return False
-    
-    # 检查符号后面是否有内容
-    after_symbol = parts[1].strip()
-    if not after_symbol:  # 空字符串
-        print("不是方程")
-        return False
+    def runStages(self):
+        try:
+            from formula import ParsedFormula, RELATION_NAMES, calculate_formula
+            from implicit_plot import ImplicitRelation
+            # 把选区分割成各个公式，分别裁剪并缩小；选区内没有笔迹时不调用模型
+            with stage("preprocess"):
+                segments = segment_qimage(self.selectionImage)
+            self.trace.attributes["segments"] = len(segments)
+            self.checkCancelled()
+            if not segments:
+                self.signals.finished.emit(self.jobId, [])
+                return
+            
+            # 只识别没有可沿用结果的公式
+            fresh = [(box, image) for box, image in segments if box not in self.known]
+            self.trace.attributes["reused"] = len(segments) - len(fresh)
+            formulas = {}
+            if fresh:
+                recognizer = get_recognizer()
+                if not recognizer.is_loaded:
+                    self.signals.progress.emit(self.jobId, "正在加载识别模型...")
+                    with stage("model_load"):
+                        recognizer.ensure_loaded()
+                with stage("inference"):
+                    recognized = recognizer.recognize_formulas([image for _, image in fresh])
+                formulas = {box: formula for (box, _), formula in zip(fresh, recognized) if formula}
+            self.trace.attributes["formulas"] = list(formulas.values())
+            self.checkCancelled()
+            
+            results = []
+            boxes = [box for box, _ in segments if box in self.known or box in formulas]
+            for box in boxes:
+                if box in self.known:
+                    results.append(self.known[box])
+                    continue
+                formula = formulas[box]
+                if len(formulas) > 1:
+                    index = list(formulas).index(box)
+                    self.signals.progress.emit(self.jobId, f"正在计算 ({index + 1}/{len(formulas)}): {formula}")
+                else:
+                    self.signals.progress.emit(self.jobId, f"正在计算: {formula}")
+                try:
+                    kind = ParsedFormula.of(formula).relation
+                except Exception:
+                    kind = None
+                result = calculate_formula(formula, cancelEvent=self._cancelled)
+                plot = None
+                if kind in ('equation', 'inequality'):
+                    # 绘图失败不影响已经得到的求解结果
+                    try:
+                        with stage("plot_compile"):
+                            plot = ImplicitRelation.from_formula(formula)
+                    except Exception as e:
+                        print(f"无法绘制公式 {formula}: {str(e)}")
+                results.append((formula, RELATION_NAMES.get(kind, ""), result, plot))
+                self.checkCancelled()
+            
+            self.boxes = boxes
+            self.signals.finished.emit(self.jobId, results)
+        except RecognitionCancelled:
+            pass
+        except Exception as e:
+            self.signals.failed.emit(self.jobId, str(e))
+        finally:
+            self.signals.done.emit(self.jobId)
+class PlotCompileSignals(QObject):
+    # 编译好的 ImplicitRelation，无法编译时为None
+    finished = pyqtSignal(object)
+class PlotCompileJob(QRunnable):
+    """在线程池中编译打开文档时读入的可绘图公式（DeferredRelation），第一次绘图时不阻塞界面"""
+    def __init__(self, deferred):
+        super().__init__()
+        self.deferred = deferred
+        self.signals = PlotCompileSignals()
+        # 由结果面板持有引用，直到任务结束
+        self.setAutoDelete(False)
     
-    # 检查是否包含至少一个数字或字母
-    return bool(re.search(r'[a-zA-Z0-9]', after_symbol))
-
-def is_binary_equation(latex_str):
+    def run(self):
+        try:
+            with stage("plot_compile"):
+                relation = self.deferred.resolve()
+        except Exception as e:
+            print(f"无法绘制公式 {self.deferred.formula}: {str(e)}")
+            relation = None
+        self.signals.finished.emit(relation)
+class FormulaResultPanel(QWidget):
     """
-    判断LaTeX表达式是否为二元方程或二元不等方程
+    显示识别结果的面板
     
-    返回：
-    - True表示是二元方程或二元不等方程
-    - False表示不是
+    画布只创建一个面板，每次识别只更新其中的内容；公式图像来自带缓存的公式渲染器。
     """
-    try:
-        # 预处理：移除空格
-        cleaned = latex_str.replace(' ', '')
-        
-        # 检查是否为方程
-        if not is_equation(cleaned):
-            return False
+    def __init__(self, parent=None, pool=None):
+        super().__init__(parent, Qt.Tool)
+        self.setWindowTitle("公式识别结果")
+        self.setGeometry(300, 300, 500, 300)
+        self.rows = []
+        self.plots = []
+        self.plotView = None
+        # 编译 DeferredRelation 的线程池和正在进行的任务
+        self.pool = pool or QThreadPool.globalInstance()
+        self.plotJobs = {}
+        self.labelFont = QFont()
+        self.labelFont.setPointSize(12)
         
-        # 尝试将表达式转换为sympy对象
-        expr = latex2sympy(cleaned)
-        
-        # 获取表达式中的符号变量
-        variables = expr.free_symbols
+        layout = QVBoxLayout()
+        self.rowLayout = QVBoxLayout()
+        layout.addLayout(self.rowLayout)
+        layout.addStretch()
         
-        # 检查是否有且仅有2个不同的变量
-        return len(variables) == 2
-    except Exception as e:
-        print(f"判断二元方程时出错: {str(e)}")
-        return False
-def is_calculation(latex_str):
+        # 添加关闭按钮
+        closeBtn = QPushButton("关闭", self)
+        closeBtn.clicked.connect(self.hide)
+        layout.addWidget(closeBtn)
+        self.setLayout(layout)
+    
+    def addRow(self):
+        # 每个公式一行：识别的公式、渲染的公式图像、计算结果
+        formulaLabel = QLabel()
+        formulaLabel.setFont(self.labelFont)
+        imageLabel = QLabel()
+        imageLabel.setAlignment(Qt.AlignCenter)
+        resultLabel = QLabel()
+        resultLabel.setFont(self.labelFont)
+        for label in (formulaLabel, imageLabel, resultLabel):
+            label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+            self.rowLayout.addWidget(label)
+        # 二元方程和不等式可以绘制图像
+        index = len(self.rows)
+        plotButton = QPushButton("绘制图像", self)
+        plotButton.clicked.connect(lambda: self.showPlot(index))
+        self.rowLayout.addWidget(plotButton, 0, Qt.AlignLeft)
+        return formulaLabel, imageLabel, resultLabel, plotButton
+    
+    def setResults(self, results):
+        renderer = get_formula_renderer()
+        while len(self.rows) < len(results):
+            self.rows.append(self.addRow())
+        self.plots = [(formula, plot) for formula, _, _, plot in results]
+        for index, row in enumerate(self.rows):
+            visible = index < len(results)
+            for label in row:
+                label.setVisible(visible)
+            if not visible:
+                continue
+            formula, relation, result, plot = results[index]
+            formulaLabel, imageLabel, resultLabel, plotButton = row
+            plotButton.setVisible(plot is not None)
+            # 多个公式时加上序号和类型
+            prefix = f"{index + 1}. " if len(results) > 1 else ""
+            kind = f"（{relation}）" if relation and len(results) > 1 else ""
+            formulaLabel.setText(f"{prefix}识别的公式{kind}: ${formula}$")
+            pixmap = renderer.render(formula)
+            if pixmap is None:
+                imageLabel.setPixmap(QPixmap())
+                imageLabel.setText("无法显示LaTeX公式")
+            else:
+                imageLabel.setPixmap(pixmap)
+            resultLabel.setText(f"计算结果: {result}")
+        self.adjustSize()
+    
+    def showPlot(self, index):
+        if index >= len(self.plots) or self.plots[index][1] is None:
+            return
+        formula, plot = self.plots[index]
+        if isinstance(plot, DeferredRelation):
+            if not plot.resolved:
+                # 打开文档时读入的公式在第一次绘图时才在线程池中编译，编译完成后再显示
+                if plot not in self.plotJobs:
+                    job = PlotCompileJob(plot)
+                    job.signals.finished.connect(
+                        lambda relation, deferred=plot: self.onPlotCompiled(deferred, formula, relation))
+                    self.plotJobs[plot] = job
+                    self.pool.start(job)
+                return
+            plot = plot.resolve()
+            if plot is None:
+                return
+        self.displayPlot(plot, formula)
+    
+    def onPlotCompiled(self, deferred, formula, relation):
+        self.plotJobs.pop(deferred, None)
+        # 编译期间面板可能已经换成了别的结果
+        if relation is None or not any(plot is deferred for _, plot in self.plots):
+            return
+        self.displayPlot(relation, formula)
+    
+    def displayPlot(self, relation, formula):
+        from implicit_plot import ImplicitPlotView
+        if self.plotView is None:
+            self.plotView = ImplicitPlotView(self)
+        self.plotView.setRelation(relation, formula)
+        self.plotView.show()
+        self.plotView.raise_()
+class DiagnosticsPanel(QWidget):
     """
-    判断LaTeX表达式是否为计算式
+    性能诊断面板
     
-    规则：
-    - 没有等号或不等号
-    - 有等号但等号后面没有内容
-    - 返回True表示是计算式，False表示不是计算式
+    显示识别管线各阶段耗时的滚动分位数和最近一次请求的分阶段明细，
+    并可以对下一次识别做 cProfile 或 tracemalloc 分析。
     """
-    # 预处理：移除空格
-    cleaned = latex_str.replace(' ', '')
+    COLUMNS = ["阶段", "次数", "p50 (ms)", "p90 (ms)", "p99 (ms)", "最大 (ms)"]
     
-    # 检查是否包含等号或不等号
-    if '=' not in cleaned and '\\neq' not in cleaned:
-        return True
+    def __init__(self, parent=None):
+        super().__init__(parent, Qt.Tool)
+        self.setWindowTitle("性能诊断")
+        self.setGeometry(320, 320, 620, 520)
+        
+        layout = QVBoxLayout()
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        layout.addWidget(self.table)
+        
+        layout.addWidget(QLabel("最近一次请求:"))
+        self.lastTrace = QPlainTextEdit()
+        self.lastTrace.setReadOnly(True)
+        layout.addWidget(self.lastTrace)
+        
+        buttons = QHBoxLayout()
+        for text, handler in [
+            ("刷新", self.refresh),
+            ("分析下一次识别 (cProfile)", lambda: self.armProfile("cprofile")),
+            ("分析下一次识别 (tracemalloc)", lambda: self.armProfile("tracemalloc")),
+            ("清空", self.resetStats),
+        ]:
+            button = QPushButton(text, self)
+            button.clicked.connect(handler)
+            buttons.addWidget(button)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+        
+        # 面板可见时每秒刷新一次
+        self.refreshTimer = QTimer(self)
+        self.refreshTimer.timeout.connect(self.refresh)
     
-    # 分割表达式（考虑等号和不等号）
-    if '=' in cleaned:
-        parts = cleaned.split('=', 1)
-    else:  # 处理不等号
-        parts = cleaned.split('\\neq', 1)
+    def showEvent(self, event):
+        self.refresh()
+        self.refreshTimer.start(1000)
+        super().showEvent(event)
     
-    # 检查等号/不等号后面是否有内容
-    if len(parts) < 2:
-        return True
+    def hideEvent(self, event):
+        self.refreshTimer.stop()
+        super().hideEvent(event)
     
-    # 检查等号/不等号后面是否有数字或字母
-    after_equal = parts[1].strip()
-    if not after_equal:  # 空字符串
-        return True
+    def refresh(self):
+        tracer = get_tracer()
+        summary = tracer.summary()
+        self.table.setRowCount(len(summary))
+        for row, (name, stats) in enumerate(sorted(summary.items())):
+            values = [name, str(stats["count"])] + [
+                f"{stats[key]:.1f}" for key in ("p50_ms", "p90_ms", "p99_ms", "max_ms")
+            ]
+            for column, value in enumerate(values):
+                self.table.setItem(row, column, QTableWidgetItem(value))
+        if tracer.recent:
+            record = tracer.recent[-1]
+            lines = [f"{record['time']}  {record['status']}  共 {record['total_ms']:.1f}ms"]
+            for item in record["stages"]:
+                alloc = "" if item["alloc_kb"] is None else f"  {item['alloc_kb']:+.0f}KB"
+                lines.append(f"{'  ' * item['depth']}{item['name']}: {item['duration_ms']:.1f}ms{alloc}")
+            self.lastTrace.setPlainText("\n".join(lines))
     
-    # 检查是否包含至少一个数字或字母
-    return not bool(re.search(r'[a-zA-Z0-9]', after_equal))
-def safe_calculate(expr_str):
-    # 去除等号和末尾可能的空白字符
-    #去除空格
-    expr_str = expr_str.replace(" ","")
-
-    if '=' in expr_str:
-        # 确保即使表达式以等号结尾也能正确处理
-        expr_str = expr_str.split('=')[0].strip()
-    
-    # 检查表达式是否为空
-    if not expr_str:
-        return "错误: 表达式为空"
-    
-    try:
-        # 尝试计算表达式
-        expr = latex2sympy(expr_str)
-        print(expr)
-        result = expr.evalf()
-        return result
-    except Exception as e:
-        return f"错误: {str(e)}"
-def solve_expression(expr_str):
-    try:
-        # 尝试解析为 LaTeX
-        expr = latex2sympy(expr_str)
-        solutions = sympy.solve(expr)
-        return solutions
-    except:
-        try:
-            # 如果不是 LaTeX，尝试解析为普通表达式
-            expr = sympy.sympify(expr_str)
-            solutions = sympy.solve(expr)
-            return solutions
-        except Exception as e:
-            return f"解析错误: {str(e)}"
+    def armProfile(self, mode):
+        get_tracer().arm_profile(mode)
+        QMessageBox.information(self, "性能诊断", "下一次识别将被分析，结果输出到标准错误输出")
+    
+    def resetStats(self):
+        get_tracer().reset()
+        self.refresh()
 class DrawingCanvas(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -209,10 +381,11 @@ class DrawingCanvas(QWidget):
         self.drawing = False
         self.lastPoint = QPoint()
         self.currentPoint = QPoint()
-        self.path = QPainterPath()
         self.tempPath = QPainterPath()
         self.selectionPath = QPainterPath()
         self.selectionRect = QRect()
+        self.strokeRenderer = StrokeRenderer()
+        self.eraserCursorPos = None
         
         # 初始化绘图工具和参数
         self.tool = "brush"
@@ -222,20 +395,48 @@ class DrawingCanvas(QWidget):
         self.shapeWidth = 2
         self.fillColor = QColor(255, 255, 255, 0)  # 透明填充
         
-        # 创建绘图画布
-        self.image = QImage(self.size(), QImage.Format_RGB32)
-        self.image.fill(Qt.white)
-        
-        # 撤销/重做栈
-        self.undoStack = []
-        self.redoStack = []
-        self.saveState()
+        # 分块的画布后备存储：图块在第一次绘制时才分配，窗口只是它的一个视口
+        self.store = TiledImage()
+        # 视口左上角在文档中的位置
+        self.viewOffset = QPoint(0, 0)
+        
+        # 矢量场景：self.store 是由它生成的光栅缓存
+        self.scene = Scene()
+        self.currentStroke = None
+        
+        # 基于图块的增量撤销/重做（附带场景位置，保持两者同步）
+        self.history = TileUndoStack()
+        self.sceneMark = 0
+        
+        # 后台识别任务（求解在独立的求解进程中执行，可以被取消）
+        self.recognitionPool = QThreadPool(self)
+        self.recognitionPool.setMaxThreadCount(2)
+        self.recognitionJobId = 0
+        self.currentJob = None
+        self.activeJobs = {}
+        self.progressDialog = None
+        self.resultPanel = None
+        
+        # 边写边识别：停笔 LIVE_IDLE_MS 毫秒后在后台识别正在书写的公式
+        self.liveMode = False
+        self.liveTracker = LiveRegionTracker()
+        self.liveJob = None
+        self.liveTimer = QTimer(self)
+        self.liveTimer.setSingleShot(True)
+        self.liveTimer.setInterval(LIVE_IDLE_MS)
+        self.liveTimer.timeout.connect(self.runLiveRecognition)
+        
+        # 当前的 .mathnote 文档（新建或打开图片时为None），保存时只追加变化的部分
+        self.noteFile = None
+        # 上一次新建、打开或保存时画布的版本号，用于判断是否有没保存的修改
+        self.savedVersion = self.store.version
         
     def eventFilter(self, obj, event):
         # 拦截橡皮擦指示器的绘制事件
         if obj == self.eraserIndicator and event.type() == QEvent.Paint:
             if self.tool == "eraser" and not self.drawing:
                 painter = QPainter(self.eraserIndicator)
+                painter.setClipRect(event.rect())
                 # 获取鼠标当前位置（相对于主画布）
                 cursorPos = self.mapFromGlobal(QCursor.pos())
                 # 转换为相对于指示器的位置
@@ -249,29 +450,66 @@ class DrawingCanvas(QWidget):
         return super().eventFilter(obj, event)
         
     def resizeEvent(self, event):
-        # 调整画布大小，保持原始内容
-        newImage = QImage(event.size(), QImage.Format_RGB32)
-        newImage.fill(Qt.white)
-        painter = QPainter(newImage)
-        painter.drawImage(QPoint(), self.image)
-        self.image = newImage
-        # 调整橡皮擦指示器的大小
+        # 画布内容保存在图块中，改变窗口大小只改变视口
         self.eraserIndicator.setGeometry(0, 0, self.width(), self.height())
         super().resizeEvent(event)
     
+    def toDocument(self, pos):
+        """窗口坐标转换为文档坐标"""
+        return pos + self.viewOffset
+    
+    def updateDocument(self, rect):
+        """刷新文档坐标下的 rect 区域"""
+        self.update(rect.translated(-self.viewOffset))
+    
+    def documentRect(self):
+        """包含所有内容和当前窗口大小的文档区域（保存图像时使用）"""
+        return QRect(QPoint(0, 0), self.size()).united(self.store.bounds())
+    
+    def scrollView(self, dx, dy):
+        # 文档从 (0, 0) 开始，视口不能移到负坐标
+        offset = QPoint(max(0, self.viewOffset.x() + dx), max(0, self.viewOffset.y() + dy))
+        delta = offset - self.viewOffset
+        if delta.isNull():
+            return
+        # 排队的笔画段按旧的视口请求了刷新，先画完并在平移后重新请求
+        flushed = self.flushStroke()
+        self.viewOffset = offset
+        # 复用已经显示的内容，只重绘新露出的区域（不移动子控件）
+        self.scroll(-delta.x(), -delta.y(), self.rect())
+        if not flushed.isEmpty():
+            self.updateDocument(flushed)
+    
+    def wheelEvent(self, event):
+        # 滚轮平移视口，按住Shift时水平平移
+        delta = event.angleDelta()
+        if event.modifiers() & Qt.ShiftModifier:
+            self.scrollView(-delta.y(), -delta.x())
+        else:
+            self.scrollView(-delta.x(), -delta.y())
+        event.accept()
+    
     def paintEvent(self, event):
+        startup.mark("首次绘制")
+        # 把这一帧之前排队的笔画点一次画完
+        self.flushStroke()
         painter = QPainter(self)
-        painter.drawImage(QPoint(), self.image)
+        # 只重绘需要刷新的区域，覆盖层也裁剪到该区域内
+        painter.setClipRect(event.rect())
+        # 以下在文档坐标下绘制
+        painter.translate(-self.viewOffset)
+        dirty = event.rect().translated(self.viewOffset)
+        self.store.drawTo(painter, dirty)
         
         # 绘制临时路径（正在绘制的形状）
-        if not self.tempPath.isEmpty():
+        if not self.tempPath.isEmpty() and dirty.intersects(self.shapePreviewRect()):
             pen = QPen(self.shapeColor, self.shapeWidth, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
             painter.setPen(pen)
             painter.setBrush(QBrush(self.fillColor))
             painter.drawPath(self.tempPath)
         
         # 绘制选区
-        if not self.selectionPath.isEmpty():
+        if not self.selectionPath.isEmpty() and dirty.intersects(self.selectionOverlayRect()):
             pen = QPen(QColor(0, 150, 255), 1, Qt.DashLine)
             painter.setPen(pen)
             painter.setBrush(QBrush(QColor(0, 150, 255, 50)))
@@ -282,110 +520,163 @@ class DrawingCanvas(QWidget):
         # 当使用橡皮擦工具时，在鼠标位置绘制一个表示作用范围的圆
         # 将这段代码放在所有绘制操作的最后，确保它显示在最上方
         if self.tool == "eraser" and not self.drawing:
-            # 获取鼠标当前位置
+            # 获取鼠标当前位置（窗口坐标）
+            painter.resetTransform()
             cursorPos = self.mapFromGlobal(QCursor.pos())
+            self.eraserCursorPos = cursorPos
             # 绘制宽度为5的圆表示橡皮擦作用范围
             pen = QPen(QColor(150, 150, 150), 5, Qt.DotLine)
             painter.setPen(pen)
             painter.setBrush(Qt.NoBrush)
             painter.drawEllipse(cursorPos, self.brushWidth // 2, self.brushWidth // 2)
     
+    def shapePreviewRect(self):
+        """正在绘制的形状（含线宽）所占的区域"""
+        margin = self.shapeWidth // 2 + 2
+        return self.tempPath.boundingRect().toAlignedRect().adjusted(-margin, -margin, margin, margin)
+    
+    def selectionOverlayRect(self):
+        """选框及其控制点所占的区域"""
+        if self.selectionPath.isEmpty():
+            return QRect()
+        # 控制点半径为4，再加上画笔宽度
+        return self.selectionPath.boundingRect().toAlignedRect().adjusted(-6, -6, 6, 6)
+    
+    def eraserRingRect(self, pos):
+        """橡皮擦指示圆所占的区域"""
+        radius = self.brushWidth // 2 + 5
+        return QRect(pos.x() - radius, pos.y() - radius, 2 * radius + 1, 2 * radius + 1)
+    
     def mousePressEvent(self, event):
         if event.button() == Qt.LeftButton:
             self.drawing = True
-            self.lastPoint = event.pos()
-            self.currentPoint = event.pos()
+            self.lastPoint = self.toDocument(event.pos())
+            self.currentPoint = self.lastPoint
             
             # 根据当前工具执行不同操作
-            if self.tool == "brush":
-                self.path = QPainterPath()
-                self.path.moveTo(self.lastPoint)
-            elif self.tool == "eraser":
-                self.path = QPainterPath()
-                self.path.moveTo(self.lastPoint)
+            if self.tool in ["brush", "eraser"]:
+                self.beginStroke(self.lastPoint)
             elif self.tool == "select":
                 # 如果当前已有选择区域，且点击位置不在选择区域内，则取消选择
-                if not self.selectionPath.isEmpty() and not self.selectionPath.contains(event.pos()):
+                if not self.selectionPath.isEmpty() and not self.selectionPath.contains(self.lastPoint):
+                    oldRect = self.selectionOverlayRect()
                     self.selectionPath = QPainterPath()
                     self.selectionRect = QRect()
-                    self.update()
+                    self.updateDocument(oldRect)
                 else:
                     # 开始新的选择
                     self.selectionPath = QPainterPath()
                     self.selectionPath.addRect(QRectF(self.lastPoint, QSizeF()))
             elif self.tool in ["rectangle", "ellipse", "line", "triangle"]:
-                self.tempPath = QPainterPath()
-                if self.tool == "line":
-                    self.tempPath.moveTo(self.lastPoint)
-                    self.tempPath.lineTo(self.currentPoint)
-                elif self.tool == "rectangle":
-                    self.tempPath.addRect(QRectF(self.lastPoint, QSizeF()))
-                elif self.tool == "ellipse":
-                    self.tempPath.addEllipse(QRect(self.lastPoint, QSize()))
-                elif self.tool == "triangle":
-                    self.updateTrianglePath()
+                self.tempPath = shape_path(self.tool, self.lastPoint, self.currentPoint)
     
     def mouseMoveEvent(self, event):
         if event.buttons() & Qt.LeftButton and self.drawing:
-            self.currentPoint = event.pos()
+            self.currentPoint = self.toDocument(event.pos())
             
-            if self.tool == "brush":
-                self.path.lineTo(self.currentPoint)
-                painter = QPainter(self.image)
-                pen = QPen(self.brushColor, self.brushWidth, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-                painter.setPen(pen)
-                painter.drawPath(self.path)
-                self.update()
-            elif self.tool == "eraser":
-                self.path.lineTo(self.currentPoint)
-                painter = QPainter(self.image)
-                # 使用白色作为橡皮擦颜色（与画布背景色相同）
-                pen = QPen(Qt.white, self.brushWidth, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-                painter.setPen(pen)
-                painter.drawPath(self.path)
-                self.update()
+            if self.tool in ["brush", "eraser"]:
+                self.queueStrokePoint(self.currentPoint)
             elif self.tool == "select":
+                oldRect = self.selectionOverlayRect()
                 self.selectionPath = QPainterPath()
                 rect = QRectF(self.lastPoint, self.currentPoint)
                 self.selectionPath.addRect(rect)
                 self.selectionRect = rect.toRect()
-                self.update()
+                # 刷新旧选框和新选框的并集
+                self.updateDocument(oldRect.united(self.selectionOverlayRect()))
             elif self.tool in ["rectangle", "ellipse", "line", "triangle"]:
-                self.tempPath = QPainterPath()
-                if self.tool == "line":
-                    self.tempPath.moveTo(self.lastPoint)
-                    self.tempPath.lineTo(self.currentPoint)
-                elif self.tool == "rectangle":
-                    self.tempPath.addRect(QRectF(self.lastPoint, self.currentPoint))
-                elif self.tool == "ellipse":
-                    self.tempPath.addEllipse(QRectF(self.lastPoint, self.currentPoint))
-                elif self.tool == "triangle":
-                    self.updateTrianglePath()
-                self.update()
-        
-        # 当使用橡皮擦工具时，刷新指示器
+                oldRect = self.shapePreviewRect()
+                self.tempPath = shape_path(self.tool, self.lastPoint, self.currentPoint)
+                # 刷新旧预览和新预览的并集
+                self.updateDocument(oldRect.united(self.shapePreviewRect()))
+        
+        # 当使用橡皮擦工具时，只刷新指示圆移动前后的位置
         if self.tool == "eraser" and not self.drawing:
-            self.eraserIndicator.update()
+            ringRect = self.eraserRingRect(event.pos())
+            if self.eraserCursorPos is not None:
+                ringRect = ringRect.united(self.eraserRingRect(self.eraserCursorPos))
+            self.eraserCursorPos = event.pos()
+            self.eraserIndicator.update(ringRect)
+    
+    def tabletEvent(self, event):
+        # 手写笔只用于画笔和橡皮擦（线宽随压感变化），其他工具交给合成的鼠标事件处理
+        if self.tool not in ["brush", "eraser"]:
+            event.ignore()
+            return
+        point = event.posF() + QPointF(self.viewOffset)
+        if event.type() == QEvent.TabletPress and event.button() == Qt.LeftButton:
+            self.drawing = True
+            self.lastPoint = point.toPoint()
+            self.currentPoint = self.lastPoint
+            self.beginStroke(point, event.pressure())
+        elif event.type() == QEvent.TabletMove and self.drawing:
+            self.currentPoint = point.toPoint()
+            self.queueStrokePoint(point, event.pressure())
+        elif event.type() == QEvent.TabletRelease and self.drawing:
+            self.finishDrawing()
+        event.accept()
+    
+    def beginStroke(self, point, pressure=1.0):
+        # 橡皮擦使用白色（与画布背景色相同）
+        color = self.brushColor if self.tool == "brush" else QColor(Qt.white)
+        pen = QPen(color, self.brushWidth, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+        self.strokeRenderer.begin(point, pen, pressure)
+        self.currentStroke = Stroke(color, self.brushWidth)
+        self.currentStroke.append(point, pressure)
+    
+    def queueStrokePoint(self, point, pressure=1.0):
+        # 只记录新点并请求刷新这一段，绘制在下一次 paintEvent 中合并完成
+        self.currentStroke.append(point, pressure)
+        self.updateDocument(self.strokeRenderer.queue(point, pressure))
+    
+    def flushStroke(self):
+        """画出排队的笔画段，返回修改的区域"""
+        if not self.strokeRenderer.hasPending():
+            return QRect()
+        self.prepareEdit(self.strokeRenderer.pendingRect())
+        return self.strokeRenderer.flush(self.store)
     
     def mouseReleaseEvent(self, event):
         if event.button() == Qt.LeftButton and self.drawing:
+            self.finishDrawing()
+        elif event.button() == Qt.RightButton and self.tool == "select" and not self.selectionPath.isEmpty():
+            # 显示右键菜单
+            self.showContextMenu(event.pos())
+    
+    def finishDrawing(self):
+        if self.drawing:
             self.drawing = False
+            self.flushStroke()
+            self.strokeRenderer.end()
             
-            # 保存当前状态用于撤销
-            self.saveState()
+            # 把完成的笔画化简后加入场景
+            if self.currentStroke is not None:
+                if len(self.currentStroke) > 1:
+                    self.currentStroke.simplify()
+                    self.scene.add(self.currentStroke)
+                self.currentStroke = None
             
             # 如果是绘制形状工具，将临时路径绘制到画布上
             if self.tool in ["rectangle", "ellipse", "line", "triangle"]:
-                painter = QPainter(self.image)
+                self.scene.add(Shape(self.tool, self.lastPoint, self.currentPoint,
+                                     self.shapeColor, self.shapeWidth, self.fillColor))
+                dirty = self.shapePreviewRect()
+                self.prepareEdit(dirty)
                 pen = QPen(self.shapeColor, self.shapeWidth, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-                painter.setPen(pen)
-                painter.setBrush(QBrush(self.fillColor))
-                painter.drawPath(self.tempPath)
+                brush = QBrush(self.fillColor)
+                path = self.tempPath
+                
+                def drawShape(painter):
+                    painter.setPen(pen)
+                    painter.setBrush(brush)
+                    painter.drawPath(path)
+                
+                self.store.paint(dirty, drawShape)
                 self.tempPath = QPainterPath()
-                self.update()
-        elif event.button() == Qt.RightButton and self.tool == "select" and not self.selectionPath.isEmpty():
-            # 显示右键菜单
-            self.showContextMenu(event.pos())
+                self.updateDocument(dirty)
+            
+            # 保存当前操作用于撤销
+            self.saveState()
             
     def showContextMenu(self, position):
         # 创建右键菜单
@@ -406,167 +697,179 @@ class DrawingCanvas(QWidget):
             QMessageBox.warning(self, "警告", "请先使用选择工具框选公式区域")
             return
         
-        try:
-            # 获取选区图像
-            selectionImage = self.image.copy(self.selectionRect)
-            
-            # 将QImage转换为PIL的Image对象（根据pix2text文档要求）
-            from PIL import Image
-            width = selectionImage.width()
-            height = selectionImage.height()
-            
-            # 确保图像格式正确
-            if selectionImage.format() != QImage.Format_RGB32:
-                selectionImage = selectionImage.convertToFormat(QImage.Format_RGB32)
-            
-            # 获取图像数据
-            ptr = selectionImage.bits()
-            ptr.setsize(height * width * 4)
-            
-            # 创建PIL Image对象
-            pil_image = Image.frombuffer(
-                "RGBA", 
-                (width, height), 
-                ptr, 
-                "raw", 
-                "RGBA", 
-                0, 
-                1
-            )
-            # 创建Pix2Text实例
-            p2t = Pix2Text()
-            
-            # 识别公式
-            result = p2t.recognize_formula(pil_image,return_text=True)
-            print(result)
-            # 解析表达式
-            QMessageBox.information(self, "结果", result)
-            # 如果识别结果为空
-            if not result:
-                QMessageBox.information(self, "结果", "未能识别出公式")
-                return
-            
-            # 尝试计算公式结果
-            try:
-                if is_equation(result):
-                    # 判断是否为二元方程或二元不等方程
-                    if is_binary_equation(result):
-                        # 调用solve_mix函数处理二元方程
-                        calculation_result = solve_mix(result)
-                        if calculation_result is False:
-                            # 如果solve_mix返回False，使用普通求解方法
-                            expr = latex2sympy(result)
-                            print(expr)
-                            calculation_result = sympy.solve(expr)
-                    else:
-                        expr = latex2sympy(result)
-                        print(expr)
-                        calculation_result = sympy.solve(expr)
-                else:
-                    calculation_result = safe_calculate(result)
-            except Exception as e:
-                calculation_result = f"计算错误: {str(e)}"
-            
-            # 显示结果对话框
-            self.showFormulaResult(result, calculation_result)
-            
-        except Exception as e:
-            print(f"处理公式时出错: {str(e)}")
-            QMessageBox.critical(self, "错误", f"处理公式时出错: {str(e)}")
-            
-    def showFormulaResult(self, formula, result):
-        # 创建结果对话框
-        dialog = QWidget()
-        dialog.setWindowTitle("公式识别结果")
-        dialog.setGeometry(300, 300, 500, 300)
-        
-        layout = QVBoxLayout()
-        
-        # 显示原始公式
-        formulaLabel = QLabel(f"识别的公式: ${formula}$")
-        font = QFont()
-        font.setPointSize(12)
-        formulaLabel.setFont(font)
-        layout.addWidget(formulaLabel)
-        
-        # 显示计算结果
-        resultLabel = QLabel(f"计算结果: {result}")
-        resultLabel.setFont(font)
-        layout.addWidget(resultLabel)
+        # 新的选区会取代仍在运行的任务
+        self.cancelRecognition()
+        
+        # 获取选区图像（QImage拷贝在界面线程完成，其余步骤在后台执行）
+        trace = get_tracer().begin("recognize")
+        with trace.stage("selection_copy"):
+            selectionImage = self.store.copy(self.selectionRect)
+        
+        # 选区内笔迹没有变化的公式沿用已有的结果（包括打开文档时读入的结果）
+        region = self.selectionRect.normalized()
+        self.recognitionJobId += 1
+        job = RecognitionJob(self.recognitionJobId, selectionImage, trace, self.liveTracker.known(region))
+        job.region = region
+        job.signals.progress.connect(self.onRecognitionProgress)
+        job.signals.finished.connect(self.onRecognitionFinished)
+        job.signals.failed.connect(self.onRecognitionFailed)
+        job.signals.done.connect(self.onRecognitionDone)
+        self.activeJobs[job.jobId] = job
+        self.currentJob = job
+        
+        self.showRecognitionProgress("正在识别公式...")
+        self.recognitionPool.start(job)
+    
+    def cancelRecognition(self):
+        """取消当前的识别任务，其结果到达后会被丢弃"""
+        if self.currentJob is not None:
+            self.currentJob.cancel()
+            self.currentJob.trace.finish("cancelled")
+            self.currentJob = None
+        if self.progressDialog is not None:
+            self.progressDialog.hide()
+    
+    def showRecognitionProgress(self, text):
+        # 非模态进度提示，不影响继续绘图
+        if self.progressDialog is None:
+            self.progressDialog = QProgressDialog(self)
+            self.progressDialog.setWindowTitle("公式识别")
+            self.progressDialog.setWindowModality(Qt.NonModal)
+            self.progressDialog.setRange(0, 0)
+            self.progressDialog.setCancelButtonText("取消")
+            self.progressDialog.setAutoClose(False)
+            self.progressDialog.setAutoReset(False)
+            self.progressDialog.canceled.connect(self.cancelRecognition)
+        self.progressDialog.setLabelText(text)
+        self.progressDialog.show()
+    
+    def isCurrentJob(self, jobId):
+        return self.currentJob is not None and self.currentJob.jobId == jobId
+    
+    def onRecognitionProgress(self, jobId, text):
+        if self.isCurrentJob(jobId):
+            self.showRecognitionProgress(text)
+    
+    def onRecognitionFinished(self, jobId, results):
+        if not self.isCurrentJob(jobId):
+            return
+        job, self.currentJob = self.currentJob, None
+        trace = job.trace
+        self.progressDialog.hide()
+        # 识别期间又被修改过的公式不保存，下一次识别时重新识别
+        self.liveTracker.store(job.region, list(zip(job.boxes, results)), job.edits)
+        
+        # 如果识别结果为空
+        if not results:
+            trace.finish("empty")
+            QMessageBox.information(self, "结果", "未能识别出公式")
+            return
         
-        # 使用matplotlib显示LaTeX公式
-        try:
-            # 创建matplotlib图形
-            fig = Figure(figsize=(5, 2))
-            ax = fig.add_subplot(111)
-            ax.axis('off')
-            
-            # 渲染LaTeX公式
-            ax.text(0.5, 0.5, f"${formula}$", fontsize=20, ha='center', va='center')
-            
-            # 创建画布并添加到布局
-            canvas = FigureCanvas(fig)
-            # 将画布和图形存储为对话框的属性，确保引用有效
-            dialog.canvas = canvas
-            dialog.fig = fig
-            layout.addWidget(canvas)
-            
-            # 刷新画布
-            canvas.draw()
+        # 显示结果对话框
+        with trace.stage("render"):
+            self.showFormulaResult(results)
+        trace.finish("ok")
+    
+    def onRecognitionDone(self, jobId):
+        # 任务结束后释放引用（包括已取消的任务）
+        self.activeJobs.pop(jobId, None)
+    
+    def onRecognitionFailed(self, jobId, message):
+        if not self.isCurrentJob(jobId):
+            return
+        self.currentJob.trace.finish("error", error=message)
+        self.currentJob = None
+        self.progressDialog.hide()
+        print(f"处理公式时出错: {message}")
+        QMessageBox.critical(self, "错误", f"处理公式时出错: {message}")
             
-            # 连接对话框关闭信号到清理函数
-            dialog.setAttribute(Qt.WA_DeleteOnClose)
-            dialog.destroyed.connect(self.onDialogDestroyed)
-        except Exception as e:
-            errorLabel = QLabel(f"无法显示LaTeX公式: {str(e)}")
-            layout.addWidget(errorLabel)
-        
-        # 添加关闭按钮
-        closeBtn = QPushButton("关闭", self)
-        closeBtn.clicked.connect(dialog.close)
-        layout.addWidget(closeBtn)
-        
-        dialog.setLayout(layout)
-        dialog.show()
-        
-        # 存储对话框引用，防止被提前回收
-        self.currentDialog = dialog
+    def showFormulaResult(self, results, activate=True):
+        # 复用同一个结果面板，只更新其中的内容
+        if self.resultPanel is None:
+            self.resultPanel = FormulaResultPanel(self, self.recognitionPool)
+        self.resultPanel.setResults(results)
+        # 实时预览不抢走画布的焦点
+        self.resultPanel.setAttribute(Qt.WA_ShowWithoutActivating, not activate)
+        self.resultPanel.show()
+        if activate:
+            self.resultPanel.raise_()
     
-    def cleanupMatplotlibCanvas(self, canvas):
-        """清理matplotlib画布资源"""
-        try:
-            # 安全关闭画布
-            if canvas and hasattr(canvas, 'close'):
-                canvas.close()
-        except Exception as e:
-            print(f"清理画布时出错: {str(e)}")
+    def setLiveMode(self, enabled):
+        self.liveMode = enabled
+        # 识别出的公式属于文档，只丢弃之前积累的修改区域
+        self.liveTimer.stop()
+        self.cancelLiveRecognition()
+        self.liveTracker.clear_changes()
     
-    def onDialogDestroyed(self):
-        """对话框销毁时执行的清理操作"""
-        try:
-            # 清理对话框相关的matplotlib资源
-            if hasattr(self, 'currentDialog'):
-                if hasattr(self.currentDialog, 'canvas'):
-                    self.cleanupMatplotlibCanvas(self.currentDialog.canvas)
-                # 清除对话框引用
-                del self.currentDialog
-        except Exception as e:
-            print(f"对话框销毁时清理出错: {str(e)}")
+    def resetLiveRecognition(self):
+        # 画布被整体替换（清空、打开文件）时，之前的区域和结果都不再有效
+        self.liveTimer.stop()
+        self.cancelLiveRecognition()
+        self.liveTracker.reset()
     
-    def updateTrianglePath(self):
-        # 创建三角形路径
-        self.tempPath = QPainterPath()
-        dx = self.currentPoint.x() - self.lastPoint.x()
-        dy = self.currentPoint.y() - self.lastPoint.y()
-        
-        p1 = self.lastPoint
-        p2 = QPoint(self.currentPoint.x(), self.lastPoint.y())
-        p3 = QPoint(self.lastPoint.x() + dx // 2, self.currentPoint.y())
-        
-        self.tempPath.moveTo(p1)
-        self.tempPath.lineTo(p2)
-        self.tempPath.lineTo(p3)
-        self.tempPath.closeSubpath()
+    def markChanged(self, rect):
+        # 记录修改的区域（笔迹变化的公式不再沿用），实时识别模式下重新开始计时
+        self.liveTracker.mark_changed(rect)
+        # 正在运行的识别任务按旧的笔迹识别，这些位置的结果到达后不再保存
+        if not rect.isEmpty():
+            for job in self.activeJobs.values():
+                job.edits.append(rect.normalized())
+        if self.liveMode:
+            self.liveTimer.start()
+    
+    def cancelLiveRecognition(self):
+        if self.liveJob is not None:
+            self.liveJob.cancel()
+            self.liveJob.trace.finish("cancelled")
+            # 结果不会被保存，修改区域留给下一次识别
+            self.liveTracker.mark_changed(self.liveJob.changed)
+            self.liveJob = None
+    
+    def runLiveRecognition(self):
+        # 仍在书写时继续等待
+        if self.drawing:
+            self.liveTimer.start()
+            return
+        if not self.liveMode or not self.liveTracker.has_changes():
+            return
+        self.cancelLiveRecognition()
+        
+        trace = get_tracer().begin("live_recognize")
+        with trace.stage("selection_copy"):
+            region = self.liveTracker.active_region(self.store)
+            changed, known = self.liveTracker.take(region)
+            regionImage = self.store.copy(region)
+        
+        self.recognitionJobId += 1
+        job = RecognitionJob(self.recognitionJobId, regionImage, trace, known)
+        job.region = region
+        job.changed = changed
+        job.signals.finished.connect(self.onLiveRecognitionFinished)
+        job.signals.failed.connect(self.onLiveRecognitionFailed)
+        job.signals.done.connect(self.onRecognitionDone)
+        self.activeJobs[job.jobId] = job
+        self.liveJob = job
+        self.recognitionPool.start(job)
+    
+    def onLiveRecognitionFinished(self, jobId, results):
+        if self.liveJob is None or self.liveJob.jobId != jobId:
+            return
+        job, self.liveJob = self.liveJob, None
+        self.liveTracker.store(job.region, list(zip(job.boxes, results)), job.edits)
+        if not results:
+            job.trace.finish("empty")
+            return
+        with job.trace.stage("render"):
+            self.showFormulaResult(results, activate=False)
+        job.trace.finish("ok")
+    
+    def onLiveRecognitionFailed(self, jobId, message):
+        if self.liveJob is None or self.liveJob.jobId != jobId:
+            return
+        self.liveJob.trace.finish("error", error=message)
+        self.liveJob = None
+        # 实时识别的错误不弹窗，避免打断书写
+        print(f"实时识别出错: {message}")
     
     def drawControlPoints(self, painter):
         # 在选框周围绘制控制点
@@ -580,34 +883,41 @@ class DrawingCanvas(QWidget):
         for point in points:
             painter.drawEllipse(point, 4, 4)
     
+    def prepareEdit(self, rect):
+        # 修改画布之前保存将被修改的图块
+        self.history.touch(self.store, rect)
+        self.markChanged(rect)
+    
     def saveState(self):
-        # 保存当前状态到撤销栈
-        self.undoStack.append(self.image.copy())
-        # 清空重做栈
-        self.redoStack.clear()
-        # 限制撤销栈大小
-        if len(self.undoStack) > 30:
-            self.undoStack.pop(0)
+        # 把本次操作修改过的图块和新增的场景记录作为一步撤销记录
+        if self.history.commit(self.sceneMark, self.scene.cursor):
+            self.sceneMark = self.scene.cursor
+            # 撤销历史被截短后，撤销不到的清空之前的场景记录不再需要
+            oldest = self.history.oldestMarker()
+            self.scene.prune(self.scene.cursor if oldest is None else oldest)
     
     def undo(self):
-        if len(self.undoStack) > 1:
-            # 将当前状态保存到重做栈
-            self.redoStack.append(self.image.copy())
-            # 恢复上一个状态
-            self.image = self.undoStack.pop()
-            self.update()
+        self.saveState()
+        self.restoreState(*self.history.undo(self.store))
     
     def redo(self):
-        if self.redoStack:
-            # 保存当前状态到撤销栈
-            self.undoStack.append(self.image.copy())
-            # 恢复下一个状态
-            self.image = self.redoStack.pop()
-            self.update()
+        self.restoreState(*self.history.redo(self.store))
+    
+    def restoreState(self, dirty, sceneMark):
+        if dirty is None:
+            return
+        if sceneMark is not None:
+            self.scene.setCursor(sceneMark)
+            self.sceneMark = self.scene.cursor
+        self.markChanged(dirty)
+        self.updateDocument(dirty)
     
     def clear(self):
-        # 清空画布
-        self.image.fill(Qt.white)
+        # 清空画布（释放所有图块）
+        self.history.touchAll(self.store)
+        self.store.clear()
+        self.scene.add(Clear())
+        self.resetLiveRecognition()
         self.update()
         self.saveState()
     
@@ -632,63 +942,172 @@ class DrawingCanvas(QWidget):
     def setFillColor(self, color):
         self.fillColor = color
     
+    def renderScene(self, rect=None, scale=1.0):
+        """从矢量场景重新渲染 rect 区域（默认整个文档），可指定缩放比例"""
+        if rect is None:
+            rect = self.documentRect()
+        return self.scene.renderImage(rect, scale)
+    
     def saveImage(self, filename):
-        return self.image.save(filename)
+        return self.store.toImage(self.documentRect()).save(filename)
     
     def loadImage(self, filename):
         newImage = QImage()
         if newImage.load(filename):
-            self.image = newImage
+            self.history.touchAll(self.store)
+            self.store.clear()
+            newImage = newImage.convertToFormat(QImage.Format_RGB32)
+            self.store.drawImage(QPoint(), newImage)
+            self.scene.add(Clear())
+            self.scene.add(RasterPatch(QRect(), QPoint(), newImage))
+            self.resetLiveRecognition()
+            self.closeDocument()
             self.update()
             self.saveState()
+            self.savedVersion = self.store.version
             return True
         return False
     
+    def newDocument(self):
+        self.clear()
+        self.closeDocument()
+        self.savedVersion = self.store.version
+    
+    def isModified(self):
+        """上一次新建、打开或保存之后画布是否被修改过"""
+        return self.store.version != self.savedVersion
+    
+    def documentMeta(self):
+        return {"viewOffset": [self.viewOffset.x(), self.viewOffset.y()]}
+    
+    def closeDocument(self):
+        # 调用前画布已被清空，不再有从文档按需加载的图块
+        if self.noteFile is not None:
+            self.noteFile.close()
+            self.noteFile = None
+    
+    def saveDocument(self, filename):
+        """保存为 .mathnote 文档；保存到当前文档时只追加变化的部分"""
+        self.flushStroke()
+        previous = self.noteFile
+        if previous is None or os.path.abspath(previous.path) != os.path.abspath(filename):
+            self.noteFile = NoteFile(filename)
+        try:
+            self.noteFile.save(self.store, self.scene, self.liveTracker.segments, self.documentMeta())
+        except (OSError, NoteFileError) as e:
+            print(f"保存文档时出错: {str(e)}")
+            self.noteFile = previous
+            return False
+        # 保存后文档中有全部图块：尚未加载的图块改为从文档中加载，
+        # 另存为之前的文档（以及恢复文件）不再被引用，可以关闭
+        self.store.rebindSources(self.noteFile)
+        if previous is not None and previous is not self.noteFile:
+            previous.close()
+        self.savedVersion = self.store.version
+        return True
+    
+    def loadDocument(self, filename):
+        """打开 .mathnote 文档：图块在显示时才加载，识别出的公式和结果直接读入"""
+        try:
+            noteFile = NoteFile.open(filename)
+        except (OSError, NoteFileError) as e:
+            print(f"打开文档时出错: {str(e)}")
+            return False
+        if self.showDocument(noteFile) is None:
+            noteFile.close()
+            return False
+        self.closeDocument()
+        self.noteFile = noteFile
+        self.savedVersion = self.store.version
+        return True
+    
+    def recoverDocument(self, noteFile):
+        """
+        显示自动保存的恢复文件（图块从恢复文件中按需加载）
+        
+        恢复后的画布视为没有保存；原来的文档仍在时，保存会写入原来的文档。
+        """
+        meta = self.showDocument(noteFile)
+        if meta is None:
+            return False
+        self.closeDocument()
+        document = meta.get("document")
+        if document:
+            self.noteFile = NoteFile(document)
+        self.savedVersion = -1
+        return True
+    
+    def showDocument(self, noteFile):
+        """用已打开的文档取代画布的内容，返回文档的元数据；读取失败时返回None，画布不变"""
+        try:
+            items, segments, meta = noteFile.read()
+        except (OSError, NoteFileError, ValueError) as e:
+            print(f"打开文档时出错: {str(e)}")
+            return None
+        self.cancelRecognition()
+        self.resetLiveRecognition()
+        # 打开的文档从新的撤销历史开始
+        self.store.clear()
+        noteFile.attach(self.store)
+        self.history.clear()
+        self.scene.reset()
+        for item in items:
+            self.scene.add(item)
+        self.sceneMark = self.scene.cursor
+        self.liveTracker.segments = segments
+        offset = meta.get("viewOffset", (0, 0))
+        self.viewOffset = QPoint(max(0, offset[0]), max(0, offset[1]))
+        self.update()
+        return meta
+    
     def scaleSelection(self, factor):
         # 缩放选区内的内容
         if not self.selectionPath.isEmpty():
-            self.saveState()
             # 获取选区图像
-            selectionImage = self.image.copy(self.selectionRect)
+            selectionImage = self.store.copy(self.selectionRect)
             # 缩放图像
             scaledImage = selectionImage.scaled(
                 int(selectionImage.width() * factor),
                 int(selectionImage.height() * factor),
                 Qt.KeepAspectRatio, Qt.SmoothTransformation
             )
-            # 清除原选区
-            painter = QPainter(self.image)
-            painter.fillRect(self.selectionRect, Qt.white)
-            # 绘制缩放后的图像
-            painter.drawImage(
-                self.selectionRect.topLeft(),
-                scaledImage
+            dirty = self.selectionRect.normalized().united(
+                QRect(self.selectionRect.topLeft(), scaledImage.size())
             )
-            self.update()
+            self.prepareEdit(dirty)
+            patch = RasterPatch(self.selectionRect, self.selectionRect.topLeft(), scaledImage)
+            # 清除原选区并绘制缩放后的图像
+            self.store.paint(dirty, patch.render)
+            self.scene.add(patch)
+            self.updateDocument(dirty)
+            self.saveState()
     
     def rotateSelection(self, angle):
         # 旋转选区内的内容
         if not self.selectionPath.isEmpty():
-            self.saveState()
             # 获取选区图像
-            selectionImage = self.image.copy(self.selectionRect)
+            selectionImage = self.store.copy(self.selectionRect)
             # 旋转图像
             rotatedImage = selectionImage.transformed(
                 QTransform().rotate(angle)
             )
-            # 清除原选区
-            painter = QPainter(self.image)
-            painter.fillRect(self.selectionRect, Qt.white)
             # 计算新的位置（居中）
             x = self.selectionRect.center().x() - rotatedImage.width() // 2
             y = self.selectionRect.center().y() - rotatedImage.height() // 2
-            # 绘制旋转后的图像
-            painter.drawImage(QPoint(x, y), rotatedImage)
-            self.update()
+            dirty = self.selectionRect.normalized().united(QRect(QPoint(x, y), rotatedImage.size()))
+            self.prepareEdit(dirty)
+            patch = RasterPatch(self.selectionRect, QPoint(x, y), rotatedImage)
+            # 清除原选区并绘制旋转后的图像
+            self.store.paint(dirty, patch.render)
+            self.scene.add(patch)
+            self.updateDocument(dirty)
+            self.saveState()
 
 class DrawingApp(QMainWindow):
-    def __init__(self):
+    def __init__(self, startupExit=False):
         super().__init__()
+        # 为True时画布第一次绘制完成后退出（--startup-exit），不提示恢复
+        self.startupExit = startupExit
         self.initUI()
         
     def initUI(self):
@@ -696,6 +1115,9 @@ class DrawingApp(QMainWindow):
         self.setWindowTitle("现代绘图工具")
         self.setGeometry(100, 100, 1024, 768)
         
+        # 性能诊断面板在第一次打开时创建
+        self.diagnosticsPanel = None
+        
         # 创建主画布
         self.canvas = DrawingCanvas(self)
         self.setCentralWidget(self.canvas)
@@ -711,6 +1133,51 @@ class DrawingApp(QMainWindow):
         
         # 显示窗口
         self.show()
+        
+        # 窗口显示后在后台预热识别模型和求解进程
+        QTimer.singleShot(0, get_recognizer().warm_up)
+        QTimer.singleShot(0, get_solver_engine().warm_up)
+        QTimer.singleShot(0, preload_formula)
+        
+        # 定时在后台把没保存的修改写入恢复文件，启动时检查上一次崩溃留下的恢复文件
+        self.autosaver = Autosaver(self.canvas)
+        if self.startupExit:
+            self.canvas.installEventFilter(self)
+        else:
+            QTimer.singleShot(0, self.offerRecovery)
+    
+    def eventFilter(self, obj, event):
+        # 画布的第一次绘制在这个事件处理完之后完成，之后再退出
+        if obj is self.canvas and event.type() == QEvent.Paint:
+            self.canvas.removeEventFilter(self)
+            QTimer.singleShot(0, QApplication.quit)
+        return super().eventFilter(obj, event)
+    
+    def offerRecovery(self):
+        for path in find_recoverable():
+            reply = QMessageBox.question(
+                self, "恢复",
+                f"发现上一次没有保存的内容（自动保存于 "
+                f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(os.path.getmtime(path)))}），是否恢复？",
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+            if reply != QMessageBox.Yes:
+                discard_autosave(path)
+                continue
+            try:
+                recovered = self.canvas.recoverDocument(self.autosaver.adopt(path))
+            except (OSError, NoteFileError) as e:
+                print(f"恢复时出错: {str(e)}")
+                recovered = False
+            if not recovered:
+                QMessageBox.warning(self, "错误", "无法恢复自动保存的内容！")
+            # 只恢复最新的一个，其余的留到下一次启动
+            break
+        self.autosaver.start()
+    
+    def closeEvent(self, event):
+        self.canvas.flushStroke()
+        self.autosaver.shutdown()
+        super().closeEvent(event)
     
     def createMenuBar(self):
         # 文件菜单
@@ -734,6 +1201,12 @@ class DrawingApp(QMainWindow):
         saveAction.triggered.connect(self.saveFile)
         fileMenu.addAction(saveAction)
         
+        # 另存为
+        saveAsAction = QAction("另存为", self)
+        saveAsAction.setShortcut("Ctrl+Shift+S")
+        saveAsAction.triggered.connect(self.saveFileAs)
+        fileMenu.addAction(saveAsAction)
+        
         fileMenu.addSeparator()
         
         # 退出应用
@@ -785,6 +1258,39 @@ class DrawingApp(QMainWindow):
         rotateAction = QAction("旋转", self)
         rotateAction.triggered.connect(self.rotateDialog)
         viewMenu.addAction(rotateAction)
+        
+        # 识别菜单
+        recognizeMenu = self.menuBar().addMenu("识别")
+        
+        # 重新加载识别模型
+        reloadModelAction = QAction("重新加载识别模型", self)
+        reloadModelAction.triggered.connect(self.reloadRecognizer)
+        recognizeMenu.addAction(reloadModelAction)
+        
+        # 卸载识别模型
+        unloadModelAction = QAction("卸载识别模型", self)
+        unloadModelAction.triggered.connect(self.unloadRecognizer)
+        recognizeMenu.addAction(unloadModelAction)
+        
+        recognizeMenu.addSeparator()
+        
+        # 边写边识别
+        liveAction = QAction("边写边识别", self)
+        liveAction.setCheckable(True)
+        liveAction.toggled.connect(self.canvas.setLiveMode)
+        recognizeMenu.addAction(liveAction)
+        
+        recognizeMenu.addSeparator()
+        
+        # 性能诊断
+        diagnosticsAction = QAction("性能诊断", self)
+        diagnosticsAction.triggered.connect(self.showDiagnostics)
+        recognizeMenu.addAction(diagnosticsAction)
+        
+        # 识别缓存统计
+        cacheStatsAction = QAction("识别缓存统计", self)
+        cacheStatsAction.triggered.connect(self.showRecognitionCacheStats)
+        recognizeMenu.addAction(cacheStatsAction)
     
     def createToolBars(self):
         # 工具工具栏
@@ -950,20 +1456,42 @@ class DrawingApp(QMainWindow):
         reply = QMessageBox.question(self, "确认", "是否创建新文件？当前未保存的内容将会丢失。",
                                      QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
         if reply == QMessageBox.Yes:
-            self.canvas.clear()
+            self.canvas.newDocument()
     
     def openFile(self):
         filename, _ = QFileDialog.getOpenFileName(self, "打开文件", "",
+                                                 f"MathNote文档 (*{NOTE_EXTENSION});;"
                                                  "图像文件 (*.png *.jpg *.jpeg *.bmp);;所有文件 (*)")
-        if filename:
+        if not filename:
+            return
+        if filename.lower().endswith(NOTE_EXTENSION):
+            if not self.canvas.loadDocument(filename):
+                QMessageBox.warning(self, "错误", "无法打开文档！")
+        else:
             self.canvas.loadImage(filename)
     
     def saveFile(self):
-        filename, _ = QFileDialog.getSaveFileName(self, "保存文件", "",
-                                                 "PNG图像 (*.png);;JPEG图像 (*.jpg);;BMP图像 (*.bmp)")
-        if filename:
-            if not self.canvas.saveImage(filename):
+        # 已经打开或保存过的文档直接保存（只写入变化的部分）
+        if self.canvas.noteFile is not None:
+            if not self.canvas.saveDocument(self.canvas.noteFile.path):
                 QMessageBox.warning(self, "错误", "保存文件失败！")
+            return
+        self.saveFileAs()
+    
+    def saveFileAs(self):
+        filename, selected = QFileDialog.getSaveFileName(self, "保存文件", "",
+                                                        f"MathNote文档 (*{NOTE_EXTENSION});;"
+                                                        "PNG图像 (*.png);;JPEG图像 (*.jpg);;BMP图像 (*.bmp)")
+        if not filename:
+            return
+        if selected.startswith("MathNote") and "." not in os.path.basename(filename):
+            filename += NOTE_EXTENSION
+        if filename.lower().endswith(NOTE_EXTENSION):
+            saved = self.canvas.saveDocument(filename)
+        else:
+            saved = self.canvas.saveImage(filename)
+        if not saved:
+            QMessageBox.warning(self, "错误", "保存文件失败！")
     
     def undo(self):
         self.canvas.undo()
@@ -972,7 +1500,7 @@ class DrawingApp(QMainWindow):
         self.canvas.redo()
     
     def clearCanvas(self):
-        reply = QMessageBox.question(self, "确认", "是否清除整个画布？此操作不可撤销。",
+        reply = QMessageBox.question(self, "确认", "是否清除整个画布？清除后可以撤销。",
                                      QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
         if reply == QMessageBox.Yes:
             self.canvas.clear()
@@ -984,12 +1512,46 @@ class DrawingApp(QMainWindow):
         angle, ok = QInputDialog.getInt(self, "旋转", "请输入旋转角度(度):", 90, -360, 360)
         if ok:
             self.canvas.rotateSelection(angle)
+    
+    def reloadRecognizer(self):
+        # 丢弃当前模型并在后台重新加载；正在识别时等识别结束，不阻塞界面
+        get_recognizer().reload_async()
+    
+    def unloadRecognizer(self):
+        get_recognizer().unload_async()
+    
+    def showDiagnostics(self):
+        if self.diagnosticsPanel is None:
+            self.diagnosticsPanel = DiagnosticsPanel(self)
+        self.diagnosticsPanel.show()
+        self.diagnosticsPanel.raise_()
+    
+    def showRecognitionCacheStats(self):
+        stats = get_recognizer().cache.stats()
+        QMessageBox.information(
+            self, "识别缓存统计",
+            f"命中: {stats['hits']}（其中磁盘 {stats['disk_hits']}）\n"
+            f"未命中: {stats['misses']}\n"
+            f"命中率: {stats['hit_rate']:.0%}\n"
+            f"缓存条目: {stats['entries']}（{stats['bytes']} 字节）\n"
+            f"节省识别时间: {stats['saved_seconds']:.2f}s"
+        )
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
-    # 设置应用程序样式
-    app.setStyle("Fusion")
+    # 无界面的批量模式：python main.py batch <目录|通配符>
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        from batch import main as batch_main
+        sys.exit(batch_main(sys.argv[2:]))
+    # --preload: 在显示窗口之前加载识别模型
+    if "--preload" in sys.argv:
+        get_recognizer().ensure_loaded()
+    with startup.phase("创建QApplication"):
+        app = QApplication(sys.argv)
+        # 设置应用程序样式
+        app.setStyle("Fusion")
     # 创建主窗口
-    window = DrawingApp()
+    # --startup-exit: 首次绘制后立即退出，便于在脚本中测量启动时间
+    with startup.phase("创建主窗口"):
+        window = DrawingApp(startupExit="--startup-exit" in sys.argv)
     # 运行应用程序
     sys.exit(app.exec_())
\ No newline at end of file
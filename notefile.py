@@ -0,0 +1,592 @@
+"""
+.mathnote 文档格式
+
+文档是一个只追加的日志文件：文件头之后是一条条记录，每条记录为
+
+    类型(4字节) 键长度(2) 数据长度(4) CRC32(4) 键 数据（zlib压缩）
+
+一次保存只追加自上次保存以来变化的记录，最后写入一条 SAVE 记录作为提交点；
+打开时只读取记录头建立索引，最后一个 SAVE 之后的记录（例如保存时崩溃）被忽略，
+下一次保存会把它们截掉。限制了数据量的快照没有取完所有变化时只写入图块、不提交，
+之后的快照接着写入，取完所有变化的那一次才写入 SAVE，因此文件中的提交点总是完整的画布。同一个键的新记录取代旧记录，被取代的记录占到文件的一半以上时，
+下一次保存改为重写整个文件（整理），未加载过的图块直接复制压缩后的数据。
+
+记录类型：
+- TILE: 画布图块的像素，键为 "列,行"，数据为空表示图块已被释放。打开文档时不读取，
+  第一次显示或编辑时才解压
+- ITEM: 矢量场景中的一条记录（笔画、形状、清空、图像块），键为序号
+- FORM: 识别出的公式，包括包围盒、关系类型和求解结果，重新打开后不需要再识别和求解
+- META: 视口位置等
+- SAVE: 提交点，数据为场景记录的条数
+"""
+import json
+import os
+import struct
+import threading
+import zlib
+from array import array
+
+import numpy as np
+from PyQt5.QtCore import QPoint, QRect
+from PyQt5.QtGui import QImage
+
+from solver_engine import SolveResult
+from strokes import Clear, RasterPatch, Shape, Stroke
+from tiles import TILE_SIZE
+from tracing import stage
+
+EXTENSION = ".mathnote"
+MAGIC = b"MATHNOTE"
+VERSION = 1
+# 文件头：标识、版本、图块边长
+FILE_HEADER = struct.Struct("<8sHI")
+# 记录头：类型、键长度、数据长度、数据的CRC32
+RECORD_HEADER = struct.Struct("<4sHII")
+COMPRESS_LEVEL = 1
+# 被取代的记录超过文件大小的该比例、且文件不小于 COMPACT_MIN_BYTES 时整理文件
+COMPACT_RATIO = 0.5
+COMPACT_MIN_BYTES = 1 << 20
+
+TILE = b"TILE"
+ITEM = b"ITEM"
+FORM = b"FORM"
+META = b"META"
+SAVE = b"SAVE"
+
+SHAPE_KINDS = ("rectangle", "ellipse", "line", "triangle")
+# 笔画：颜色、线宽、点数、是否有压感；之后是 float32 的坐标和压感
+_STROKE = struct.Struct("<IdI?")
+# 形状：种类、颜色、线宽、填充色、起点和终点
+_SHAPE = struct.Struct("<BIdI4f")
+# 图像块：擦除的矩形、位置、图像宽高；之后是 ARGB32 像素
+_PATCH = struct.Struct("<8i")
+
+
+class NoteFileError(Exception):
+    """不是 .mathnote 文档、版本不受支持或数据已损坏"""
+
+
+def _number(value):
+    return int(value) if float(value).is_integer() else value
+
+
+def encode_item(item):
+    """把场景中的一条记录编码为字节串"""
+    if isinstance(item, Stroke):
+        pressures = item.pressures.tobytes() if item.pressures is not None else b""
+        return (b"S" + _STROKE.pack(item.color, item.width, len(item), item.pressures is not None)
+                + item.points.tobytes() + pressures)
+    if isinstance(item, Shape):
+        return b"H" + _SHAPE.pack(SHAPE_KINDS.index(item.kind), item.color, item.width, item.fill, *item.points)
+    if isinstance(item, Clear):
+        return b"C"
+    if isinstance(item, RasterPatch):
+        image = item.image.convertToFormat(QImage.Format_ARGB32)
+        rect = item.eraseRect
+        header = _PATCH.pack(rect.x(), rect.y(), rect.width(), rect.height(),
+                             item.pos.x(), item.pos.y(), image.width(), image.height())
+        return b"P" + header + image.constBits().asstring(image.sizeInBytes())
+    raise TypeError(f"无法保存的场景记录: {type(item).__name__}")
+
+
+def decode_item(data):
+    """encode_item 的逆操作"""
+    tag, body = data[:1], data[1:]
+    if tag == b"S":
+        color, width, count, hasPressure = _STROKE.unpack_from(body)
+        offset = _STROKE.size
+        stroke = Stroke(0, _number(width))
+        stroke.color = color
+        stroke.points.frombytes(body[offset:offset + count * 8])
+        if hasPressure:
+            stroke.pressures = array("f")
+            stroke.pressures.frombytes(body[offset + count * 8:offset + count * 12])
+        return stroke
+    if tag == b"H":
+        kind, color, width, fill, x1, y1, x2, y2 = _SHAPE.unpack(body)
+        shape = Shape(SHAPE_KINDS[kind], QPoint(), QPoint(), 0, _number(width), 0)
+        shape.points = array("f", (x1, y1, x2, y2))
+        # QColor(int) 会丢掉透明度，直接写回 ARGB 整数
+        shape.color = color
+        shape.fill = fill
+        return shape
+    if tag == b"C":
+        return Clear()
+    if tag == b"P":
+        x, y, w, h, px, py, width, height = _PATCH.unpack_from(body)
+        pixels = body[_PATCH.size:_PATCH.size + width * height * 4]
+        image = QImage(pixels, width, height, width * 4, QImage.Format_ARGB32).copy()
+        return RasterPatch(QRect(x, y, w, h), QPoint(px, py), image)
+    raise NoteFileError(f"未知的场景记录类型: {tag!r}")
+
+
+def encode_formulas(segments):
+    """segments 为 {(top, bottom, left, right): (公式, 关系类型, SolveResult, ImplicitRelation、DeferredRelation或None)}"""
+    return [
+        {"box": list(box), "formula": formula, "relation": relation,
+         "result": result.to_dict(), "plot": plot is not None}
+        for box, (formula, relation, result, plot) in segments.items()
+    ]
+
+
+class DeferredRelation:
+    """
+    文档中可以绘图的公式
+
+    编译 ImplicitRelation 需要导入 sympy 和 latex2sympy2，打开文档时不做，
+    第一次绘图时才在后台线程中调用 resolve() 编译（之后沿用），无法编译时返回None。
+    """
+
+    __slots__ = ("formula", "_relation", "_resolved")
+
+    def __init__(self, formula):
+        self.formula = formula
+        self._relation = None
+        self._resolved = False
+
+    @property
+    def resolved(self):
+        return self._resolved
+
+    def resolve(self):
+        if not self._resolved:
+            from implicit_plot import ImplicitRelation
+            self._relation = ImplicitRelation.from_formula(self.formula)
+            self._resolved = True
+        return self._relation
+
+
+def decode_formulas(entries):
+    """encode_formulas 的逆操作；不会再次求解，可以绘图的公式用 DeferredRelation 代替 ImplicitRelation"""
+    segments = {}
+    for entry in entries:
+        plot = DeferredRelation(entry["formula"]) if entry.get("plot") else None
+        segments[tuple(entry["box"])] = (entry["formula"], entry["relation"],
+                                         SolveResult.from_dict(entry["result"]), plot)
+    return segments
+
+
+def _tile_name(key):
+    return f"{key[0]},{key[1]}"
+
+
+def _tile_key(name):
+    column, row = name.split(",")
+    return int(column), int(row)
+
+
+def _record(kind, key, data):
+    keyBytes = key.encode("utf-8")
+    return RECORD_HEADER.pack(kind, len(keyBytes), len(data), zlib.crc32(data)) + keyBytes + data
+
+
+def _compress(data):
+    return zlib.compress(data, COMPRESS_LEVEL)
+
+
+def _scene_items(scene):
+    """文档中保存的场景记录：当前可见的记录，去掉开头的清空"""
+    items = scene.visibleItems()
+    if items and isinstance(items[0], Clear):
+        items = items[1:]
+    return items
+
+
+class NoteFile:
+    """
+    一个 .mathnote 文档
+
+    - NoteFile.open(path): 打开已有的文档，只读取记录头
+    - read(): 读取场景记录、公式和元数据，返回 (场景记录, 公式, 元数据)
+    - attach(store): 把文档的图块登记到画布的 TiledImage 上，第一次访问时才加载
+    - save(store, scene, formulas, meta): 保存；新文档写入完整的文件，之后只追加变化的记录
+    - snapshot(...) / write(snapshot): 分两步保存，快照在界面线程中生成，写入可以在后台线程中进行
+
+    formulas 的形式与 LiveRegionTracker.segments 相同。文档按 store 的版本号判断哪些图块
+    需要写入；换成另一个 store 时写入完整的文件。
+    """
+
+    def __init__(self, path, tileSize=TILE_SIZE):
+        self.path = path
+        self.tileSize = tileSize
+        # (类型, 键) -> (数据偏移, 数据长度, CRC32, 记录字节数)，只包含已提交的最新记录
+        self._chunks = {}
+        self._itemCount = 0
+        # 文件中的场景记录对应的内存对象，用于判断哪些是新增的
+        self._items = []
+        # 上一次写入的 FORM/META 数据，没有变化时不再写入
+        self._written = {}
+        # 从本文档按需加载图块的画布
+        self._store = None
+        # 最后一个提交点之后的位置，以及被取代的记录的字节数
+        self._size = 0
+        self._garbage = 0
+        # 已经写入、等待同一个检查点的后续快照一起提交的记录，以及它们之后的位置；
+        # _staging 为True时这些记录在重写用的临时文件中
+        self._staged = []
+        self._tail = 0
+        self._staging = False
+        self._reader = None
+        # 按需加载和后台写入可能在不同的线程中进行
+        self._lock = threading.RLock()
+        # 上一次快照时画布的版本号，以及还没有写入的图块
+        self._version = 0
+        self._pending = set()
+
+    @classmethod
+    def open(cls, path):
+        note = cls(path)
+        note._reader = open(path, "rb")
+        try:
+            note._scan()
+        except Exception:
+            note.close()
+            raise
+        return note
+
+    def close(self):
+        with self._lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    # ---- 读取 ----
+
+    def _scan(self):
+        f = self._reader
+        header = f.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size or header[:len(MAGIC)] != MAGIC:
+            raise NoteFileError("不是 .mathnote 文档")
+        _, version, self.tileSize = FILE_HEADER.unpack(header)
+        if version > VERSION:
+            raise NoteFileError(f"不支持的文档版本: {version}")
+        fileSize = os.fstat(f.fileno()).st_size
+        position = self._size = FILE_HEADER.size
+        pending = []
+        while position + RECORD_HEADER.size <= fileSize:
+            f.seek(position)
+            kind, keyLength, length, crc = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+            offset = position + RECORD_HEADER.size + keyLength
+            end = offset + length
+            if end > fileSize:
+                break
+            try:
+                key = f.read(keyLength).decode("utf-8")
+            except UnicodeDecodeError:
+                break
+            if kind != SAVE:
+                pending.append((kind, key, (offset, length, crc, end - position)))
+                position = end
+                continue
+            try:
+                commit = json.loads(self._read(offset, length, crc))
+            except (NoteFileError, ValueError):
+                break
+            for kind, key, chunk in pending:
+                self._put(kind, key, chunk)
+            pending = []
+            self._commit(commit["items"])
+            self._garbage += end - position
+            position = self._size = end
+        self._tail = self._size
+
+    def _put(self, kind, key, chunk):
+        old = self._chunks.pop((kind, key), None)
+        if old is not None:
+            self._garbage += old[3]
+        if kind == TILE and chunk[1] == 0:
+            # 释放图块的记录在整理后就不再需要
+            self._garbage += chunk[3]
+        else:
+            self._chunks[(kind, key)] = chunk
+
+    def _commit(self, itemCount):
+        # 场景变短时，多出的旧记录不再属于文档
+        for index in range(itemCount, self._itemCount):
+            old = self._chunks.pop((ITEM, str(index)), None)
+            if old is not None:
+                self._garbage += old[3]
+        self._itemCount = itemCount
+
+    def _readRaw(self, offset, length, crc):
+        with self._lock:
+            if self._reader is None:
+                raise NoteFileError("文档已关闭")
+            self._reader.seek(offset)
+            data = self._reader.read(length)
+        if len(data) != length or zlib.crc32(data) != crc:
+            raise NoteFileError(f"{self.path} 中的数据已损坏")
+        return data
+
+    def _read(self, offset, length, crc):
+        try:
+            return zlib.decompress(self._readRaw(offset, length, crc))
+        except zlib.error as e:
+            raise NoteFileError(f"{self.path} 中的数据已损坏: {e}")
+
+    def _chunk(self, kind, key, default=None):
+        with self._lock:
+            chunk = self._chunks.get((kind, key))
+            if chunk is not None:
+                return self._read(*chunk[:3])
+        if default is None:
+            raise NoteFileError(f"{self.path} 中缺少记录 {kind.decode()} {key}")
+        return default
+
+    def loadTile(self, key):
+        """读取并解压一个图块，返回 (tileSize, tileSize) uint32 数组（TiledImage 按需加载时调用）"""
+        with stage("document_tile_load"):
+            data = self._chunk(TILE, _tile_name(key))
+        return np.frombuffer(data, np.uint32).reshape(self.tileSize, self.tileSize)
+
+    def rawTile(self, key):
+        """一个图块压缩后的数据，可以在任意线程中调用"""
+        with self._lock:
+            chunk = self._chunks.get((TILE, _tile_name(key)))
+            if chunk is None:
+                raise NoteFileError(f"{self.path} 中缺少图块 {_tile_name(key)}")
+            return self._readRaw(*chunk[:3])
+
+    def read(self):
+        """读取场景记录、公式和元数据；图块不在这里读取"""
+        with stage("document_read"):
+            items = [decode_item(self._chunk(ITEM, str(index))) for index in range(self._itemCount)]
+            form = self._chunk(FORM, "", b"[]")
+            meta = self._chunk(META, "", b"{}")
+            segments = decode_formulas(json.loads(form))
+        self._items = items
+        self._written = {FORM: form, META: meta}
+        return items, segments, json.loads(meta)
+
+    def attach(self, store):
+        """把文档中的图块登记为 store 的按需加载图块，store 的内容此后与文档一致"""
+        if store.tileSize != self.tileSize:
+            raise NoteFileError(f"图块大小不一致: {self.tileSize} != {store.tileSize}")
+        store.attachSource([_tile_key(key) for kind, key in self._chunks if kind == TILE], self)
+        self._store = store
+        self._version = store.version
+        self._pending = set()
+
+    # ---- 保存 ----
+
+    def save(self, store, scene, formulas, meta):
+        """在当前线程中保存文档，返回写入的字节数（没有变化时为0）"""
+        return self.write(self.snapshot(store, scene, formulas, meta))
+
+    def snapshot(self, store, scene, formulas, meta, maxBytes=None):
+        """
+        在界面线程中取出要写入的内容，返回 Snapshot
+
+        只复制上一次快照之后修改过的图块的像素；尚未加载的图块只记下来源，写入时再读取。
+        maxBytes 限制一次快照读取的数据量（复制的像素按未压缩的大小计算），
+        超出的图块留给下一次快照，这次快照写入的记录等到所有变化都写完时才提交。
+        上一次快照写完（或失败）之前不能再次调用。
+        """
+        with stage("document_snapshot"):
+            # 有等待提交的追加记录时不开始整理，整理会丢掉它们
+            compact = not self._staged and self._size >= COMPACT_MIN_BYTES \
+                and self._garbage > self._size * COMPACT_RATIO
+            sameStore = store is self._store
+            snapshot = Snapshot(rewrite=self._staging or self._reader is None or compact or not sameStore)
+            if not sameStore:
+                # 新的文件或新的画布：所有图块都要写入，之前没有提交的记录作废
+                self._store = store
+                self.tileSize = store.tileSize
+                self._pending = set(store.keys())
+                self._staged = []
+                self._staging = False
+                self._tail = self._size
+            else:
+                self._pending.update(store.changedSince(self._version))
+            self._version = store.version
+
+            tileBytes = store.tileSize * store.tileSize * 4
+            budget = maxBytes
+            for key in sorted(self._pending):
+                source = store.tileSource(key)
+                if source is not None:
+                    # 尚未加载的图块（来自本文档时表示没有变化，不会出现在这里）
+                    cost = source.rawSize(key)
+                    data = source
+                elif store.hasTile(key):
+                    cost = tileBytes
+                    data = store.read_pixels(store.tileRect(key)).tobytes()
+                else:
+                    cost = 0
+                    data = None
+                if budget is not None and cost > budget and snapshot.tiles:
+                    break
+                snapshot.tiles[key] = data
+                if budget is not None:
+                    budget -= cost
+            self._pending.difference_update(snapshot.tiles)
+            snapshot.commit = not self._pending
+            if snapshot.rewrite and snapshot.commit:
+                # 重写时没有变化的图块从原来的文件中复制压缩后的数据
+                staged = self._stagedTiles()
+                snapshot.copied = [key for key in store.keys()
+                                   if key not in snapshot.tiles and _tile_name(key) not in staged
+                                   and (TILE, _tile_name(key)) in self._chunks]
+
+            snapshot.items = _scene_items(scene)
+            saved = self._items
+            snapshot.start = 0 if snapshot.rewrite else len(saved)
+            if len(snapshot.items) < len(saved) or any(a is not b for a, b in zip(saved, snapshot.items)):
+                # 撤销后又有新的操作：场景从头重写（笔画很小，图块不受影响）
+                snapshot.start = 0
+            snapshot.form = json.dumps(encode_formulas(formulas), ensure_ascii=False).encode("utf-8")
+            snapshot.meta = json.dumps(meta).encode("utf-8")
+        return snapshot
+
+    def pending(self):
+        """因为超出 maxBytes 而留到下一次快照的图块数；不为0时最近的快照还没有提交"""
+        return len(self._pending)
+
+    def _stagedTiles(self):
+        return {key for kind, key, _ in self._staged if kind == TILE}
+
+    def rawSize(self, key):
+        chunk = self._chunks.get((TILE, _tile_name(key)))
+        return chunk[1] if chunk is not None else 0
+
+    def write(self, snapshot):
+        """写入快照，返回写入的字节数（没有变化时为0）；可以在后台线程中调用"""
+        try:
+            if snapshot.rewrite:
+                with stage("document_rewrite"):
+                    return self._rewrite(snapshot)
+            with stage("document_append"):
+                return self._append(snapshot)
+        except Exception:
+            # 没有写入的图块留给下一次快照（已经写入、等待提交的记录保留）；
+            # 重写失败时下一次重新写入完整的文件
+            self._pending.update(snapshot.tiles)
+            if snapshot.rewrite:
+                self._store = None
+            raise
+
+    def _tileData(self, key, data):
+        if data is None:
+            return b""
+        if isinstance(data, bytes):
+            return _compress(data)
+        return data.rawTile(key)
+
+    def _records(self, snapshot):
+        """按顺序生成 (类型, 键, 数据)，提交的快照最后是提交点"""
+        staged = self._stagedTiles()
+        for key in sorted(snapshot.tiles):
+            data = snapshot.tiles[key]
+            if data is None and snapshot.rewrite and _tile_name(key) not in staged:
+                continue
+            yield TILE, _tile_name(key), self._tileData(key, data)
+        if not snapshot.commit:
+            # 场景、公式和元数据与提交点一起写入
+            return
+        for key in sorted(snapshot.copied):
+            yield TILE, _tile_name(key), self.rawTile(key)
+        for index in range(snapshot.start, len(snapshot.items)):
+            yield ITEM, str(index), _compress(encode_item(snapshot.items[index]))
+        if snapshot.rewrite or snapshot.form != self._written.get(FORM):
+            yield FORM, "", _compress(snapshot.form)
+        if snapshot.rewrite or snapshot.meta != self._written.get(META):
+            yield META, "", _compress(snapshot.meta)
+        yield SAVE, "", _compress(json.dumps({"items": len(snapshot.items)}).encode("utf-8"))
+
+    def _write(self, f, base, records):
+        """写入记录，返回 [(类型, 键, 位置信息), ...] 和写入的字节数"""
+        written = []
+        position = base
+        for kind, key, data in records:
+            record = _record(kind, key, data)
+            f.write(record)
+            offset = position + len(record) - len(data)
+            written.append((kind, key, (offset, len(data), zlib.crc32(data), len(record))))
+            position += len(record)
+        f.flush()
+        os.fsync(f.fileno())
+        return written, position - base
+
+    def _finish(self, snapshot, written):
+        for kind, key, chunk in written:
+            if kind == SAVE:
+                self._commit(len(snapshot.items))
+                self._garbage += chunk[3]
+            else:
+                self._put(kind, key, chunk)
+        self._items = list(snapshot.items)
+        self._written = {FORM: snapshot.form, META: snapshot.meta}
+
+    def _append(self, snapshot):
+        if not snapshot.tiles and not self._staged and snapshot.start == len(snapshot.items) == len(self._items) \
+                and snapshot.form == self._written.get(FORM) and snapshot.meta == self._written.get(META):
+            return 0
+        with open(self.path, "r+b") as f:
+            # 截掉上一次没有写完的记录，已经写完、等待提交的记录保留
+            f.truncate(self._tail)
+            f.seek(self._tail)
+            written, size = self._write(f, self._tail, self._records(snapshot))
+        with self._lock:
+            self._tail += size
+            if snapshot.commit:
+                self._finish(snapshot, self._staged + written)
+                self._staged = []
+                self._size = self._tail
+            else:
+                self._staged += written
+        return size
+
+    def _rewrite(self, snapshot):
+        temporary = self.path + ".tmp"
+        # 没有提交之前原来的文件保持不变，记录都写在临时文件中
+        with open(temporary, "r+b" if self._staging else "wb") as f:
+            if not self._staging:
+                f.write(FILE_HEADER.pack(MAGIC, VERSION, self.tileSize))
+                self._tail = FILE_HEADER.size
+                self._staging = True
+            f.truncate(self._tail)
+            f.seek(self._tail)
+            written, size = self._write(f, self._tail, self._records(snapshot))
+        self._tail += size
+        if not snapshot.commit:
+            self._staged += written
+            return size
+        # 替换文件和更新索引时不允许读取，按需加载的图块读到的总是一致的数据
+        with self._lock:
+            if self._reader is not None:
+                self._reader.close()
+            os.replace(temporary, self.path)
+            self._reader = open(self.path, "rb")
+            self._chunks = {}
+            self._itemCount = 0
+            self._garbage = 0
+            self._size = self._tail
+            self._finish(snapshot, self._staged + written)
+            self._staged = []
+            self._staging = False
+        return self._size
+
+
+class Snapshot:
+    """
+    一次保存要写入的内容
+
+    - tiles: {图块: 像素字节 / None（已释放）/ 图块来源（尚未加载，写入时读取压缩数据）}
+    - copied: 重写文件时直接从原文件复制的图块
+    - items/start: 场景记录，以及需要写入的第一条的序号
+    - form/meta: 公式和元数据（JSON）
+    - rewrite: 是否重写整个文件（或继续还没有提交的重写）
+    - commit: 是否写入提交点；还有图块留到下一次快照时为False，只写入图块
+    """
+
+    __slots__ = ("tiles", "copied", "items", "start", "form", "meta", "rewrite", "commit")
+
+    def __init__(self, rewrite=False):
+        self.tiles = {}
+        self.copied = []
+        self.items = []
+        self.start = 0
+        self.form = b""
+        self.meta = b""
+        self.rewrite = rewrite
+        self.commit = True
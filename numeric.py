@@ -0,0 +1,129 @@
+"""
+数值计算
+
+把 sympy 表达式用 lambdify 编译成 NumPy 向量化函数，按表达式结构缓存，
+一次调用即可对标量、数组或区间内的所有取值求值。只有明确要求时才退回到
+逐个 evalf 的精确计算。
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import sympy
+
+# 编译结果缓存的最大条目数
+COMPILE_CACHE_SIZE = 128
+
+
+class CompiledExpression:
+    """
+    编译后的表达式
+
+    variables 为按名称排序的自由变量；调用时按 variables 的顺序传入参数，
+    参数可以是标量或可以互相广播的 NumPy 数组。
+    """
+
+    __slots__ = ("expr", "variables", "function")
+
+    def __init__(self, expr, variables):
+        self.expr = expr
+        self.variables = variables
+        self.function = sympy.lambdify(variables, _numeric_form(expr), modules="numpy")
+
+    def __call__(self, *args):
+        arrays = [np.asarray(arg, dtype=float) for arg in args]
+        result = np.asarray(self.function(*arrays))
+        # 常数表达式也按输入的形状广播
+        shape = np.broadcast_shapes(*(a.shape for a in arrays)) if arrays else ()
+        if result.shape != shape:
+            result = np.broadcast_to(result, shape).copy()
+        return result
+
+    def evaluate(self, values=None):
+        """按 {变量或变量名: 取值} 求值"""
+        return self(*_resolve_values(self.variables, values))
+
+    def real(self, *args):
+        """只保留实数结果的求值：无定义或结果为复数的点为 NaN，不产生警告"""
+        with np.errstate(all="ignore"):
+            values = self(*args)
+        if np.iscomplexobj(values):
+            values = np.where(values.imag == 0, values.real, np.nan)
+        return values.astype(float, copy=False)
+
+
+def _numeric_form(expr):
+    # latex2sympy 把 \ln x 解析为未求值的 log(x, E)，NumPy 的 log 不接受底数参数
+    return expr.replace(lambda e: isinstance(e, sympy.log) and len(e.args) == 2,
+                        lambda e: sympy.log(e.args[0]) / sympy.log(e.args[1]))
+
+
+_compileCache = OrderedDict()
+_compileLock = threading.Lock()
+
+
+def _sorted_symbols(expr):
+    return tuple(sorted(expr.free_symbols, key=lambda s: s.name))
+
+
+def compile_expression(expr, variables=None):
+    """编译表达式，相同结构的表达式共享同一个编译结果"""
+    variables = tuple(variables) if variables is not None else _sorted_symbols(expr)
+    # sympy 表达式的哈希和相等都基于结构
+    key = (expr, variables)
+    with _compileLock:
+        compiled = _compileCache.get(key)
+        if compiled is not None:
+            _compileCache.move_to_end(key)
+            return compiled
+    compiled = CompiledExpression(expr, variables)
+    with _compileLock:
+        _compileCache[key] = compiled
+        while len(_compileCache) > COMPILE_CACHE_SIZE:
+            _compileCache.popitem(last=False)
+    return compiled
+
+
+def _as_array(value):
+    if isinstance(value, range):
+        return np.arange(value.start, value.stop, value.step, dtype=float)
+    return np.asarray(value, dtype=float)
+
+
+def _resolve_values(variables, values):
+    """把 {变量或变量名: 取值} 转换为按 variables 顺序排列的参数"""
+    values = values or {}
+    byName = {getattr(k, "name", k): v for k, v in values.items()}
+    args = []
+    for symbol in variables:
+        if symbol.name not in byName:
+            raise ValueError(f"缺少变量 {symbol.name} 的取值")
+        args.append(_as_array(byName[symbol.name]))
+    return args
+
+
+def evaluate(expr, values=None, exact=False):
+    """
+    对表达式求值
+
+    - values: {变量或变量名: 标量 / 数组 / range}，各变量的数组按NumPy规则广播
+    - exact: 为True时用 evalf 逐个精确计算，否则使用编译后的向量化函数
+    """
+    variables = _sorted_symbols(expr)
+    args = _resolve_values(variables, values)
+    if not exact:
+        return compile_expression(expr, variables)(*args)
+
+    arrays = np.broadcast_arrays(*args) if args else []
+    shape = arrays[0].shape if arrays else ()
+    result = np.empty(shape, dtype=object)
+    for index in np.ndindex(shape):
+        subs = {symbol: sympy.Float(array[index]) for symbol, array in zip(variables, arrays)}
+        result[index] = expr.evalf(subs=subs)
+    return result if shape else result[()]
+
+
+def value_table(expr, variable, start, stop, num=50):
+    """在 [start, stop] 上均匀取 num 个点，返回 (取值, 结果)"""
+    xs = np.linspace(start, stop, num)
+    return xs, evaluate(expr, {variable: xs})
@@ -0,0 +1,192 @@
+"""
+数值求根
+
+sympy.solve 找不到解析解（例如 sin(x)=x/3 这样的超越方程）或超时时使用。
+方程只用 lambdify 编译一次，之后所有初始点一起向量化计算：
+
+- 一元方程：在区间内密集采样，对每个变号的小区间用 brentq 求根，
+  |f| 的局部极小值接近0的地方（不变号的重根）再单独精化
+- 方程组：在区间内取网格状的多个初始点，所有初始点同时做阻尼牛顿迭代
+  （雅可比矩阵同样编译为向量化函数），未完全收敛的再用 scipy.optimize.root 精化
+
+结果去重后连同残差一起返回，只包含区间内的实数解。在求解进程中执行，
+与 sympy.solve 一样受超时和内存上限的约束。
+"""
+import itertools
+
+import numpy as np
+import sympy
+
+import numeric
+from structured_solve import to_expressions
+
+# 默认的搜索区间（每个变量）
+DEFAULT_BOUNDS = (-10.0, 10.0)
+# 一元方程的采样点数
+SCAN_POINTS = 4001
+# 方程组每个变量方向上的初始点数（总数为其 n 次方，按变量个数取值）
+STARTS_PER_AXIS = {2: 24, 3: 9}
+# 超过3个变量时使用的随机初始点数
+RANDOM_STARTS = 1024
+NEWTON_ITERATIONS = 40
+# 残差小于该值的点视为根
+RESIDUAL_TOLERANCE = 1e-8
+# |f| 的局部极小值小于该值时才尝试寻找不变号的重根
+TANGENT_THRESHOLD = 1e-3
+# 距离小于该值的根视为同一个
+DEDUP_TOLERANCE = 1e-6
+
+
+class NumericRoots(list):
+    """
+    数值解的列表（一元方程为数值，方程组为 {变量: 值}），与 sympy.solve 的结果形式相同
+
+    - residuals: 与每个解对应的残差（各方程绝对值的最大值）
+    - bounds: 搜索区间
+    """
+
+    def __init__(self, solutions=(), residuals=(), bounds=DEFAULT_BOUNDS):
+        super().__init__(solutions)
+        self.residuals = list(residuals)
+        self.bounds = bounds
+
+    def __str__(self):
+        if not self:
+            return f"在区间 [{self.bounds[0]:g}, {self.bounds[1]:g}] 内没有找到实数解"
+        residual = max(self.residuals) if self.residuals else 0.0
+        return f"{list.__repr__(self)}（数值解，区间 [{self.bounds[0]:g}, {self.bounds[1]:g}]，最大残差 {residual:.1e}）"
+
+
+def _dedup(points, residuals):
+    """按距离去重，保留残差较小的一个；points 为 (个数, 变量数) 数组"""
+    order = np.argsort(residuals, kind="stable")
+    kept = []
+    for index in order:
+        point = points[index]
+        if all(np.max(np.abs(point - points[other])) > DEDUP_TOLERANCE * (1 + np.max(np.abs(point)))
+               for other in kept):
+            kept.append(index)
+    # 按第一个变量（再按后面的变量）从小到大排列
+    kept.sort(key=lambda index: tuple(points[index]))
+    return kept
+
+
+def _scalar_roots(compiled, bounds):
+    from scipy.optimize import brentq, minimize_scalar
+
+    def f(value):
+        return float(compiled.real(value))
+
+    xs = np.linspace(bounds[0], bounds[1], SCAN_POINTS)
+    ys = compiled.real(xs)
+    finite = np.isfinite(ys)
+    candidates = list(xs[finite & (ys == 0)])
+
+    # 变号的小区间：brentq 保证收敛，之后用残差排除极点（例如 tan 的间断处）
+    signs = np.sign(ys)
+    brackets = np.flatnonzero(finite[:-1] & finite[1:] & (signs[:-1] * signs[1:] < 0))
+    for index in brackets:
+        candidates.append(brentq(f, xs[index], xs[index + 1], xtol=1e-15, rtol=4 * np.finfo(float).eps))
+
+    # |f| 的局部极小值：不变号的重根（例如 (x-1)^2 e^x = 0）
+    magnitude = np.where(finite, np.abs(ys), np.inf)
+    minima = np.flatnonzero((magnitude[1:-1] < magnitude[:-2]) & (magnitude[1:-1] < magnitude[2:])) + 1
+    for index in minima[magnitude[minima] < TANGENT_THRESHOLD]:
+        result = minimize_scalar(lambda value: abs(f(value)), bounds=(xs[index - 1], xs[index + 1]),
+                                 method="bounded", options={"xatol": 1e-14})
+        candidates.append(result.x)
+
+    roots, residuals = [], []
+    for value in candidates:
+        residual = abs(f(value))
+        if np.isfinite(residual) and residual <= RESIDUAL_TOLERANCE:
+            roots.append([value])
+            residuals.append(residual)
+    return np.array(roots).reshape(-1, 1), np.array(residuals)
+
+
+def _starts(count, bounds):
+    """均匀网格（变量较多时改为固定种子的随机点）上的初始点，形状为 (变量数, 个数)"""
+    perAxis = STARTS_PER_AXIS.get(count)
+    if perAxis is None:
+        return np.random.default_rng(0).uniform(bounds[0], bounds[1], (count, RANDOM_STARTS))
+    # 错开边界，避免对称方程的初始点正好落在对称轴上
+    axis = np.linspace(bounds[0], bounds[1], perAxis + 2)[1:-1] + 1e-3
+    return np.array(list(itertools.product(axis, repeat=count))).T
+
+
+def _system_roots(expressions, symbols, bounds):
+    from scipy.optimize import root
+
+    functions = [numeric.compile_expression(expr, symbols) for expr in expressions]
+    jacobian = [[numeric.compile_expression(sympy.diff(expr, symbol), symbols) for symbol in symbols]
+                for expr in expressions]
+
+    def residual(points):
+        return np.stack([function.real(*points) for function in functions])
+
+    def jacobian_at(points):
+        # (个数, 方程, 变量)
+        return np.stack([np.stack([entry.real(*points) for entry in row]) for row in jacobian]).transpose(2, 0, 1)
+
+    # 所有初始点同时做阻尼牛顿迭代，走到无定义处的点不再继续
+    points = _starts(len(symbols), bounds)
+    indices = np.arange(points.shape[1])
+    span = bounds[1] - bounds[0]
+    with np.errstate(all="ignore"):
+        for _ in range(NEWTON_ITERATIONS):
+            current = points[:, indices]
+            values = residual(current)
+            matrices = jacobian_at(current)
+            usable = np.isfinite(values).all(axis=0) & np.isfinite(matrices).all(axis=(1, 2))
+            indices, current, values, matrices = indices[usable], current[:, usable], values[:, usable], matrices[usable]
+            if not indices.size or np.max(np.abs(values)) < 1e-15:
+                break
+            step = np.einsum("kij,jk->ik", np.linalg.pinv(matrices), values)
+            # 每一步的长度不超过区间宽度的四分之一
+            length = np.max(np.abs(step), axis=0)
+            step *= np.minimum(1.0, span / 4 / np.where(length > 0, length, 1.0))
+            points[:, indices] = current - step
+        errors = np.max(np.abs(residual(points[:, indices])), axis=0) if indices.size else np.empty(0)
+
+    roots, residuals = [], []
+    for index, error in zip(indices, errors):
+        if not np.isfinite(error) or error >= 1e-3:
+            continue
+        point = points[:, index]
+        if error > RESIDUAL_TOLERANCE:
+            # 没有完全收敛的点用 MINPACK 精化
+            result = root(lambda p: residual(p.reshape(-1, 1)).ravel(), point,
+                          jac=lambda p: jacobian_at(p.reshape(-1, 1))[0])
+            point = result.x
+            error = float(np.max(np.abs(residual(point.reshape(-1, 1)))))
+        if error <= RESIDUAL_TOLERANCE and np.all((point >= bounds[0]) & (point <= bounds[1])):
+            roots.append(point)
+            residuals.append(error)
+    return np.array(roots).reshape(-1, len(symbols)), np.array(residuals)
+
+
+def find_roots(target, bounds=DEFAULT_BOUNDS):
+    """
+    在区间内寻找方程（组）的所有实数解，返回 NumericRoots
+
+    target 与 sympy.solve 的参数相同；方程个数与变量个数不同、或含有不等式时返回None。
+    """
+    expressions = to_expressions(target)
+    if not expressions:
+        return None
+    symbols = tuple(sorted(set().union(*(expr.free_symbols for expr in expressions)), key=lambda s: s.name))
+    if not symbols or len(symbols) != len(expressions):
+        return None
+    bounds = (float(bounds[0]), float(bounds[1]))
+    if len(symbols) == 1:
+        points, residuals = _scalar_roots(numeric.compile_expression(expressions[0], symbols), bounds)
+    else:
+        points, residuals = _system_roots(expressions, symbols, bounds)
+    kept = _dedup(points, residuals)
+    if len(symbols) == 1:
+        solutions = [sympy.Float(points[index][0]) for index in kept]
+    else:
+        solutions = [{symbol: sympy.Float(value) for symbol, value in zip(symbols, points[index])}
+                     for index in kept]
+    return NumericRoots(solutions, [float(residuals[index]) for index in kept], bounds)
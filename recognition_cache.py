@@ -0,0 +1,153 @@
+"""
+公式识别缓存
+
+以选区内笔迹的内容作为键缓存识别出的LaTeX：先灰度化、二值化，再裁剪到笔迹的
+包围盒，因此选区稍微偏移几个像素也能命中。内存层按字节预算做LRU淘汰，
+可选的磁盘层在重启后依然有效。
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# 灰度低于该值的像素视为笔迹
+INK_THRESHOLD = 128
+
+
+def ink_key(image, extra=""):
+    """
+    计算图像笔迹的内容哈希
+
+    image 可以是PIL图像或NumPy数组；extra 会一并参与哈希（例如识别参数）。
+    """
+    pixels = np.asarray(image)
+    if pixels.ndim == 3:
+        # 只取颜色通道求平均，忽略透明通道
+        gray = pixels[..., :3].mean(axis=2)
+    else:
+        gray = pixels
+    ink = gray < INK_THRESHOLD
+
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    if rows.size:
+        ink = ink[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    else:
+        ink = ink[:0, :0]
+
+    digest = hashlib.sha1()
+    digest.update(f"{ink.shape[0]}x{ink.shape[1]}|{extra}|".encode("utf-8"))
+    digest.update(np.packbits(ink).tobytes())
+    return digest.hexdigest()
+
+
+class RecognitionCache:
+    """
+    图像 -> LaTeX 的缓存
+
+    - maxBytes: 内存层的字节预算，超出后淘汰最久未使用的条目
+    - diskDir: 可选的磁盘层目录，为None时只使用内存
+    - 每个条目记录当时的推理耗时，命中时累加到 savedSeconds
+    """
+
+    # 每个条目除文本之外的估算开销（键、OrderedDict节点等）
+    ENTRY_OVERHEAD = 128
+
+    def __init__(self, maxBytes=4 * 1024 * 1024, diskDir=None):
+        self.maxBytes = maxBytes
+        self.diskDir = diskDir
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.savedSeconds = 0.0
+        if diskDir:
+            os.makedirs(diskDir, exist_ok=True)
+
+    def _entry_size(self, latex):
+        return len(latex.encode("utf-8")) + self.ENTRY_OVERHEAD
+
+    def _put_memory(self, key, latex, seconds):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= self._entry_size(old[0])
+        self._entries[key] = (latex, seconds)
+        self._bytes += self._entry_size(latex)
+        while self._bytes > self.maxBytes and self._entries:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self._bytes -= self._entry_size(evicted)
+
+    def _disk_path(self, key):
+        return os.path.join(self.diskDir, key[:2], key + ".tex")
+
+    def _read_disk(self, key):
+        if not self.diskDir:
+            return None
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                seconds, latex = f.read().split("\n", 1)
+            return latex, float(seconds)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, latex, seconds):
+        if not self.diskDir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmpPath = path + ".tmp"
+            with open(tmpPath, "w", encoding="utf-8") as f:
+                f.write(f"{seconds}\n{latex}")
+            os.replace(tmpPath, path)
+        except OSError as e:
+            print(f"写入识别缓存失败: {str(e)}")
+
+    def get(self, key):
+        """查询缓存，未命中时返回None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.savedSeconds += entry[1]
+                return entry[0]
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self._put_memory(key, entry[0], entry[1])
+            self.hits += 1
+            self.diskHits += 1
+            self.savedSeconds += entry[1]
+            return entry[0]
+
+    def put(self, key, latex, seconds=0.0):
+        """写入缓存，seconds为本次识别的推理耗时"""
+        with self._lock:
+            self._put_memory(key, latex, seconds)
+        self._write_disk(key, latex, seconds)
+
+    def clear(self):
+        """清空内存层（磁盘层保留）"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "disk_hits": self.diskHits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_seconds": self.savedSeconds,
+            }
@@ -0,0 +1,176 @@
+"""
+公式识别服务
+
+整个进程只持有一个懒加载的 Pix2Text 实例，第一次识别（或后台预热）时构建，
+之后的识别只需要付出推理的开销，不再重复从磁盘加载模型。
+"""
+import gc
+import os
+import threading
+import time
+
+import startup
+from recognition_cache import RecognitionCache, ink_key
+
+
+class FormulaRecognizer:
+    """
+    进程级的 Pix2Text 持有者
+
+    - ensure_loaded(): 需要时构建模型（线程安全，只会构建一次）
+    - warm_up(): 在后台线程中预热模型，不阻塞调用者
+    - unload()/reload(): 显式释放或重新加载模型（等待正在进行的加载或推理结束）
+    - unload_async()/reload_async(): 在后台线程中释放或重新加载，供界面线程调用
+    - recognize_formula(): 使用常驻模型识别公式，结果按笔迹内容缓存
+    - recognize_formulas(): 一次批量推理识别多张公式图片
+    """
+
+    def __init__(self, factory=None, cache=None):
+        # factory 用于构建模型，默认为 Pix2Text()，便于替换配置
+        self._factory = factory
+        if cache is None:
+            # 设置 MATHNOTE_RECOGNITION_CACHE 为目录时启用磁盘缓存
+            cache = RecognitionCache(diskDir=os.environ.get("MATHNOTE_RECOGNITION_CACHE") or None)
+        self.cache = cache
+        self._model = None
+        # 加载和推理期间一直持有，可能长达数秒
+        self._lock = threading.RLock()
+        # 只保护后台线程的启动，界面线程只获取这个锁
+        self._threadLock = threading.Lock()
+        self._warmupThread = None
+        self.loadTime = 0.0
+        self.loadError = None
+
+    def _create_model(self):
+        if self._factory is not None:
+            return self._factory()
+        from pix2text import Pix2Text
+        return Pix2Text()
+
+    @property
+    def is_loaded(self):
+        return self._model is not None
+
+    def ensure_loaded(self):
+        """返回常驻模型，尚未加载时在当前线程中加载"""
+        with self._lock:
+            if self._model is None:
+                start = time.perf_counter()
+                try:
+                    with startup.phase("加载识别模型"):
+                        self._model = self._create_model()
+                    self.loadError = None
+                except Exception as e:
+                    self.loadError = e
+                    raise
+                self.loadTime = time.perf_counter() - start
+                print(f"识别模型加载完成，用时 {self.loadTime:.2f}s")
+            return self._model
+
+    def warm_up(self):
+        """在后台线程中加载模型，已加载或正在加载时直接返回"""
+        with self._threadLock:
+            if self._model is not None:
+                return
+            if self._warmupThread is not None and self._warmupThread.is_alive():
+                return
+            self._warmupThread = threading.Thread(
+                target=self._warm_up_worker, name="FormulaRecognizerWarmUp", daemon=True
+            )
+            self._warmupThread.start()
+
+    def _warm_up_worker(self):
+        try:
+            self.ensure_loaded()
+        except Exception as e:
+            print(f"预热识别模型时出错: {str(e)}")
+
+    def unload(self):
+        """释放常驻模型及其占用的内存"""
+        with self._lock:
+            if self._model is None:
+                return
+            self._model = None
+        gc.collect()
+
+    def reload(self):
+        """丢弃当前模型并重新加载"""
+        with self._lock:
+            self.unload()
+            return self.ensure_loaded()
+
+    def unload_async(self):
+        """在后台线程中释放模型，正在加载或推理时等它结束后再释放"""
+        threading.Thread(target=self.unload, name="FormulaRecognizerUnload", daemon=True).start()
+
+    def reload_async(self):
+        """在后台线程中重新加载模型"""
+        with self._threadLock:
+            self._warmupThread = threading.Thread(
+                target=self._reload_worker, name="FormulaRecognizerReload", daemon=True
+            )
+            self._warmupThread.start()
+
+    def _reload_worker(self):
+        try:
+            self.reload()
+        except Exception as e:
+            print(f"重新加载识别模型时出错: {str(e)}")
+
+    def recognize_formula(self, image, **kwargs):
+        """使用常驻模型识别公式图片，返回LaTeX文本"""
+        kwargs.setdefault("return_text", True)
+        key = None
+        if kwargs["return_text"]:
+            key = ink_key(image, repr(sorted(kwargs.items())))
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        with self._lock:
+            model = self.ensure_loaded()
+            start = time.perf_counter()
+            result = model.recognize_formula(image, **kwargs)
+            elapsed = time.perf_counter() - start
+        if key is not None and isinstance(result, str):
+            self.cache.put(key, result, elapsed)
+        return result
+
+    def recognize_formulas(self, images, **kwargs):
+        """
+        识别多张公式图片，返回与 images 一一对应的LaTeX列表
+
+        命中缓存的图片不再推理，其余的在一次批量推理中完成。
+        """
+        kwargs["return_text"] = True
+        extra = repr(sorted(kwargs.items()))
+        keys = [ink_key(image, extra) for image in images]
+        results = [self.cache.get(key) for key in keys]
+        missing = [index for index, result in enumerate(results) if result is None]
+        if not missing:
+            return results
+        with self._lock:
+            model = self.ensure_loaded()
+            start = time.perf_counter()
+            recognized = model.recognize_formula(
+                [images[index] for index in missing], batch_size=len(missing), **kwargs
+            )
+            elapsed = time.perf_counter() - start
+        # 批量推理的耗时平均分摊到每个条目
+        for index, result in zip(missing, recognized):
+            results[index] = result
+            if isinstance(result, str):
+                self.cache.put(keys[index], result, elapsed / len(missing))
+        return results
+
+
+_recognizer = None
+_recognizerLock = threading.Lock()
+
+
+def get_recognizer():
+    """获取进程内共享的识别服务"""
+    global _recognizer
+    with _recognizerLock:
+        if _recognizer is None:
+            _recognizer = FormulaRecognizer()
+        return _recognizer
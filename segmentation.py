@@ -0,0 +1,116 @@
+"""
+把一个选区分割成多个公式
+
+基于投影轮廓：先按空白行把笔迹切成若干行，再把每一行按足够宽的空白列切成
+并排的公式块。切分阈值与行高成比例，分数线、上下标之间较窄的空白不会被切开；
+只有一条横线（例如被切出来的分数线）这样过矮的片段会并回相邻的行：横向覆盖了上下
+两行的横线是分数线，与分子、分母合并为一个公式。
+全部是对笔迹掩码的向量化运算，不依赖连通域标记。
+"""
+import numpy as np
+
+# 两行公式之间至少需要的空白行数（像素）
+MIN_ROW_GAP = 12
+# 同一行内两个公式之间的空白至少为行高的倍数，且不少于 MIN_COLUMN_GAP 像素
+COLUMN_GAP_RATIO = 1.5
+MIN_COLUMN_GAP = 32
+# 低于该高度（像素）的行视为分数线等碎片，并入相邻的行
+MIN_LINE_HEIGHT = 8
+# 相邻行的横向范围至少有该比例落在横线之内时，视为被横线覆盖（分子或分母）
+COVER_RATIO = 0.8
+
+
+def _runs(profile, minGap):
+    """
+    把一维投影切成有笔迹的区间 [(start, end), ...]，end 不含
+
+    长度小于 minGap 的空白不会切开区间。
+    """
+    filled = np.flatnonzero(profile)
+    if not filled.size:
+        return []
+    # 相邻两个有笔迹的位置之间的空白长度
+    gaps = np.diff(filled) - 1
+    breaks = np.flatnonzero(gaps >= minGap)
+    starts = np.concatenate(([filled[0]], filled[breaks + 1]))
+    ends = np.concatenate((filled[breaks] + 1, [filled[-1] + 1]))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def _overlap(first, second):
+    """两行横向范围重叠的宽度；两者都是 (top, bottom, left, right)"""
+    return min(first[3], second[3]) - max(first[2], second[2])
+
+
+def _covers(bar, line):
+    """line 的横向范围是否大部分落在 bar 之内"""
+    return _overlap(bar, line) >= COVER_RATIO * (line[3] - line[2])
+
+
+def _join(first, second):
+    return (min(first[0], second[0]), max(first[1], second[1]),
+            min(first[2], second[2]), max(first[3], second[3]))
+
+
+def _merge_thin(lines, minHeight):
+    """
+    把过矮的行并入相邻的行，lines 为 [(top, bottom, left, right), ...]
+
+    横向覆盖了上下两行的矮行（分数线）同时并入上下两行；否则并入被它覆盖的一行，
+    其次是横向范围与它重叠的一行，都没有时并入距离更近的一行。
+    """
+    lines = list(lines)
+    index = 0
+    while len(lines) > 1 and index < len(lines):
+        line = lines[index]
+        if line[1] - line[0] >= minHeight:
+            index += 1
+            continue
+        above = lines[index - 1] if index > 0 else None
+        below = lines[index + 1] if index + 1 < len(lines) else None
+        coversAbove = above is not None and _covers(line, above)
+        coversBelow = below is not None and _covers(line, below)
+        if coversAbove and coversBelow:
+            # 分子、分数线和分母是同一个公式
+            lines[index - 1:index + 2] = [_join(_join(above, line), below)]
+            index -= 1
+            continue
+        overlapsAbove = above is not None and _overlap(line, above) > 0
+        overlapsBelow = below is not None and _overlap(line, below) > 0
+        if coversAbove != coversBelow:
+            mergeAbove = coversAbove
+        elif overlapsAbove != overlapsBelow:
+            mergeAbove = overlapsAbove
+        else:
+            mergeAbove = below is None or (above is not None and line[0] - above[1] <= below[0] - line[1])
+        if mergeAbove:
+            lines[index - 1:index + 1] = [_join(above, line)]
+            index -= 1
+        else:
+            lines[index:index + 2] = [_join(line, below)]
+    return lines
+
+
+def _line_extent(ink, top, bottom):
+    cols = np.flatnonzero(ink[top:bottom].any(axis=0))
+    return top, bottom, int(cols[0]), int(cols[-1]) + 1
+
+
+def segment_ink(ink, minRowGap=MIN_ROW_GAP, columnGapRatio=COLUMN_GAP_RATIO,
+                minColumnGap=MIN_COLUMN_GAP, minLineHeight=MIN_LINE_HEIGHT):
+    """
+    在笔迹掩码中寻找各个公式
+
+    返回按阅读顺序（从上到下、从左到右）排列的包围盒 [(top, bottom, left, right), ...]，
+    bottom/right 不含；没有笔迹时返回空列表。
+    """
+    segments = []
+    lines = [_line_extent(ink, top, bottom) for top, bottom in _runs(ink.any(axis=1), minRowGap)]
+    for top, bottom, _, _ in _merge_thin(lines, minLineHeight):
+        band = ink[top:bottom]
+        columnGap = max(minColumnGap, int((bottom - top) * columnGapRatio))
+        for left, right in _runs(band.any(axis=0), columnGap):
+            # 收紧到该块自身的上下边界
+            rows = np.flatnonzero(band[:, left:right].any(axis=1))
+            segments.append((top + int(rows[0]), top + int(rows[-1]) + 1, left, right))
+    return segments
@@ -0,0 +1,333 @@
+"""
+沙箱求解引擎
+
+sympy.solve / evalf / 按结构的快速求解 / 数值求根在可复用的子进程池中执行，每个任务都有墙钟超时和内存上限。
+超时、超出内存或被取消的任务所在的进程会被直接杀掉并补充新的进程，
+应用本身不受影响。结果以 SolveResult 返回，而不是混杂的错误字符串。
+"""
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import time
+
+# 默认的单个任务超时（秒）和每个求解进程的内存上限（字节）
+DEFAULT_TIMEOUT = float(os.environ.get("MATHNOTE_SOLVE_TIMEOUT", "10"))
+DEFAULT_MEMORY_LIMIT = int(os.environ.get("MATHNOTE_SOLVE_MEMORY_MB", "1536")) * 1024 * 1024
+DEFAULT_WORKERS = 2
+
+# 等待结果时检查取消标志的间隔（秒）
+POLL_INTERVAL = 0.05
+# 等待空闲进程时重新判断是否需要启动新进程的间隔（秒）
+ACQUIRE_RECHECK = 0.5
+
+
+class SolveResult:
+    """
+    一次求解/计算的结构化结果
+
+    - status: OK / TIMEOUT / MEMORY / CANCELLED / ERROR
+    - solutions: 求解结果（status为OK时有效）
+    - elapsed: 墙钟耗时（秒）
+    - error: 失败原因
+    """
+    OK = "ok"
+    TIMEOUT = "timeout"
+    MEMORY = "memory"
+    CANCELLED = "cancelled"
+    ERROR = "error"
+
+    __slots__ = ("status", "solutions", "elapsed", "error")
+
+    def __init__(self, status, solutions=None, elapsed=0.0, error=None):
+        self.status = status
+        self.solutions = solutions
+        self.elapsed = elapsed
+        self.error = error
+
+    @classmethod
+    def failure(cls, error, elapsed=0.0):
+        return cls(cls.ERROR, elapsed=elapsed, error=error)
+
+    @property
+    def ok(self):
+        return self.status == self.OK
+
+    def unwrap(self):
+        """返回求解结果，失败时抛出 SolverError"""
+        if not self.ok:
+            raise SolverError(self)
+        return self.solutions
+
+    def to_dict(self):
+        return {
+            "status": self.status,
+            "solutions": None if self.solutions is None else str(self.solutions),
+            "elapsed": self.elapsed,
+            "error": self.error,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """由 to_dict 的结果重建，solutions 为其文本形式"""
+        return cls(data["status"], data.get("solutions"), data.get("elapsed", 0.0), data.get("error"))
+
+    def __str__(self):
+        if self.ok:
+            return str(self.solutions)
+        if self.status == self.TIMEOUT:
+            return f"计算超时（超过 {self.elapsed:.1f}s）"
+        if self.status == self.MEMORY:
+            return "计算错误: 超出内存限制"
+        if self.status == self.CANCELLED:
+            return "计算已取消"
+        return f"计算错误: {self.error}"
+
+    def __repr__(self):
+        return f"SolveResult({self.status!r}, {self.solutions!r}, elapsed={self.elapsed:.3f}, error={self.error!r})"
+
+
+class SolverError(Exception):
+    """求解失败（超时、超出内存或出错），result 为对应的 SolveResult"""
+
+    def __init__(self, result):
+        super().__init__(str(result))
+        self.result = result
+
+
+def _run_job(kind, payload, options):
+    import sympy
+    if kind == "solve":
+        return sympy.solve(payload, **options)
+    if kind == "evalf":
+        return payload.evalf(**options)
+    if kind == "nsolve":
+        from numeric_solve import find_roots
+        return find_roots(payload, **options)
+    if kind == "structured":
+        # 不属于线性方程组或一元多项式时结果为None
+        from structured_solve import solve_structured
+        result = solve_structured(payload)
+        return None if result is None else result.solutions
+    raise ValueError(f"未知的任务类型: {kind}")
+
+
+def _worker_main(conn, memoryLimit):
+    """求解进程的主循环"""
+    if memoryLimit:
+        try:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (memoryLimit, memoryLimit))
+        except (ImportError, ValueError, OSError):
+            # Windows 等平台不支持 RLIMIT_AS，只保留超时限制
+            pass
+    import sympy  # noqa: F401  预先导入，第一次求解时不再付出导入开销
+    while True:
+        try:
+            kind, payload, options = conn.recv()
+        except (EOFError, OSError):
+            return
+        except MemoryError:
+            conn.send((SolveResult.MEMORY, "超出内存限制"))
+            return
+        try:
+            conn.send((SolveResult.OK, _run_job(kind, payload, options)))
+        except MemoryError:
+            # 内存分配失败后进程状态不可靠，报告后退出，由引擎补充新进程
+            conn.send((SolveResult.MEMORY, "超出内存限制"))
+            return
+        except Exception as e:
+            conn.send((SolveResult.ERROR, str(e)))
+
+
+class _Worker:
+    def __init__(self, context, memoryLimit):
+        self.conn, childConn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(childConn, memoryLimit),
+            name="MathNoteSolver", daemon=True
+        )
+        self.process.start()
+        childConn.close()
+
+    def kill(self):
+        try:
+            self.process.kill()
+            self.process.join(1)
+        except Exception:
+            pass
+        self.conn.close()
+
+
+class SolverEngine:
+    """
+    可复用的求解进程池
+
+    solve()/evaluate() 会阻塞调用线程直到得到结果，应在后台线程中调用。
+    无法创建子进程的平台（例如部分安卓环境）会退回到在当前进程中直接计算。
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT, memoryLimit=DEFAULT_MEMORY_LIMIT):
+        self.maxWorkers = workers
+        self.timeout = timeout
+        self.memoryLimit = memoryLimit
+        # spawn 避免在多线程的Qt进程中fork
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        self._count = 0
+        self._lock = threading.Lock()
+        self._inline = False
+        self.killed = 0
+
+    def _spawn(self):
+        return _Worker(self._context, self.memoryLimit)
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                spawn = self._idle.empty() and self._count < self.maxWorkers
+                if spawn:
+                    self._count += 1
+            if spawn:
+                try:
+                    return self._spawn()
+                except Exception:
+                    with self._lock:
+                        self._count -= 1
+                    raise
+            try:
+                return self._idle.get(timeout=ACQUIRE_RECHECK)
+            except queue.Empty:
+                # 后台补充进程失败时进程数会减少，等待者需要重新判断是否由自己启动
+                continue
+
+    def _release(self, worker):
+        self._idle.put(worker)
+
+    def _replace(self, worker):
+        """杀掉失控的进程，并在后台补充一个新进程"""
+        worker.kill()
+        self.killed += 1
+
+        def replenish():
+            try:
+                self._idle.put(self._spawn())
+            except Exception as e:
+                with self._lock:
+                    self._count -= 1
+                print(f"补充求解进程失败: {str(e)}")
+        threading.Thread(target=replenish, name="MathNoteSolverSpawn", daemon=True).start()
+
+    def warm_up(self):
+        """在后台预先启动求解进程"""
+        def worker():
+            try:
+                self._release(self._acquire())
+            except Exception as e:
+                print(f"启动求解进程失败: {str(e)}")
+        threading.Thread(target=worker, name="MathNoteSolverWarmUp", daemon=True).start()
+
+    def _run_inline(self, kind, payload, options, start):
+        try:
+            return SolveResult(SolveResult.OK, _run_job(kind, payload, options), time.perf_counter() - start)
+        except Exception as e:
+            return SolveResult.failure(str(e), time.perf_counter() - start)
+
+    def run(self, kind, payload, options=None, timeout=None, cancelEvent=None):
+        """执行一个任务，返回 SolveResult"""
+        options = options or {}
+        timeout = self.timeout if timeout is None else timeout
+        start = time.perf_counter()
+        if self._inline:
+            return self._run_inline(kind, payload, options, start)
+        try:
+            worker = self._acquire()
+        except Exception as e:
+            print(f"无法启动求解进程，改为在当前进程中计算: {str(e)}")
+            self._inline = True
+            return self._run_inline(kind, payload, options, start)
+
+        try:
+            worker.conn.send((kind, payload, options))
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            self._release(worker)
+            return SolveResult.failure(f"无法发送求解任务: {str(e)}", time.perf_counter() - start)
+        except (EOFError, OSError) as e:
+            self._replace(worker)
+            return SolveResult.failure(f"求解进程已退出: {str(e)}", time.perf_counter() - start)
+
+        # 超时从任务发出后开始计算，不包括等待空闲进程的时间
+        deadline = time.perf_counter() + timeout
+        try:
+            while True:
+                if cancelEvent is not None and cancelEvent.is_set():
+                    self._replace(worker)
+                    return SolveResult(SolveResult.CANCELLED, elapsed=time.perf_counter() - start)
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._replace(worker)
+                    return SolveResult(SolveResult.TIMEOUT, elapsed=time.perf_counter() - start,
+                                       error=f"超过 {timeout:.1f}s 未完成")
+                if worker.conn.poll(min(remaining, POLL_INTERVAL)):
+                    status, value = worker.conn.recv()
+                    break
+        except (EOFError, OSError):
+            # 进程被系统杀掉（通常是内存不足）
+            self._replace(worker)
+            return SolveResult(SolveResult.MEMORY, elapsed=time.perf_counter() - start,
+                               error="求解进程意外退出")
+
+        elapsed = time.perf_counter() - start
+        if status == SolveResult.MEMORY:
+            self._replace(worker)
+            return SolveResult(SolveResult.MEMORY, elapsed=elapsed, error=value)
+        self._release(worker)
+        if status == SolveResult.OK:
+            return SolveResult(SolveResult.OK, value, elapsed)
+        return SolveResult.failure(value, elapsed)
+
+    def solve(self, equations, timeout=None, cancelEvent=None, **options):
+        """在子进程中执行 sympy.solve"""
+        return self.run("solve", equations, options, timeout, cancelEvent)
+
+    def evaluate(self, expr, timeout=None, cancelEvent=None, **options):
+        """在子进程中执行 expr.evalf"""
+        return self.run("evalf", expr, options, timeout, cancelEvent)
+
+    def nsolve(self, equations, timeout=None, cancelEvent=None, **options):
+        """在子进程中执行多初始点的数值求根（numeric_solve.find_roots）"""
+        return self.run("nsolve", equations, options, timeout, cancelEvent)
+
+    def structured(self, equations, timeout=None, cancelEvent=None):
+        """
+        在子进程中按结构快速求解（structured_solve.solve_structured）
+
+        大次数多项式的因式分解同样可能很慢，因此也受超时、内存上限和取消的约束。
+        不属于线性方程组或一元多项式时返回 status 为OK、solutions 为None的结果。
+        """
+        return self.run("structured", equations, None, timeout, cancelEvent)
+
+    def shutdown(self):
+        """结束所有空闲的求解进程"""
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.kill()
+            with self._lock:
+                self._count -= 1
+
+
+_engine = None
+_engineLock = threading.Lock()
+
+
+def get_solver_engine():
+    """获取进程内共享的求解引擎"""
+    global _engine
+    with _engineLock:
+        if _engine is None:
+            _engine = SolverEngine()
+        return _engine
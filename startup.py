@@ -0,0 +1,97 @@
+"""
+启动耗时统计
+
+设置环境变量 MATHNOTE_STARTUP_TRACE=1 或使用 --startup-trace 参数启动时，记录每个
+启动阶段（导入、创建窗口、首次绘制、后台预热等）和每个顶层模块首次导入的耗时，
+退出时把按开始时间排序的报告打印到标准错误输出。未启用时 phase/mark 几乎没有开销。
+
+在程序中：
+    with startup.phase("创建主窗口"):
+        ...
+    startup.mark("首次绘制")
+"""
+import atexit
+import builtins
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# 以本模块被导入的时刻作为启动时刻（main.py 第一个导入本模块）
+_T0 = time.perf_counter()
+
+enabled = os.environ.get("MATHNOTE_STARTUP_TRACE") == "1" or "--startup-trace" in sys.argv
+
+_records = []
+_lock = threading.Lock()
+_local = threading.local()
+_marked = set()
+
+
+def elapsed():
+    """距离启动的秒数"""
+    return time.perf_counter() - _T0
+
+
+def _record(kind, name, start, duration):
+    with _lock:
+        _records.append((start - _T0, duration, kind, name, threading.current_thread().name))
+
+
+@contextmanager
+def phase(name):
+    """记录一个启动阶段的耗时"""
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record("阶段", name, start, time.perf_counter() - start)
+
+
+def mark(name, once=True):
+    """记录一个时间点（例如首次绘制），once 为True时同名的点只记录第一次"""
+    if not enabled:
+        return
+    if once:
+        with _lock:
+            if name in _marked:
+                return
+            _marked.add(name)
+    now = time.perf_counter()
+    _record("时刻", name, now, 0.0)
+    print(f"[startup] {name}: {(now - _T0) * 1000:.1f}ms", file=sys.stderr)
+
+
+_original_import = builtins.__import__
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    # 只统计每个线程最外层、且是第一次导入的模块，嵌套导入的时间计入外层
+    if level != 0 or getattr(_local, "depth", 0) or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    _local.depth = 1
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _local.depth = 0
+        _record("导入", name, start, time.perf_counter() - start)
+
+
+def report(file=None):
+    """打印所有记录，按开始时间排序"""
+    file = file or sys.stderr
+    with _lock:
+        records = sorted(_records)
+    print(f"{'开始':>10s} {'耗时':>10s}  {'类型':4s} {'线程':12s} 名称", file=file)
+    for start, duration, kind, name, thread in records:
+        print(f"{start * 1000:8.1f}ms {duration * 1000:8.1f}ms  {kind:4s} {thread[:12]:12s} {name}", file=file)
+
+
+if enabled:
+    builtins.__import__ = _timed_import
+    atexit.register(report)
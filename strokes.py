@@ -0,0 +1,402 @@
+"""
+笔画绘制与矢量场景
+
+StrokeRenderer 每次只把新增的几段光栅化到画布上，调用方只需要刷新这些段
+（含线宽）的包围矩形。输入事件只把点加入队列，每一帧绘制前一次性画出队列中
+的所有段，高频的输入（手写板、触摸）不会让每个事件都付出一次绘制的开销。
+每段的线宽可以随压感变化。
+
+完成的笔画用 Ramer–Douglas–Peucker 算法在给定误差内化简，场景中保存和重绘的
+点数大大减少，而重新渲染的结果与原笔迹的偏差不超过误差。
+
+Scene 保留所有绘制操作的矢量记录（笔画、形状、清除、图像块），画布上的
+光栅图像只是由它生成的缓存：可以按任意缩放比例重新渲染，也可以只渲染某个
+区域的干净笔迹交给识别模型。笔画的点以 array('f') 紧凑存储，每个点8字节。
+"""
+import math
+import sys
+from array import array
+
+import numpy as np
+from PyQt5.QtCore import QLineF, QPointF, QRect, QRectF, Qt
+from PyQt5.QtGui import QBrush, QColor, QImage, QPainter, QPainterPath, QPen, QPolygonF
+
+
+# 笔画化简允许的最大偏差（像素）
+STROKE_TOLERANCE = 0.5
+# 压感很轻时的最小线宽（像素）
+MIN_PRESSURE_WIDTH = 1.0
+
+
+def pressure_width(width, pressure):
+    """按压感缩放后的线宽"""
+    return max(MIN_PRESSURE_WIDTH, width * pressure)
+
+
+def segment_rect(start, end, width):
+    """一段线段（含线宽和抗锯齿余量）的包围矩形"""
+    margin = math.ceil(width / 2) + 2
+    return QRectF(start, end).normalized().toAlignedRect().adjusted(-margin, -margin, margin, margin)
+
+
+def simplify_mask(points, tolerance):
+    """
+    Ramer–Douglas–Peucker 化简，返回需要保留的点的布尔掩码
+
+    points 为 (n, k) 数组，k 通常为2（x, y），带压感时为3（x, y, 线宽）。
+    用显式栈代替递归，长笔画也不会超出递归深度。
+    """
+    count = len(points)
+    keep = np.zeros(count, bool)
+    if count == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        origin = points[start]
+        direction = points[end] - origin
+        offsets = points[start + 1:end] - origin
+        length = np.linalg.norm(direction)
+        if length == 0:
+            distances = np.linalg.norm(offsets, axis=1)
+        else:
+            unit = direction / length
+            # 到直线的距离：去掉沿直线方向的分量后的长度
+            distances = np.linalg.norm(offsets - np.outer(offsets @ unit, unit), axis=1)
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            split = start + 1 + index
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return keep
+
+
+class StrokeRenderer:
+    """
+    增量笔画渲染器
+
+    - queue(point, pressure): 加入一个新点，返回需要刷新的矩形（此时还没有绘制）
+    - pendingRect(): 队列中所有段将要修改的区域
+    - flush(surface): 一次画出队列中的所有段
+
+    段与段之间依靠圆形线帽衔接，效果与对整条路径使用圆角连接相同。
+    """
+
+    def __init__(self):
+        self.pen = None
+        self.lastPoint = None
+        self.lastPressure = 1.0
+        self._pending = []
+        self._pendingRect = QRect()
+
+    def begin(self, point, pen, pressure=1.0):
+        """开始一条新笔画，pen 的线宽为压感为1时的线宽"""
+        self.pen = QPen(pen)
+        self.lastPoint = QPointF(point)
+        self.lastPressure = pressure
+        self._pending = []
+        self._pendingRect = QRect()
+
+    def end(self):
+        self.pen = None
+        self.lastPoint = None
+        self._pending = []
+        self._pendingRect = QRect()
+
+    def queue(self, point, pressure=1.0):
+        """把 lastPoint -> point 这一段加入队列，返回这一段的包围矩形"""
+        point = QPointF(point)
+        start = self._pending[-1][1] if self._pending else self.lastPoint
+        startPressure = self._pending[-1][3] if self._pending else self.lastPressure
+        width = pressure_width(self.pen.widthF(), (startPressure + pressure) / 2)
+        self._pending.append((start, point, width, pressure))
+        rect = segment_rect(start, point, width)
+        self._pendingRect = self._pendingRect.united(rect)
+        return rect
+
+    def hasPending(self):
+        return bool(self._pending)
+
+    def pendingRect(self):
+        return QRect(self._pendingRect)
+
+    def flush(self, surface):
+        """把队列中的所有段画到 surface（tiles.TiledImage）上，返回修改的区域"""
+        if not self._pending:
+            return QRect()
+        segments = self._pending
+        rect = self._pendingRect
+        pen = QPen(self.pen)
+
+        def draw(painter):
+            for start, end, width, _ in segments:
+                pen.setWidthF(width)
+                painter.setPen(pen)
+                painter.drawLine(QLineF(start, end))
+
+        surface.paint(rect, draw)
+        self.lastPoint = segments[-1][1]
+        self.lastPressure = segments[-1][3]
+        self._pending = []
+        self._pendingRect = QRect()
+        return rect
+
+    def extend(self, surface, point, pressure=1.0):
+        """立即把 lastPoint -> point 这一段画到 surface 上，返回需要刷新的矩形"""
+        self.queue(point, pressure)
+        return self.flush(surface)
+
+
+def shape_path(kind, start, end):
+    """根据拖动的起点和终点生成形状路径（rectangle/ellipse/line/triangle）"""
+    start = QPointF(start)
+    end = QPointF(end)
+    path = QPainterPath()
+    if kind == "line":
+        path.moveTo(start)
+        path.lineTo(end)
+    elif kind == "rectangle":
+        path.addRect(QRectF(start, end))
+    elif kind == "ellipse":
+        path.addEllipse(QRectF(start, end))
+    elif kind == "triangle":
+        dx = end.x() - start.x()
+        path.moveTo(start)
+        path.lineTo(QPointF(end.x(), start.y()))
+        path.lineTo(QPointF(start.x() + math.floor(dx / 2), end.y()))
+        path.closeSubpath()
+    return path
+
+
+class Stroke:
+    """
+    画笔或橡皮擦的一条笔画，points 为交错存放的 x, y
+
+    pressures 为每个点的压感，全部为1（例如鼠标输入）时为None，不占用内存。
+    """
+
+    __slots__ = ("points", "pressures", "color", "width", "_bounds")
+
+    def __init__(self, color, width, points=None, pressures=None):
+        self.points = array("f", points or ())
+        self.pressures = None if pressures is None else array("f", pressures)
+        # 颜色以 ARGB 整数保存
+        self.color = QColor(color).rgba()
+        self.width = width
+        self._bounds = None
+
+    def append(self, point, pressure=1.0):
+        if self.pressures is None and pressure != 1.0:
+            self.pressures = array("f", [1.0] * len(self))
+        self.points.append(point.x())
+        self.points.append(point.y())
+        if self.pressures is not None:
+            self.pressures.append(pressure)
+        self._bounds = None
+
+    def simplify(self, tolerance=STROKE_TOLERANCE):
+        """用 RDP 算法化简笔画（就地修改），带压感时线宽的变化同样受误差约束"""
+        if len(self) < 3:
+            return
+        coordinates = np.frombuffer(self.points, np.float32).reshape(-1, 2).astype(np.float64)
+        if self.pressures is not None:
+            widths = np.frombuffer(self.pressures, np.float32).astype(np.float64) * self.width
+            coordinates = np.column_stack((coordinates, widths))
+        keep = simplify_mask(coordinates, tolerance)
+        self.points = array("f", np.frombuffer(self.points, np.float32).reshape(-1, 2)[keep].ravel().tobytes())
+        if self.pressures is not None:
+            self.pressures = array("f", np.frombuffer(self.pressures, np.float32)[keep].tobytes())
+        self._bounds = None
+
+    def __len__(self):
+        return len(self.points) // 2
+
+    def polygon(self):
+        points = self.points
+        return QPolygonF([QPointF(points[i], points[i + 1]) for i in range(0, len(points), 2)])
+
+    def bounds(self):
+        if self._bounds is None:
+            if not self.points:
+                return QRect()
+            xs = self.points[0::2]
+            ys = self.points[1::2]
+            margin = math.ceil(self.width / 2) + 2
+            self._bounds = QRectF(min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys)).toAlignedRect().adjusted(
+                -margin, -margin, margin, margin
+            )
+        return self._bounds
+
+    def render(self, painter):
+        if len(self) < 2:
+            return
+        pen = QPen(QColor.fromRgba(self.color), self.width, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+        painter.setBrush(Qt.NoBrush)
+        if self.pressures is None:
+            painter.setPen(pen)
+            painter.drawPolyline(self.polygon())
+            return
+        # 带压感的笔画逐段设置线宽，与 StrokeRenderer 的绘制方式一致
+        points, pressures = self.points, self.pressures
+        for index in range(1, len(self)):
+            pen.setWidthF(pressure_width(self.width, (pressures[index - 1] + pressures[index]) / 2))
+            painter.setPen(pen)
+            painter.drawLine(QLineF(points[2 * index - 2], points[2 * index - 1],
+                                    points[2 * index], points[2 * index + 1]))
+
+    def nbytes(self):
+        size = sys.getsizeof(self) + self.points.buffer_info()[1] * self.points.itemsize
+        if self.pressures is not None:
+            size += self.pressures.buffer_info()[1] * self.pressures.itemsize
+        return size
+
+
+class Shape:
+    """矩形、椭圆、直线或三角形，points 为拖动的起点和终点"""
+
+    __slots__ = ("kind", "points", "color", "width", "fill")
+
+    def __init__(self, kind, start, end, color, width, fill):
+        self.kind = kind
+        self.points = array("f", (start.x(), start.y(), end.x(), end.y()))
+        self.color = QColor(color).rgba()
+        self.width = width
+        self.fill = QColor(fill).rgba()
+
+    def path(self):
+        p = self.points
+        return shape_path(self.kind, QPointF(p[0], p[1]), QPointF(p[2], p[3]))
+
+    def bounds(self):
+        margin = self.width // 2 + 2
+        return self.path().boundingRect().toAlignedRect().adjusted(-margin, -margin, margin, margin)
+
+    def render(self, painter):
+        pen = QPen(QColor.fromRgba(self.color), self.width, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+        painter.setPen(pen)
+        painter.setBrush(QBrush(QColor.fromRgba(self.fill)))
+        painter.drawPath(self.path())
+
+    def nbytes(self):
+        return sys.getsizeof(self) + self.points.buffer_info()[1] * self.points.itemsize
+
+
+class Clear:
+    """清空画布"""
+
+    __slots__ = ()
+
+    def bounds(self):
+        return None
+
+    def render(self, painter):
+        # Scene 只从最后一次清空开始、在白色背景上重放，这里无需绘制
+        pass
+
+    def nbytes(self):
+        return sys.getsizeof(self)
+
+
+class RasterPatch:
+    """
+    无法用矢量表示的操作（打开图片、缩放/旋转选区）：
+    先把 eraseRect 填成白色，再把 image 画到 pos
+    """
+
+    __slots__ = ("eraseRect", "pos", "image")
+
+    def __init__(self, eraseRect, pos, image):
+        self.eraseRect = QRect(eraseRect)
+        self.pos = pos
+        self.image = image
+
+    def bounds(self):
+        return self.eraseRect.normalized().united(QRect(self.pos, self.image.size()))
+
+    def render(self, painter):
+        if not self.eraseRect.isEmpty():
+            painter.fillRect(self.eraseRect, Qt.white)
+        painter.drawImage(self.pos, self.image)
+
+    def nbytes(self):
+        return sys.getsizeof(self) + self.image.sizeInBytes()
+
+
+class Scene:
+    """
+    按时间顺序记录的绘制操作
+
+    cursor 之后的记录是被撤销的操作，重做时移动 cursor 即可恢复；
+    在撤销之后添加新记录会丢弃这些记录。
+
+    cursor 是从场景建立开始计算的位置，prune() 丢弃开头的记录后不变，
+    撤销记录中保存的位置仍然有效；base 为已丢弃的记录数。
+    """
+
+    def __init__(self):
+        self.items = []
+        self.base = 0
+        self.cursor = 0
+
+    def add(self, item):
+        del self.items[self.cursor - self.base:]
+        self.items.append(item)
+        self.cursor = self.base + len(self.items)
+
+    def setCursor(self, cursor):
+        self.cursor = max(self.base, min(cursor, self.base + len(self.items)))
+
+    def reset(self):
+        self.items = []
+        self.base = 0
+        self.cursor = 0
+
+    def visibleItems(self):
+        """当前可见的记录（从最后一次清空开始）"""
+        items = self.items[:self.cursor - self.base]
+        for index in range(len(items) - 1, -1, -1):
+            if isinstance(items[index], Clear):
+                return items[index:]
+        return items
+
+    def prune(self, cursor):
+        """
+        撤销最多能回到位置 cursor 时，丢弃此后再也不会显示的记录
+
+        即 cursor 处可见的最后一次清空之前的记录（例如打开图片时整幅画布的 RasterPatch）。
+        """
+        end = min(cursor, self.cursor) - self.base
+        for index in range(end - 1, 0, -1):
+            if isinstance(self.items[index], Clear):
+                del self.items[:index]
+                self.base += index
+                return
+
+    def render(self, painter, clip=None):
+        """在白色背景的 painter 上重放场景；clip 为场景坐标下需要绘制的区域"""
+        for item in self.visibleItems():
+            bounds = item.bounds()
+            if clip is not None and bounds is not None and not bounds.intersects(clip):
+                continue
+            item.render(painter)
+
+    def renderImage(self, rect, scale=1.0):
+        """把场景中 rect 区域渲染为新的白底图像，scale 为缩放比例"""
+        width = max(1, math.ceil(rect.width() * scale))
+        height = max(1, math.ceil(rect.height() * scale))
+        image = QImage(width, height, QImage.Format_RGB32)
+        image.fill(Qt.white)
+        painter = QPainter(image)
+        painter.scale(scale, scale)
+        painter.translate(-rect.x(), -rect.y())
+        painter.setClipRect(rect)
+        self.render(painter, rect)
+        painter.end()
+        return image
+
+    def nbytes(self):
+        return sys.getsizeof(self.items) + sum(item.nbytes() for item in self.items)
@@ -0,0 +1,153 @@
+"""
+按方程结构选择的快速求解
+
+大多数作业题是线性方程组或一元多项式方程，不需要通用的 sympy.solve：
+
+- 线性方程组：整理成系数矩阵，精确系数用 linsolve 求解，含浮点数或规模较大时用
+  NumPy 的 linalg；只处理有唯一解或无解的情况
+- 一元多项式：不超过四次时用 sympy.roots 精确求根，更高次时对无重根的部分用
+  numpy.roots（伴随矩阵的特征值）求数值根
+
+结果的形式与 sympy.solve 相同（单个方程返回根的列表，方程组返回 {变量: 值}）。
+其余情况（非线性方程组、超越方程、不等式等）返回None，由求解引擎执行 sympy.solve。
+"""
+import time
+
+import numpy as np
+import sympy
+
+from solver_engine import SolveResult
+
+# 不超过该次数的多项式精确求根
+EXACT_DEGREE_LIMIT = 4
+# 不超过该规模、且系数中没有浮点数的线性方程组精确求解
+EXACT_LINEAR_LIMIT = 10
+# 数值根的虚部小于该值（相对于模长）时视为实根
+IMAGINARY_TOLERANCE = 1e-9
+
+
+def to_expressions(target):
+    """把方程、表达式或它们的列表整理为 [lhs - rhs, ...]；含有不等式等其他关系时返回None"""
+    items = target if isinstance(target, (list, tuple)) else [target]
+    expressions = []
+    for item in items:
+        if isinstance(item, sympy.Equality):
+            expressions.append(item.lhs - item.rhs)
+        elif isinstance(item, sympy.Expr):
+            expressions.append(item)
+        else:
+            return None
+    return expressions
+
+
+def _is_linear(expressions, symbols):
+    for expr in expressions:
+        if not expr.is_polynomial(*symbols):
+            return False
+        if sympy.Poly(expr, *symbols).total_degree() > 1:
+            return False
+    return True
+
+
+def solve_linear(expressions, symbols):
+    """
+    求解线性方程组，返回 {变量: 值}，无解时返回 []
+
+    解不唯一时返回None（交给 sympy.solve 给出参数形式的解）。
+    """
+    A, b = sympy.linear_eq_to_matrix(expressions, symbols)
+    values = list(A) + list(b)
+    exact = len(symbols) <= EXACT_LINEAR_LIMIT and not any(value.has(sympy.Float) for value in values)
+    if exact:
+        solutions = sympy.linsolve((A, b), symbols)
+        if solutions is sympy.S.EmptySet:
+            return []
+        solution = next(iter(solutions))
+        if any(value.free_symbols for value in solution):
+            return None
+        return dict(zip(symbols, solution))
+
+    matrix = np.array(A.tolist(), dtype=float)
+    rhs = np.array(b.tolist(), dtype=float).ravel()
+    solution, _, rank, _ = np.linalg.lstsq(matrix, rhs, rcond=None)
+    if rank < len(symbols):
+        return None
+    if not np.allclose(matrix @ solution, rhs):
+        return []
+    return {symbol: sympy.Float(value) for symbol, value in zip(symbols, solution)}
+
+
+def _numeric_root(value):
+    if abs(value.imag) <= IMAGINARY_TOLERANCE * max(1.0, abs(value)):
+        return sympy.Float(value.real)
+    return sympy.Float(value.real) + sympy.Float(value.imag) * sympy.I
+
+
+def _numeric_roots(poly):
+    """用 numpy.roots（伴随矩阵的特征值）求无重根多项式的数值根"""
+    coefficients = np.array([complex(coeff) for coeff in poly.all_coeffs()])
+    if not coefficients.imag.any():
+        coefficients = coefficients.real
+    return [_numeric_root(value) for value in np.roots(coefficients)]
+
+
+def _root_order(root):
+    # 实根在前并按从小到大排列，与 sympy.solve 的顺序一致
+    value = complex(root)
+    return abs(value.imag) > IMAGINARY_TOLERANCE * max(1.0, abs(value)), value.real, value.imag
+
+
+def solve_polynomial(expr, symbol):
+    """
+    求一元多项式的所有不同的根
+
+    精确系数的多项式先做因式分解，不超过四次的因式用 sympy.roots 精确求根，
+    更高次的因式求数值根；含浮点系数时去掉重根后直接求数值根。
+    """
+    poly = sympy.Poly(expr, symbol)
+    if poly.degree() < 1 or not all(coeff.is_number for coeff in poly.all_coeffs()):
+        return None
+    if poly.has(sympy.Float):
+        factors = [poly]
+    else:
+        factors = [factor for factor, _ in poly.factor_list()[1]]
+    roots = set()
+    for factor in factors:
+        degree = factor.degree()
+        if degree <= EXACT_DEGREE_LIMIT:
+            exact = sympy.roots(factor)
+            if sum(exact.values()) == degree:
+                roots.update(exact)
+                continue
+        roots.update(_numeric_roots(factor if factor.has(sympy.Float) else factor.sqf_part()))
+    return sorted(roots, key=_root_order)
+
+
+def solve_structured(target):
+    """
+    按结构尝试快速求解，返回 SolveResult；不属于线性方程组或一元多项式时返回None
+
+    target 与 sympy.solve 的参数相同：一个方程（或表达式）或方程的列表。
+    """
+    start = time.perf_counter()
+    expressions = to_expressions(target)
+    if not expressions:
+        return None
+    symbols = sorted(set().union(*(expr.free_symbols for expr in expressions)), key=lambda s: s.name)
+    if not symbols:
+        return None
+    try:
+        if _is_linear(expressions, symbols):
+            solutions = solve_linear(expressions, symbols)
+            # 单个方程、单个变量时 sympy.solve 返回根的列表
+            if isinstance(solutions, dict) and not isinstance(target, (list, tuple)) and len(symbols) == 1:
+                solutions = list(solutions.values())
+        elif not isinstance(target, (list, tuple)) and len(symbols) == 1 and expressions[0].is_polynomial(symbols[0]):
+            solutions = solve_polynomial(expressions[0], symbols[0])
+        else:
+            return None
+    except (sympy.PolynomialError, sympy.polys.polyerrors.PolificationFailed, ValueError, TypeError):
+        return None
+    if solutions is None:
+        return None
+    return SolveResult(SolveResult.OK, solutions, time.perf_counter() - start)
@@ -0,0 +1,30 @@
+import math
+
+from image_bridge import qimage_array
+from implicit_plot import BASE_SCALE, CURVE_COLOR, ImplicitRelation, PlotTiles
+
+
+def _curve(formula, col, row, level=0):
+    tiles = PlotTiles(ImplicitRelation.from_formula(formula))
+    return qimage_array(tiles.image(level, col, row)) == CURVE_COLOR
+
+
+def test_chained_relation_is_not_plotted():
+    assert ImplicitRelation.from_formula("1<x+y<2") is None
+    assert ImplicitRelation.from_formula("y<x<2") is None
+
+
+def test_pole_is_not_drawn_as_curve():
+    # 图块 (0, -1) 覆盖 0<=x<8、0<y<=8，x=pi/2 处是 tan 的渐近线
+    curve = _curve(r"y=\tan(x)", 0, -1)
+    pole = int(math.pi / 2 * BASE_SCALE)
+    # y<=8 时曲线在 x<=atan(8) 以内，渐近线所在的几列不应有竖线
+    assert curve[:, :pole - 2].any()
+    assert not curve[:, pole - 1:pole + 2].any()
+
+
+def test_line_is_drawn():
+    # 图块 (0, -1) 中第 c 列的 y=x 落在第 256-c 行附近
+    curve = _curve("y=x", 0, -1)
+    assert curve[126:131, 128].any()
+    assert curve.sum() < 2 * curve.shape[0]
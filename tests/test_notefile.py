@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+from PyQt5.QtCore import QPoint
+
+from notefile import NoteFile
+from solver_engine import SolveResult
+from strokes import Scene, Shape, Stroke
+from tiles import TiledImage
+
+TILE = 64
+
+
+def _canvas(fill):
+    store = TiledImage(TILE)
+    store.write_pixels(QPoint(0, 0), np.full((TILE, 2 * TILE), fill, np.uint32))
+    return store
+
+
+def _pixels(store):
+    return store.read_pixels(store.tileRect((0, 0)).united(store.tileRect((1, 0))))
+
+
+def _stroke(*points):
+    stroke = Stroke(0xFF000000, 3)
+    for x, y in points:
+        stroke.append(QPoint(x, y))
+    return stroke
+
+
+def _save(path, store, scene, formulas=None):
+    note = NoteFile(path)
+    note.save(store, scene, formulas or {}, {"viewOffset": [1, 2]})
+    note.close()
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "a.mathnote")
+    store = _canvas(0xFF112233)
+    scene = Scene()
+    scene.add(_stroke((0, 0), (10, 5), (20, 20)))
+    scene.add(Shape("ellipse", QPoint(1, 2), QPoint(30, 40), 0xFF00FF00, 2, 0xFF0000FF))
+    formulas = {(0, 10, 0, 20): ("x+1=2", "方程", SolveResult(SolveResult.OK, "[1]", 0.1), None)}
+    _save(path, store, scene, formulas)
+
+    note = NoteFile.open(path)
+    items, segments, meta = note.read()
+    opened = TiledImage(TILE)
+    note.attach(opened)
+    assert meta == {"viewOffset": [1, 2]}
+    assert list(items[0].points) == list(scene.items[0].points)
+    shape = scene.items[1]
+    assert (items[1].kind, items[1].color, items[1].fill) == ("ellipse", shape.color, shape.fill)
+    assert list(items[1].points) == list(shape.points)
+    formula, relation, result, plot = segments[(0, 10, 0, 20)]
+    assert (formula, relation, result.ok, result.solutions, plot) == ("x+1=2", "方程", True, "[1]", None)
+    assert sorted(opened.keys()) == [(0, 0), (1, 0)]
+    assert (_pixels(opened) == 0xFF112233).all()
+    note.close()
+
+
+def test_torn_tail_recovers_last_save(tmp_path):
+    path = str(tmp_path / "b.mathnote")
+    store = _canvas(0xFF112233)
+    scene = Scene()
+    scene.add(_stroke((0, 0), (5, 5)))
+    note = NoteFile(path)
+    note.save(store, scene, {}, {})
+    committed = os.path.getsize(path)
+    # 第二次保存只追加变化的记录，在写到一半时"崩溃"
+    store.write_pixels(QPoint(0, 0), np.full((TILE, TILE), 0xFF445566, np.uint32))
+    scene.add(_stroke((1, 1), (9, 9)))
+    note.save(store, scene, {}, {})
+    note.close()
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    note = NoteFile.open(path)
+    items, _, _ = note.read()
+    opened = TiledImage(TILE)
+    note.attach(opened)
+    assert len(items) == 1
+    assert (_pixels(opened) == 0xFF112233).all()
+
+    # 下一次保存截掉不完整的记录后追加
+    opened.write_pixels(QPoint(TILE, 0), np.full((TILE, TILE), 0xFF778899, np.uint32))
+    note.save(opened, scene, {}, {})
+    note.close()
+    assert os.path.getsize(path) > committed
+    note = NoteFile.open(path)
+    items, _, _ = note.read()
+    reopened = TiledImage(TILE)
+    note.attach(reopened)
+    assert len(items) == 2
+    pixels = _pixels(reopened)
+    assert (pixels[:, :TILE] == 0xFF112233).all() and (pixels[:, TILE:] == 0xFF778899).all()
+    note.close()
+
+
+def _reopened_pixels(path):
+    note = NoteFile.open(path)
+    note.read()
+    opened = TiledImage(TILE)
+    note.attach(opened)
+    pixels = _pixels(opened)
+    note.close()
+    return pixels
+
+
+def test_partial_checkpoint_is_not_committed(tmp_path):
+    path = str(tmp_path / "c.mathnote")
+    store = _canvas(0xFF112233)
+    scene = Scene()
+    note = NoteFile(path)
+    # 第一次写入也分两次：提交之前文件还不存在
+    note.write(note.snapshot(store, scene, {}, {}, maxBytes=1))
+    assert note.pending() == 1 and not os.path.exists(path)
+    note.write(note.snapshot(store, scene, {}, {}, maxBytes=1))
+    assert note.pending() == 0
+    assert (_reopened_pixels(path) == 0xFF112233).all()
+
+    store.write_pixels(QPoint(0, 0), np.full((TILE, 2 * TILE), 0xFF445566, np.uint32))
+    note.write(note.snapshot(store, scene, {}, {}, maxBytes=1))
+    # 只写了一半的检查点没有提交，打开时仍是上一个完整的画布
+    assert note.pending() == 1
+    assert (_reopened_pixels(path) == 0xFF112233).all()
+    note.write(note.snapshot(store, scene, {}, {}, maxBytes=1))
+    assert note.pending() == 0
+    assert (_reopened_pixels(path) == 0xFF445566).all()
+    note.close()
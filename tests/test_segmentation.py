@@ -0,0 +1,36 @@
+import numpy as np
+
+from segmentation import segment_ink
+
+
+def _ink(height, width, *boxes):
+    ink = np.zeros((height, width), bool)
+    for top, bottom, left, right in boxes:
+        ink[top:bottom, left:right] = True
+    return ink
+
+
+def test_fraction_stays_one_formula():
+    # 分子 0-20 行、分数线 35-38 行、分母 53-73 行，分数线横向覆盖分子和分母
+    ink = _ink(80, 60, (0, 20, 20, 40), (35, 38, 5, 55), (53, 73, 20, 40))
+    assert segment_ink(ink) == [(0, 73, 5, 55)]
+
+
+def test_stacked_equations_are_split():
+    ink = _ink(120, 200, (0, 20, 10, 150), (60, 80, 10, 120))
+    assert segment_ink(ink) == [(0, 20, 10, 150), (60, 80, 10, 120)]
+
+
+def test_side_by_side_formulas_are_split():
+    ink = _ink(40, 300, (5, 25, 0, 80), (5, 25, 200, 280))
+    assert segment_ink(ink) == [(5, 25, 0, 80), (5, 25, 200, 280)]
+
+
+def test_thin_line_joins_the_row_it_overlaps():
+    # 下划线只与上面一行重叠，即使离下面一行更近也不并入下面一行
+    ink = _ink(120, 300, (0, 20, 10, 100), (40, 43, 10, 100), (55, 75, 200, 290))
+    assert segment_ink(ink) == [(0, 43, 10, 100), (55, 75, 200, 290)]
+
+
+def test_empty_ink():
+    assert segment_ink(np.zeros((10, 10), bool)) == []
@@ -0,0 +1,303 @@
+"""
+分块的画布后备存储
+
+画布由固定大小的图块组成，图块在第一次被绘制时才分配，空白图块不占内存，
+因此画布可以远大于屏幕。超过常驻上限的冷图块可以换出到内存映射的临时文件，
+再次访问时自动换回。图块也可以来自文档文件，第一次访问时才读取和解压。
+文档坐标从 (0, 0) 开始向右、向下延伸。
+
+每次修改、释放图块都会递增版本号并记在该图块上，保存文档和自动保存各自记住
+上一次写入时的版本号，只写入之后变化的图块。
+"""
+import mmap
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+from PyQt5.QtCore import QPoint, QRect, Qt
+from PyQt5.QtGui import QImage, QPainter
+
+from image_bridge import qimage_array
+
+TILE_SIZE = 256
+# 常驻内存的图块上限（256x256 的 RGB32 图块每块 256KB），设为0表示不换出
+DEFAULT_MAX_RESIDENT_TILES = int(os.environ.get("MATHNOTE_RESIDENT_TILES", 512)) or None
+WHITE = 0xFFFFFFFF
+
+
+class _ScratchFile:
+    """换出图块用的内存映射临时文件，按固定大小的槽位分配"""
+
+    SLOTS_PER_CHUNK = 64
+
+    def __init__(self, slotBytes):
+        self.slotBytes = slotBytes
+        self.chunkBytes = slotBytes * self.SLOTS_PER_CHUNK
+        self.file = tempfile.TemporaryFile(prefix="mathnote-tiles-")
+        self.chunks = []
+        self.freeSlots = []
+        self.nextSlot = 0
+
+    def _locate(self, slot):
+        chunk, index = divmod(slot, self.SLOTS_PER_CHUNK)
+        while chunk >= len(self.chunks):
+            # 按块扩展文件，每块单独映射
+            self.file.truncate(self.chunkBytes * (len(self.chunks) + 1))
+            self.chunks.append(mmap.mmap(self.file.fileno(), self.chunkBytes, offset=self.chunkBytes * len(self.chunks)))
+        return self.chunks[chunk], index * self.slotBytes
+
+    def store(self, data):
+        slot = self.freeSlots.pop() if self.freeSlots else self.nextSlot
+        if slot == self.nextSlot:
+            self.nextSlot += 1
+        mapped, offset = self._locate(slot)
+        mapped[offset:offset + self.slotBytes] = data
+        return slot
+
+    def load(self, slot):
+        mapped, offset = self._locate(slot)
+        data = mapped[offset:offset + self.slotBytes]
+        self.freeSlots.append(slot)
+        return data
+
+    def release(self, slot):
+        self.freeSlots.append(slot)
+
+    def close(self):
+        for mapped in self.chunks:
+            mapped.close()
+        self.file.close()
+
+
+class TiledImage:
+    """
+    懒分配的分块图像
+
+    - paint(rect, draw): 在 rect 覆盖的每个图块上调用 draw(painter)，painter 使用文档坐标
+    - drawTo(painter, rect): 把 rect 区域画到 painter 上（空白图块直接填白）
+    - copy(rect): 把 rect 区域拼成一张 QImage
+    - read_pixels/write_pixels: 以 NumPy 数组读写任意区域，供撤销使用
+    - attachSource(keys, source): 按需加载的图块，source.loadTile(key) 返回 (tileSize, tileSize) uint32 数组；
+      rebindSources(source) 把它们改为从另一个内容相同的来源加载
+    - version/changedSince(version): 当前版本号，以及该版本之后修改或释放过的图块
+    """
+
+    def __init__(self, tileSize=TILE_SIZE, maxResidentTiles=DEFAULT_MAX_RESIDENT_TILES):
+        self.tileSize = tileSize
+        self.maxResidentTiles = maxResidentTiles
+        self._tiles = OrderedDict()
+        self._paged = {}
+        self._scratch = None
+        # 尚未加载的图块及其来源
+        self._lazy = {}
+        # 每个图块最后一次修改时的版本号
+        self.version = 0
+        self._versions = {}
+
+    # ---- 图块管理 ----
+
+    def tileRect(self, key):
+        return QRect(key[0] * self.tileSize, key[1] * self.tileSize, self.tileSize, self.tileSize)
+
+    def tileKeys(self, rect):
+        """rect 覆盖的图块（只包括非负坐标）"""
+        rect = rect.normalized().intersected(QRect(0, 0, 1 << 30, 1 << 30))
+        if rect.isEmpty():
+            return []
+        size = self.tileSize
+        return [
+            (tx, ty)
+            for ty in range(rect.top() // size, rect.bottom() // size + 1)
+            for tx in range(rect.left() // size, rect.right() // size + 1)
+        ]
+
+    def _newTile(self):
+        tile = QImage(self.tileSize, self.tileSize, QImage.Format_RGB32)
+        tile.fill(Qt.white)
+        return tile
+
+    def _tile(self, key, create=False):
+        """返回图块，必要时从临时文件换回；不存在且 create 为False时返回None"""
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            return tile
+        if key in self._paged:
+            tile = self._newTile()
+            qimage_array(tile)[...] = np.frombuffer(
+                self._scratch.load(self._paged.pop(key)), np.uint32
+            ).reshape(self.tileSize, self.tileSize)
+        elif key in self._lazy:
+            tile = self._newTile()
+            qimage_array(tile)[...] = self._lazy[key].loadTile(key)
+            del self._lazy[key]
+        elif create:
+            tile = self._newTile()
+        else:
+            return None
+        self._tiles[key] = tile
+        self._evict()
+        return tile
+
+    def _evict(self):
+        if self.maxResidentTiles is None:
+            return
+        while len(self._tiles) > self.maxResidentTiles:
+            key, tile = self._tiles.popitem(last=False)
+            if self._scratch is None:
+                self._scratch = _ScratchFile(self.tileSize * self.tileSize * 4)
+            self._paged[key] = self._scratch.store(qimage_array(tile).tobytes())
+
+    def hasTile(self, key):
+        return key in self._tiles or key in self._paged or key in self._lazy
+
+    def keys(self):
+        return list(self._tiles) + list(self._paged) + list(self._lazy)
+
+    def tileCount(self):
+        return len(self._tiles) + len(self._paged) + len(self._lazy)
+
+    def residentBytes(self):
+        return sum(tile.sizeInBytes() for tile in self._tiles.values())
+
+    def bounds(self):
+        """所有已分配图块的外接矩形"""
+        rect = QRect()
+        for key in self.keys():
+            rect = rect.united(self.tileRect(key))
+        return rect
+
+    def clear(self):
+        """丢弃所有图块，画布恢复为空白"""
+        for key in self.keys():
+            self._touch(key)
+        self._tiles.clear()
+        for slot in self._paged.values():
+            self._scratch.release(slot)
+        self._paged.clear()
+        self._lazy.clear()
+
+    # ---- 按需加载与保存 ----
+
+    def attachSource(self, keys, source):
+        """登记按需加载的图块（会取代这些位置上已有的图块），第一次访问时调用 source.loadTile(key)"""
+        for key in keys:
+            self._tiles.pop(key, None)
+            slot = self._paged.pop(key, None)
+            if slot is not None:
+                self._scratch.release(slot)
+            self._lazy[key] = source
+            self._touch(key)
+
+    def rebindSources(self, source):
+        """尚未加载的图块全部改为从 source 加载（source 中有相同的内容，不算修改）"""
+        for key in self._lazy:
+            self._lazy[key] = source
+
+    def tileSource(self, key):
+        """尚未加载的图块的来源，已加载或不存在的图块返回None"""
+        return self._lazy.get(key)
+
+    def _touch(self, key):
+        self.version += 1
+        self._versions[key] = self.version
+
+    def changedSince(self, version):
+        """版本 version 之后修改或释放过的图块"""
+        return [key for key, changed in self._versions.items() if changed > version]
+
+    # ---- 绘制 ----
+
+    def paint(self, rect, draw):
+        """在 rect 覆盖的每个图块上调用 draw(painter)，painter 已平移到文档坐标并裁剪到 rect"""
+        for key in self.tileKeys(rect):
+            tile = self._tile(key, create=True)
+            self._touch(key)
+            painter = QPainter(tile)
+            painter.translate(-key[0] * self.tileSize, -key[1] * self.tileSize)
+            painter.setClipRect(rect)
+            draw(painter)
+            painter.end()
+
+    def drawImage(self, pos, image):
+        self.paint(QRect(pos, image.size()), lambda painter: painter.drawImage(pos, image))
+
+    def drawTo(self, painter, rect):
+        """把文档中 rect 区域画到 painter（使用文档坐标）上"""
+        for key in self.tileKeys(rect):
+            tileRect = self.tileRect(key)
+            part = tileRect.intersected(rect)
+            tile = self._tile(key)
+            if tile is None:
+                painter.fillRect(part, Qt.white)
+            else:
+                painter.drawImage(part, tile, part.translated(-tileRect.topLeft()))
+
+    def copy(self, rect):
+        """把文档中 rect 区域拼成一张新的 QImage"""
+        rect = rect.normalized()
+        image = QImage(max(rect.width(), 1), max(rect.height(), 1), QImage.Format_RGB32)
+        image.fill(Qt.white)
+        painter = QPainter(image)
+        painter.translate(-rect.x(), -rect.y())
+        self.drawTo(painter, rect)
+        painter.end()
+        return image
+
+    def toImage(self, rect=None):
+        """导出为单张图像，默认导出所有已分配的图块"""
+        if rect is None:
+            rect = self.bounds()
+        return self.copy(rect)
+
+    # ---- 像素读写 ----
+
+    def read_pixels(self, rect):
+        """读取 rect 区域的像素，返回 (高, 宽) uint32 数组（拷贝）"""
+        pixels = np.full((rect.height(), rect.width()), WHITE, np.uint32)
+        for key in self.tileKeys(rect):
+            tile = self._tile(key)
+            if tile is None:
+                continue
+            tileRect = self.tileRect(key)
+            part = tileRect.intersected(rect)
+            source = qimage_array(tile)[
+                part.top() - tileRect.top():part.bottom() + 1 - tileRect.top(),
+                part.left() - tileRect.left():part.right() + 1 - tileRect.left()
+            ]
+            pixels[
+                part.top() - rect.top():part.bottom() + 1 - rect.top(),
+                part.left() - rect.left():part.right() + 1 - rect.left()
+            ] = source
+        return pixels
+
+    def write_pixels(self, pos, pixels):
+        """把像素数组写到以 pos 为左上角的区域，写完后全白的图块会被释放"""
+        rect = QRect(QPoint(pos), QPoint(pos.x() + pixels.shape[1] - 1, pos.y() + pixels.shape[0] - 1))
+        for key in self.tileKeys(rect):
+            tileRect = self.tileRect(key)
+            part = tileRect.intersected(rect)
+            block = pixels[
+                part.top() - rect.top():part.bottom() + 1 - rect.top(),
+                part.left() - rect.left():part.right() + 1 - rect.left()
+            ]
+            tile = self._tile(key)
+            if tile is None:
+                if (block == WHITE).all():
+                    continue
+                tile = self._tile(key, create=True)
+            self._touch(key)
+            target = qimage_array(tile)
+            target[
+                part.top() - tileRect.top():part.bottom() + 1 - tileRect.top(),
+                part.left() - tileRect.left():part.right() + 1 - tileRect.left()
+            ] = block
+            if (target == WHITE).all():
+                del self._tiles[key]
+
+    def close(self):
+        self.clear()
+        if self._scratch is not None:
+            self._scratch.close()
+            self._scratch = None
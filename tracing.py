@@ -0,0 +1,275 @@
+"""
+识别与求解管线的分阶段计时
+
+一次右键识别是一个请求（Trace），其中的每个阶段（复制选区、预处理、加载模型、推理、
+latex2sympy、分类、求解、渲染）记录耗时和内存增量。所有阶段的耗时保存在滚动窗口中，
+可以随时查询分位数；诊断面板和 JSON 日志都从这里读取。
+
+- 阶段可以嵌套，也可以在没有请求时单独使用（此时只计入统计，不测量内存）
+- 设置环境变量 MATHNOTE_TRACE_LOG 为文件路径时，每个请求结束后追加一行 JSON
+- 设置环境变量 MATHNOTE_PROFILE=cprofile 或 tracemalloc 时，对下一个请求做一次
+  完整的分析（也可以调用 arm_profile 再次启用）。求解在独立进程中执行，不在分析范围内。
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+# 每个阶段保留的最近样本数
+WINDOW = 200
+# 保留的最近请求数
+RECENT_TRACES = 20
+PERCENTILES = (50, 90, 99)
+PROFILE_MODES = ("cprofile", "tracemalloc")
+
+_local = threading.local()
+
+
+def percentile(samples, p):
+    """线性插值的分位数"""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(ordered) - 1)
+    return ordered[f] + (ordered[c] - ordered[f]) * (k - f)
+
+
+def _memory_bytes():
+    """当前的内存用量：tracemalloc 运行时为其统计值，否则为进程常驻内存（仅Linux），无法获取时为None"""
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class Trace:
+    """
+    一个请求的分阶段记录
+
+    stages 为 [{name, start_ms, duration_ms, alloc_kb, depth}, ...]，按开始时间排列。
+    """
+
+    def __init__(self, tracer, name, **attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.stages = []
+        self.status = None
+        self.totalMs = None
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._profile = tracer._take_profile()
+        self._profiler = None
+        self.profileReport = None
+
+    @contextmanager
+    def stage(self, name):
+        """记录一个阶段；可以在任何线程中调用"""
+        start = time.perf_counter()
+        memory = _memory_bytes()
+        with self._lock:
+            depth = self._depth
+            self._depth += 1
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            after = _memory_bytes()
+            with self._lock:
+                self._depth -= 1
+                self.stages.append({
+                    "name": name,
+                    "start_ms": (start - self._start) * 1000,
+                    "duration_ms": duration * 1000,
+                    "alloc_kb": None if memory is None or after is None else (after - memory) / 1024,
+                    "depth": depth,
+                })
+            self.tracer.record(name, duration)
+
+    @contextmanager
+    def activate(self):
+        """在当前线程中把本请求设为活动请求，模块级的 stage() 会记录到这里"""
+        previous = getattr(_local, "trace", None)
+        _local.trace = self
+        self._startProfile()
+        try:
+            yield self
+        finally:
+            self._stopProfile()
+            _local.trace = previous
+
+    def _startProfile(self):
+        if self._profile == "cprofile":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self._profile == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            self._profiler = tracemalloc
+
+    def _stopProfile(self):
+        if self._profiler is None:
+            return
+        output = io.StringIO()
+        if self._profile == "cprofile":
+            self._profiler.disable()
+            stats = pstats.Stats(self._profiler, stream=output)
+            stats.sort_stats("cumulative").print_stats(30)
+            path = f"mathnote-{self.name}-{int(self.started)}.prof"
+            stats.dump_stats(path)
+            output.write(f"\n完整的分析数据已写入 {path}\n")
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            for statistic in snapshot.statistics("lineno")[:30]:
+                output.write(f"{statistic}\n")
+        self._profiler = None
+        self.profileReport = output.getvalue()
+        print(self.profileReport, file=sys.stderr)
+
+    def finish(self, status="ok", **attributes):
+        """结束请求，写入统计和日志；重复调用无效"""
+        if self.status is not None:
+            return
+        self.status = status
+        self.attributes.update(attributes)
+        duration = time.perf_counter() - self._start
+        self.totalMs = duration * 1000
+        self.tracer.record(self.name, duration)
+        self.tracer._finished(self)
+
+    def to_dict(self):
+        with self._lock:
+            stages = sorted(self.stages, key=lambda stage: stage["start_ms"])
+        return {
+            "request": self.name,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "status": self.status,
+            "total_ms": self.totalMs if self.totalMs is not None else (time.perf_counter() - self._start) * 1000,
+            "attributes": self.attributes,
+            "stages": stages,
+            "profile": self._profile,
+        }
+
+
+class Tracer:
+    """
+    进程级的统计
+
+    - begin(name): 开始一个请求，返回 Trace
+    - record(name, seconds): 记录一个样本（通常由阶段自动调用）
+    - summary(): 每个阶段的样本数和耗时分位数
+    - arm_profile(mode): 对下一个请求做 cProfile 或 tracemalloc 分析
+    """
+
+    def __init__(self, window=WINDOW, logPath=None, profile=None):
+        self.window = window
+        self.logPath = logPath
+        self.samples = {}
+        self.recent = deque(maxlen=RECENT_TRACES)
+        self._lock = threading.Lock()
+        self._profile = None
+        if profile:
+            self.arm_profile(profile)
+
+    def begin(self, name, **attributes):
+        return Trace(self, name, **attributes)
+
+    def record(self, name, seconds):
+        with self._lock:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def arm_profile(self, mode="cprofile"):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"未知的分析方式: {mode}（可选 {', '.join(PROFILE_MODES)}）")
+        with self._lock:
+            self._profile = mode
+
+    def _take_profile(self):
+        with self._lock:
+            mode, self._profile = self._profile, None
+            return mode
+
+    def _finished(self, trace):
+        record = trace.to_dict()
+        with self._lock:
+            self.recent.append(record)
+        if self.logPath:
+            try:
+                with open(self.logPath, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            except OSError as e:
+                print(f"写入性能日志失败: {str(e)}", file=sys.stderr)
+
+    def summary(self):
+        """{阶段: {count, p50_ms, p90_ms, p99_ms, max_ms}}"""
+        with self._lock:
+            samples = {name: list(values) for name, values in self.samples.items()}
+        summary = {}
+        for name, values in samples.items():
+            stats = {f"p{p}_ms": percentile(values, p) * 1000 for p in PERCENTILES}
+            stats["count"] = len(values)
+            stats["max_ms"] = max(values) * 1000
+            summary[name] = stats
+        return summary
+
+    def reset(self):
+        with self._lock:
+            self.samples.clear()
+            self.recent.clear()
+
+
+_tracer = None
+_tracerLock = threading.Lock()
+
+
+def get_tracer():
+    """获取进程内共享的 Tracer"""
+    global _tracer
+    with _tracerLock:
+        if _tracer is None:
+            _tracer = Tracer(
+                logPath=os.environ.get("MATHNOTE_TRACE_LOG") or None,
+                profile=os.environ.get("MATHNOTE_PROFILE") or None,
+            )
+        return _tracer
+
+
+def current_trace():
+    """当前线程的活动请求，没有时为None"""
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def stage(name):
+    """
+    记录一个阶段
+
+    当前线程有活动请求时记录到请求中（包括内存增量），否则只计入统计。
+    """
+    trace = current_trace()
+    if trace is not None:
+        with trace.stage(name):
+            yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        get_tracer().record(name, time.perf_counter() - start)
@@ -0,0 +1,203 @@
+"""
+基于图块的增量撤销/重做
+
+每一步操作只保存被修改的图块在修改前的内容（可压缩），撤销时只把这些图块写回。
+撤销占用的内存取决于实际编辑的面积，而不是画布大小乘以历史步数。
+
+使用方式：
+- 修改画布之前调用 touch(surface, rect)，第一次碰到的图块会被保存
+- 替换整个画布的操作（例如打开文件、清空）之前调用 touchAll(surface)
+- 操作完成后调用 commit() 生成一步撤销记录
+
+surface 为 tiles.TiledImage，通过 read_pixels/write_pixels 读写像素；
+撤销图块的大小可以与画布图块不同。
+
+commit 还可以附带操作前后的标记（例如矢量场景的位置），撤销/重做时返回
+应当恢复的标记，使其他状态与图块保持同步。
+"""
+import zlib
+from collections import deque
+
+import numpy as np
+from PyQt5.QtCore import QRect
+
+TILE_SIZE = 64
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_STEPS = 100
+
+
+class _Entry:
+    """
+    一步撤销记录：被修改图块的内容
+
+    replace 为True时表示整个画布被替换，撤销时先清空画布再写回图块。
+    marker 为应用该记录后应恢复的标记，inverseMarker 为应用前的标记。
+    """
+
+    __slots__ = ("tiles", "bytes", "replace", "marker", "inverseMarker")
+
+    def __init__(self, tiles, replace=False, marker=None, inverseMarker=None):
+        self.tiles = tiles
+        self.replace = replace
+        self.marker = marker
+        self.inverseMarker = inverseMarker
+        self.bytes = sum(len(data) for _, data in tiles.values())
+
+
+class TileUndoStack:
+    """
+    图块增量撤销栈
+
+    - tileSize: 图块边长（像素）
+    - maxBytes / maxSteps: 撤销历史的字节上限和步数上限，超出时丢弃最早的记录（最近的一步总是保留）
+    - compress: 是否用 zlib 压缩图块
+    """
+
+    def __init__(self, tileSize=TILE_SIZE, maxBytes=DEFAULT_MAX_BYTES, maxSteps=DEFAULT_MAX_STEPS, compress=True):
+        self.tileSize = tileSize
+        self.maxBytes = maxBytes
+        self.maxSteps = maxSteps
+        self.compress = compress
+        self.undoStack = deque()
+        self.redoStack = deque()
+        self.bytes = 0
+        self._pending = None
+        self._pendingReplace = False
+
+    # ---- 图块读写 ----
+
+    def _tileRect(self, key):
+        return QRect(key[0] * self.tileSize, key[1] * self.tileSize, self.tileSize, self.tileSize)
+
+    def _keys(self, rect):
+        rect = rect.normalized()
+        size = self.tileSize
+        for ty in range(max(rect.top(), 0) // size, rect.bottom() // size + 1):
+            for tx in range(max(rect.left(), 0) // size, rect.right() // size + 1):
+                yield (tx, ty)
+
+    def _encode(self, surface, key):
+        tile = surface.read_pixels(self._tileRect(key))
+        data = tile.tobytes()
+        if self.compress:
+            data = zlib.compress(data, 1)
+        return tile.shape, data
+
+    def _decode(self, surface, key, encoded):
+        shape, data = encoded
+        if self.compress:
+            data = zlib.decompress(data)
+        tile = np.frombuffer(data, np.uint32).reshape(shape)
+        surface.write_pixels(self._tileRect(key).topLeft(), tile)
+
+    def _allKeys(self, surface):
+        bounds = surface.bounds()
+        if bounds.isEmpty():
+            return []
+        return list(self._keys(bounds))
+
+    # ---- 记录操作 ----
+
+    def touch(self, surface, rect):
+        """在修改 rect 之前调用，保存其中尚未保存的图块"""
+        if self._pending is None:
+            self._pending = {}
+            self._pendingReplace = False
+        if rect.isEmpty():
+            return
+        for key in self._keys(rect):
+            if key not in self._pending:
+                self._pending[key] = self._encode(surface, key)
+
+    def touchAll(self, surface):
+        """在替换整个画布之前调用"""
+        if self._pending is None:
+            self._pending = {}
+        for key in self._allKeys(surface):
+            if key not in self._pending:
+                self._pending[key] = self._encode(surface, key)
+        self._pendingReplace = True
+
+    def commit(self, before=None, after=None):
+        """
+        结束当前操作，生成一步撤销记录
+
+        before/after 为操作前后的标记，撤销时返回 before，重做时返回 after。
+        """
+        if not self._pending and before == after:
+            self._pending = None
+            return False
+        entry = _Entry(self._pending or {}, self._pendingReplace, before, after)
+        self._pending = None
+        self.undoStack.append(entry)
+        self.bytes += entry.bytes
+        for redoEntry in self.redoStack:
+            self.bytes -= redoEntry.bytes
+        self.redoStack.clear()
+        self._trim()
+        return True
+
+    def _trim(self):
+        # 最近的一步总是保留，即使它本身超出字节上限（例如清空一张很大的画布）
+        while len(self.undoStack) > 1 and (len(self.undoStack) > self.maxSteps or self.bytes > self.maxBytes):
+            self.bytes -= self.undoStack.popleft().bytes
+
+    def clear(self):
+        self.undoStack.clear()
+        self.redoStack.clear()
+        self.bytes = 0
+        self._pending = None
+
+    # ---- 撤销/重做 ----
+
+    def _apply(self, surface, entry):
+        """把 entry 写回 surface，返回 (反向记录, 需要刷新的矩形)"""
+        keys = self._allKeys(surface) if entry.replace else list(entry.tiles)
+        inverse = _Entry({key: self._encode(surface, key) for key in keys}, entry.replace,
+                         entry.inverseMarker, entry.marker)
+
+        dirty = QRect()
+        if entry.replace:
+            dirty = surface.bounds()
+            surface.clear()
+        for key, encoded in entry.tiles.items():
+            self._decode(surface, key, encoded)
+            dirty = dirty.united(self._tileRect(key))
+        return inverse, dirty
+
+    def oldestMarker(self):
+        """撤销到最早的一步时恢复的标记；没有撤销记录时返回None"""
+        return self.undoStack[0].marker if self.undoStack else None
+
+    def canUndo(self):
+        return bool(self.undoStack)
+
+    def canRedo(self):
+        return bool(self.redoStack)
+
+    def undo(self, surface):
+        """
+        撤销一步，返回 (需要刷新的矩形, 标记)
+
+        没有可撤销的操作时返回 (None, None)。
+        """
+        if not self.undoStack:
+            return None, None
+        entry = self.undoStack.pop()
+        self.bytes -= entry.bytes
+        inverse, dirty = self._apply(surface, entry)
+        self.redoStack.append(inverse)
+        self.bytes += inverse.bytes
+        return dirty, entry.marker
+
+    def redo(self, surface):
+        """重做一步，返回 (需要刷新的矩形, 标记)；没有可重做的操作时返回 (None, None)"""
+        if not self.redoStack:
+            return None, None
+        entry = self.redoStack.pop()
+        self.bytes -= entry.bytes
+        inverse, dirty = self._apply(surface, entry)
+        self.undoStack.append(inverse)
+        self.bytes += inverse.bytes
+        self._trim()
+        return dirty, entry.marker